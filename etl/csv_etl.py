@@ -11,25 +11,12 @@ ex row:
 
 002351bfaa49,43.5813927142857,-79.6150485714286
 
+The raw input is tab delimited (bssid, lat, lon) rows.  See
+offline_encoder/etl.py for the options.
 '''
-import sys
-import csv
+import etl
 
-bssid_set = set()
-with open('input.csv', 'w') as fout:
-    writer = csv.writer(fout)
-    for i, row in enumerate(csv.reader(open('input_raw.csv'), delimiter='\t')):
-        try:
-            float(row[1])
-            float(row[2])
-            bssid = row[0].strip()
-            if len(bssid) == 12:
-                if bssid in bssid_set:
-                    print "already have : %s" % bssid
-                    continue
-                bssid_set.add(bssid)
-                writer.writerow((row[0], row[1], row[2]))
-        except:
-            e = sys.exc_info()[0]
-            print "Skipping : %d" % i
-            continue
+if __name__ == '__main__':
+    etl.main(default_input='input_raw.csv',
+             default_output='input.csv',
+             default_format='tsv')
@@ -0,0 +1,186 @@
+#!/usr/bin/env python
+
+"""
+Build record tries for many cities at once.
+
+The cities are listed in a JSON manifest :
+
+    {
+        "cities": [
+            {
+                "name": "toronto",
+                "input": "inputs/toronto.csv",
+                "seed": 123344129,
+                "output_dir": "outputs/toronto"
+            },
+            ...
+        ]
+    }
+
+Each city gets its own output directory which holds all of its
+persistent state (sobol sequence, bssid_sobol_idx.csv, ordered city
+tiles) along with the record trie.  Relative paths are resolved
+against the directory the manifest is in.
+
+An optional "mode" of "fused" (the default) or "delta" selects how a
+city is built.
+
+Cities are built concurrently on a bounded pool of worker processes.
+A city is skipped when its input file, seed and mode are the same as
+they were for its last successful build.
+"""
+
+# Standard library
+import argparse
+import hashlib
+import json
+import multiprocessing
+import os
+import traceback
+from os.path import abspath, dirname, isdir, isfile, join
+
+# Custom modules
+from encoder import PrivateLocations
+
+BUILD_STAMP = 'build_stamp.json'
+
+BUILD_MODES = ('fused', 'delta')
+
+
+def load_manifest(manifest_fname):
+    '''
+    Return a list of city dicts with all paths made absolute
+    '''
+    base_dir = dirname(abspath(manifest_fname))
+    with open(manifest_fname) as fin:
+        manifest = json.load(fin)
+
+    cities = []
+    names = set()
+    for city in manifest['cities']:
+        name = city['name']
+        if name in names:
+            raise RuntimeError("Duplicate city in manifest: %s" % name)
+        names.add(name)
+
+        mode = city.get('mode', 'fused')
+        if mode not in BUILD_MODES:
+            raise RuntimeError("Invalid mode for %s: %s" % (name, mode))
+
+        cities.append({'name': name,
+                       'input': join(base_dir, city['input']),
+                       'seed': int(city['seed']),
+                       'output_dir': join(base_dir, city['output_dir']),
+                       'mode': mode})
+    return cities
+
+
+def input_digest(fname):
+    sha = hashlib.sha256()
+    with open(fname, 'rb') as fin:
+        for block in iter(lambda: fin.read(1024 * 1024), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def _stamp(city):
+    return {'input_sha256': input_digest(city['input']),
+            'seed': city['seed'],
+            'mode': city['mode']}
+
+
+def is_up_to_date(city, locations):
+    '''
+    True if the city was last built from the same input, seed and
+    mode and its record trie is still there.
+    '''
+    stamp_fname = join(city['output_dir'], BUILD_STAMP)
+    if not (isfile(stamp_fname) and isfile(locations.output_trie_fname)):
+        return False
+    with open(stamp_fname) as fin:
+        return json.load(fin) == _stamp(city)
+
+
+def city_locations(city):
+    return PrivateLocations(
+        bssid_input=city['input'],
+        output_dir=city['output_dir'],
+        sobol_seed=city['seed'],
+        ordered_city_csv=join(city['output_dir'], 'ordered_city.csv'))
+
+
+def build_city(args):
+    '''
+    Build a single city.  This runs in a worker process so it returns
+    a (name, status, detail) tuple instead of raising.
+    '''
+    city, force = args
+    try:
+        if not isdir(city['output_dir']):
+            os.makedirs(city['output_dir'])
+
+        locations = city_locations(city)
+        if not force and is_up_to_date(city, locations):
+            return city['name'], 'skipped', None
+
+        stamp = _stamp(city)
+        if city['mode'] == 'delta':
+            locations.generate_recordtrie_delta()
+        else:
+            locations.generate_recordtrie_fused()
+
+        with open(join(city['output_dir'], BUILD_STAMP), 'w') as fout:
+            json.dump(stamp, fout)
+        return city['name'], 'built', None
+    except Exception:
+        return city['name'], 'failed', traceback.format_exc()
+
+
+def build_cities(cities, jobs=None, force=False):
+    '''
+    Build every city on a pool of at most `jobs` worker processes and
+    return a dict of city name -> (status, detail).
+    '''
+    if jobs is None:
+        jobs = multiprocessing.cpu_count()
+    jobs = max(1, min(jobs, len(cities)))
+
+    results = {}
+    pool = multiprocessing.Pool(jobs)
+    try:
+        work = [(city, force) for city in cities]
+        for name, status, detail in pool.imap_unordered(build_city, work):
+            print "%s: %s" % (name, status)
+            results[name] = (status, detail)
+    finally:
+        pool.close()
+        pool.join()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Build tries for many cities')
+    parser.add_argument('manifest', help='JSON manifest of cities')
+    parser.add_argument('--jobs',
+                        type=int,
+                        default=None,
+                        help='Number of cities to build at once')
+    parser.add_argument('--force',
+                        action='store_true',
+                        help='Rebuild cities even if their input is unchanged')
+    args = parser.parse_args()
+
+    results = build_cities(load_manifest(args.manifest),
+                           args.jobs,
+                           args.force)
+
+    failed = 0
+    for name, (status, detail) in sorted(results.items()):
+        if status == 'failed':
+            failed += 1
+            print "%s failed:\n%s" % (name, detail)
+    if failed:
+        raise SystemExit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,253 @@
+#!/usr/bin/env python
+
+"""
+Benchmark the encoder on synthetic cities.
+
+A synthetic input is a CSV of (bssid, lat, lon) rows with random
+BSSIDs spread uniformly over a bounding box.  Each benchmark builds a
+fresh city from scratch in a temporary directory and keeps the build
+report of every stage (see buildstats.py).  Builds run in a child
+process so that the peak RSS of one run doesn't leak into the next.
+
+    python ./bench.py --rows 100000 --rows 1000000 --mode staged --mode fused
+
+Results are compared against a stored baseline, which maps
+"<mode>/<rows>" to the rows/sec and peak RSS of each stage.  A stage
+which is more than --tolerance slower or bigger than its baseline is
+reported as a regression and the exit status is 1.  Use
+--save-baseline to record the current results as the new baseline.
+
+Baselines are only comparable on the same hardware.
+"""
+
+# Standard library
+import argparse
+import csv
+import json
+import multiprocessing
+import os
+import shutil
+import tempfile
+import traceback
+from os.path import abspath, dirname, isfile, join
+
+# PyPI
+import numpy as np
+
+# Custom modules
+from encoder import PrivateLocations
+
+BASELINE = join(dirname(abspath(__file__)), 'bench_baseline.json')
+
+# Toronto
+DEFAULT_BBOX = (43.58, -79.64, 43.86, -79.12)
+
+DEFAULT_ROWS = (100000,)
+
+MODES = ('staged', 'fused', 'parallel')
+
+# Rows generated at a time
+CHUNK_ROWS = 1000000
+
+
+def generate_input(fname, rows, bbox=DEFAULT_BBOX, seed=0):
+    '''
+    Write rows of random (bssid, lat, lon) into fname.  bbox is
+    (min_lat, min_lon, max_lat, max_lon).  The output only depends on
+    rows, bbox and seed.
+    '''
+    min_lat, min_lon, max_lat, max_lon = bbox
+    rand = np.random.RandomState(seed)
+    with open(fname, 'w') as fout:
+        writer = csv.writer(fout)
+        for offset in xrange(0, rows, CHUNK_ROWS):
+            count = min(CHUNK_ROWS, rows - offset)
+            # randint only draws up to 2 ** 31 on some platforms, so
+            # BSSIDs are made of two 24 bit halves.
+            bssids = ((rand.randint(0, 2 ** 24, size=count).astype(np.int64) << 24) |
+                      rand.randint(0, 2 ** 24, size=count).astype(np.int64))
+            lats = rand.uniform(min_lat, max_lat, count)
+            lons = rand.uniform(min_lon, max_lon, count)
+            writer.writerows(('%012x' % b, '%.7f' % lat, '%.7f' % lon)
+                             for b, lat, lon in zip(bssids.tolist(),
+                                                    lats.tolist(),
+                                                    lons.tolist()))
+
+
+def _build(mode, input_fname, city_dir, workers):
+    pl = PrivateLocations(bssid_input=input_fname,
+                          output_dir=city_dir,
+                          ordered_city_csv=join(city_dir, 'ordered_city.csv'))
+    if mode == 'staged':
+        pl.generate_recordtrie()
+    elif mode == 'fused':
+        pl.generate_recordtrie_fused()
+    else:
+        pl.generate_recordtrie_parallel(workers)
+    return pl.report.as_dict()
+
+
+def _build_child(queue, args):
+    try:
+        queue.put((True, _build(*args)))
+    except Exception:
+        queue.put((False, traceback.format_exc()))
+
+
+def run_benchmark(mode, rows, bbox=DEFAULT_BBOX, workers=None, work_dir=None):
+    '''
+    Build a synthetic city of the given size from scratch and return
+    its build report.
+    '''
+    if mode not in MODES:
+        raise RuntimeError("Invalid benchmark mode: %s" % mode)
+
+    tmp_dir = tempfile.mkdtemp(dir=work_dir)
+    try:
+        input_fname = join(tmp_dir, 'input.csv')
+        city_dir = join(tmp_dir, 'city')
+        os.makedirs(city_dir)
+        generate_input(input_fname, rows, bbox)
+
+        # A fresh process per build keeps peak RSS figures separate.
+        # The parallel mode needs its own worker pool so it can't run
+        # inside a daemonic pool process.
+        queue = multiprocessing.Queue()
+        child = multiprocessing.Process(target=_build_child,
+                                        args=(queue, (mode,
+                                                      input_fname,
+                                                      city_dir,
+                                                      workers)))
+        child.start()
+        ok, report = queue.get()
+        child.join()
+        if not ok:
+            raise RuntimeError("%s benchmark failed:\n%s" % (mode, report))
+        report['rows'] = rows
+        return report
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def summarize(report):
+    '''
+    Reduce a build report to {stage name: {rows_per_sec, peak_rss_kb}}
+    '''
+    return dict((s['name'], {'rows_per_sec': s['rows_per_sec'],
+                             'peak_rss_kb': s['peak_rss_kb']})
+                for s in report['stages'])
+
+
+def compare(results, baseline, tolerance):
+    '''
+    Return a list of regression messages for every stage which is
+    slower or uses more memory than its baseline by more than
+    tolerance.
+    '''
+    regressions = []
+    for key, stages in sorted(results.items()):
+        for name, stats in sorted(stages.items()):
+            base = baseline.get(key, {}).get(name)
+            if base is None:
+                continue
+            if (base['rows_per_sec'] and stats['rows_per_sec'] is not None and
+                    stats['rows_per_sec'] < base['rows_per_sec'] * (1 - tolerance)):
+                regressions.append("%s %s: %.0f rows/sec, baseline %.0f" %
+                                   (key, name,
+                                    stats['rows_per_sec'],
+                                    base['rows_per_sec']))
+            if stats['peak_rss_kb'] > base['peak_rss_kb'] * (1 + tolerance):
+                regressions.append("%s %s: %d KB peak RSS, baseline %d KB" %
+                                   (key, name,
+                                    stats['peak_rss_kb'],
+                                    base['peak_rss_kb']))
+    return regressions
+
+
+def load_baseline(fname):
+    if not isfile(fname):
+        return {}
+    with open(fname) as fin:
+        return json.load(fin)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the encoder')
+    parser.add_argument('--rows',
+                        type=int,
+                        action='append',
+                        help='Number of input rows, may be repeated '
+                             '(default: %s)' % ', '.join(map(str, DEFAULT_ROWS)))
+    parser.add_argument('--mode',
+                        choices=MODES,
+                        action='append',
+                        help='Encoder mode to run, may be repeated (default: staged)')
+    parser.add_argument('--bbox',
+                        type=float,
+                        nargs=4,
+                        default=DEFAULT_BBOX,
+                        metavar=('MIN_LAT', 'MIN_LON', 'MAX_LAT', 'MAX_LON'),
+                        help='Bounding box of the synthetic city')
+    parser.add_argument('--workers',
+                        type=int,
+                        default=None,
+                        help='Worker processes for the parallel mode')
+    parser.add_argument('--work-dir',
+                        default=None,
+                        help='Directory for the temporary city files')
+    parser.add_argument('--baseline',
+                        default=BASELINE,
+                        help='Baseline JSON file')
+    parser.add_argument('--save-baseline',
+                        action='store_true',
+                        help='Store these results in the baseline file')
+    parser.add_argument('--tolerance',
+                        type=float,
+                        default=0.2,
+                        help='Allowed slowdown or memory growth as a fraction')
+    parser.add_argument('--output',
+                        default=None,
+                        help='Write the full build reports here as JSON')
+    args = parser.parse_args()
+
+    reports = {}
+    results = {}
+    for mode in args.mode or ['staged']:
+        for rows in args.rows or DEFAULT_ROWS:
+            key = '%s/%d' % (mode, rows)
+            print "Running %s" % key
+            reports[key] = run_benchmark(mode,
+                                         rows,
+                                         tuple(args.bbox),
+                                         args.workers,
+                                         args.work_dir)
+            results[key] = summarize(reports[key])
+
+    for key, stages in sorted(results.items()):
+        for name, stats in sorted(stages.items()):
+            print "%-20s %-12s %12.0f rows/sec %10d KB" % (key,
+                                                         name,
+                                                         stats['rows_per_sec'] or 0,
+                                                         stats['peak_rss_kb'])
+
+    if args.output:
+        with open(args.output, 'w') as fout:
+            json.dump(reports, fout, indent=2, sort_keys=True,
+                      separators=(',', ': '))
+
+    baseline = load_baseline(args.baseline)
+    if args.save_baseline:
+        baseline.update(results)
+        with open(args.baseline, 'w') as fout:
+            json.dump(baseline, fout, indent=2, sort_keys=True,
+                      separators=(',', ': '))
+        return
+
+    regressions = compare(results, baseline, args.tolerance)
+    for msg in regressions:
+        print "REGRESSION %s" % msg
+    if regressions:
+        raise SystemExit(1)
+
+if __name__ == '__main__':
+    main()
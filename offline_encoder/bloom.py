@@ -0,0 +1,132 @@
+'''
+A bloom filter of the hashed BSSIDs in a city.
+
+The filter answers "could this BSSID be in the city's trie" without
+opening the trie.  It never misses a BSSID which is in the trie, and
+with the default of 10 bits per BSSID about 1% of other BSSIDs are
+let through as well.
+
+Items are the 48 bit integer value of the digest prefix that every
+trie key is made from (see trieformat.py), so one filter serves every
+key scheme.  The digest is already uniformly distributed, so the bit
+positions come straight from it by double hashing :
+
+    h1 = value >> 24, h2 = (value & 0xffffff) | 1
+    bit i = (h1 + i * h2) mod num_bits
+
+The filter file is a small header followed by the bit array :
+
+    magic       8 bytes  'BSSBLOOM'
+    version     uint32
+    num_hashes  uint32
+    num_bits    uint64
+    num_keys    uint64
+    bits        uint8[ceil(num_bits / 8)]
+
+Everything is little endian.
+'''
+import binascii
+import math
+import struct
+
+import numpy as np
+
+BLOOM_MAGIC = b'BSSBLOOM'
+BLOOM_VERSION = 1
+BLOOM_HEADER = struct.Struct('<8sIIQQ')
+
+BITS_PER_KEY = 10
+
+
+def digest_value(digest):
+    '''
+    The integer value of a digest prefix
+    '''
+    return int(binascii.hexlify(digest), 16)
+
+
+class BloomFilter(object):
+    def __init__(self, bits, num_bits, num_hashes, num_keys=0):
+        self.bits = bits
+        self.num_bits = num_bits
+        self.num_hashes = num_hashes
+        self.num_keys = num_keys
+
+    @classmethod
+    def build(cls, values, bits_per_key=BITS_PER_KEY):
+        '''
+        Build a filter holding an array of digest values
+        '''
+        values = np.asarray(values, dtype=np.uint64)
+        num_bits = max(64, len(values) * bits_per_key)
+        num_hashes = max(1, int(round(bits_per_key * math.log(2))))
+        bloom = cls(np.zeros((num_bits + 7) // 8, dtype=np.uint8),
+                    num_bits,
+                    num_hashes,
+                    len(values))
+        one = np.uint8(1)
+        for positions in bloom._positions(values):
+            np.bitwise_or.at(bloom.bits,
+                             (positions >> np.uint64(3)).astype(np.int64),
+                             one << (positions & np.uint64(7)).astype(np.uint8))
+        return bloom
+
+    def _positions(self, values):
+        h1 = values >> np.uint64(24)
+        h2 = (values & np.uint64(0xffffff)) | np.uint64(1)
+        for i in range(self.num_hashes):
+            yield (h1 + np.uint64(i) * h2) % np.uint64(self.num_bits)
+
+    def contains_values(self, values):
+        '''
+        Return a boolean array which is True for every digest value
+        which may be in the filter.
+        '''
+        values = np.asarray(values, dtype=np.uint64)
+        found = np.ones(len(values), dtype=bool)
+        for positions in self._positions(values):
+            found &= (self.bits[(positions >> np.uint64(3)).astype(np.int64)] >>
+                      (positions & np.uint64(7)).astype(np.uint8)) & 1 == 1
+        return found
+
+    def __contains__(self, digest):
+        return bool(self.contains_values([digest_value(digest)])[0])
+
+    def save(self, fname):
+        with open(fname, 'wb') as fout:
+            self.write(fout)
+
+    def write(self, fout):
+        '''
+        Write the filter to an open file at its current position
+        '''
+        fout.write(BLOOM_HEADER.pack(BLOOM_MAGIC,
+                                     BLOOM_VERSION,
+                                     self.num_hashes,
+                                     self.num_bits,
+                                     self.num_keys))
+        np.asarray(self.bits, dtype=np.uint8).tofile(fout)
+
+    def size(self):
+        return BLOOM_HEADER.size + len(self.bits)
+
+
+def load_bloom(fname, offset=0):
+    '''
+    Memory map a filter written by save(), starting offset bytes into
+    the file
+    '''
+    with open(fname, 'rb') as fin:
+        fin.seek(offset)
+        magic, version, num_hashes, num_bits, num_keys = \
+            BLOOM_HEADER.unpack(fin.read(BLOOM_HEADER.size))
+    if magic != BLOOM_MAGIC:
+        raise RuntimeError("Not a bloom filter: %s" % fname)
+    if version > BLOOM_VERSION:
+        raise RuntimeError("Unsupported bloom filter version: %d" % version)
+    bits = np.memmap(fname,
+                     dtype=np.uint8,
+                     mode='r',
+                     offset=offset + BLOOM_HEADER.size,
+                     shape=((num_bits + 7) // 8,))
+    return BloomFilter(bits, num_bits, num_hashes, num_keys)
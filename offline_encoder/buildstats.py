@@ -0,0 +1,152 @@
+"""
+Instrumentation for the stages of a record trie build.
+
+Each stage records :
+
+    wall_secs      elapsed wall clock time
+    cpu_secs       user + system time of this process and any worker
+                   processes which were reaped during the stage
+    rows_in        rows read by the stage
+    rows_out       rows produced by the stage
+    rows_per_sec   rows_in / wall_secs
+    peak_rss_kb    peak resident set size of the process (or of its
+                   largest worker) at the end of the stage
+    bytes_written  total size of the files the stage wrote.  Files
+                   which weren't modified during the stage are not
+                   counted.
+
+The report for a whole build is written out as JSON.  Stages can also
+be run under cProfile, with one profile dump per stage.
+"""
+import cProfile
+import json
+import os
+import resource
+import time
+from contextlib import contextmanager
+from os.path import getmtime, getsize, isfile, join
+
+
+def _cpu_secs():
+    t = os.times()
+    return t[0] + t[1] + t[2] + t[3]
+
+
+def peak_rss_kb():
+    '''
+    Peak resident set size in kilobytes of this process or of any of
+    its reaped child processes, whichever is larger.
+    '''
+    return max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+
+
+def _bytes_written(fnames, since):
+    # Skip files left over from an earlier build.  Some filesystems
+    # only keep whole seconds of mtime.
+    return sum(getsize(f) for f in fnames
+               if isfile(f) and getmtime(f) >= int(since))
+
+
+class StageStats(object):
+    def __init__(self, name):
+        self.name = name
+        self.wall_secs = 0.0
+        self.cpu_secs = 0.0
+        self.rows_in = 0
+        self.rows_out = 0
+        self.peak_rss_kb = 0
+        self.bytes_written = 0
+
+    def as_dict(self):
+        rows_per_sec = None
+        if self.wall_secs > 0:
+            rows_per_sec = self.rows_in / self.wall_secs
+        return {'name': self.name,
+                'wall_secs': self.wall_secs,
+                'cpu_secs': self.cpu_secs,
+                'rows_in': self.rows_in,
+                'rows_out': self.rows_out,
+                'rows_per_sec': rows_per_sec,
+                'peak_rss_kb': self.peak_rss_kb,
+                'bytes_written': self.bytes_written}
+
+
+class BuildReport(object):
+    '''
+    Collects StageStats for each stage of a build.
+
+    Code inside a stage reports the rows it handles with count() or
+    counted() without needing a reference to the stage.  Row counts
+    outside of any stage are ignored.
+    '''
+    def __init__(self, mode=None, profile_dir=None):
+        self.mode = mode
+        self.profile_dir = profile_dir
+        self.stages = []
+        self.info = {}
+        self._active = []
+        self._start = time.time()
+
+    @contextmanager
+    def stage(self, name, outputs=()):
+        stats = StageStats(name)
+        self._active.append(stats)
+
+        profile = None
+        if self.profile_dir:
+            profile = cProfile.Profile()
+
+        wall_start = time.time()
+        cpu_start = _cpu_secs()
+        if profile is not None:
+            profile.enable()
+        try:
+            yield stats
+        finally:
+            if profile is not None:
+                profile.disable()
+            stats.wall_secs = time.time() - wall_start
+            stats.cpu_secs = _cpu_secs() - cpu_start
+            stats.peak_rss_kb = peak_rss_kb()
+            stats.bytes_written = _bytes_written(outputs, wall_start)
+            self._active.pop()
+            self.stages.append(stats)
+
+            if profile is not None:
+                profile.dump_stats(join(self.profile_dir,
+                                        '%02d_%s.prof' % (len(self.stages), name)))
+
+        print ("Stage %s: %.2fs wall, %.2fs cpu, %d rows in, %d rows out" %
+               (name, stats.wall_secs, stats.cpu_secs, stats.rows_in, stats.rows_out))
+
+    def count(self, rows_in=0, rows_out=0):
+        if self._active:
+            self._active[-1].rows_in += rows_in
+            self._active[-1].rows_out += rows_out
+
+    def counted(self, rows):
+        '''
+        Pass an iterable through, counting each item as a row out of
+        the current stage.  The rows are added to the stage once the
+        iterable is done.
+        '''
+        num_rows = 0
+        try:
+            for row in rows:
+                num_rows += 1
+                yield row
+        finally:
+            self.count(rows_out=num_rows)
+
+    def as_dict(self):
+        return {'mode': self.mode,
+                'wall_secs': time.time() - self._start,
+                'peak_rss_kb': peak_rss_kb(),
+                'info': self.info,
+                'stages': [s.as_dict() for s in self.stages]}
+
+    def save(self, fname):
+        with open(fname, 'w') as fout:
+            json.dump(self.as_dict(), fout, indent=2, sort_keys=True,
+                      separators=(',', ': '))
@@ -0,0 +1,155 @@
+'''
+A city bundle packs everything the searcher needs for one city into
+a single file :
+
+    trie        the record trie, exactly as save_trie writes it
+    city_tiles  the ordered city tiles in the binary format of
+                OrderedCityTiles.save, with tile centres and adjacency
+    bloom       the bloom filter of the hashed BSSIDs, see bloom.py
+    metadata    JSON object, see below
+    trailer     magic       8 bytes  'CITYBNDL'
+                version     uint32
+                meta_offset uint64
+                meta_length uint64
+
+Everything is little endian.  The trie starts at offset 0 so that
+marisa_trie memory maps the bundle file itself, and ignores whatever
+follows the trie.  Every other section starts on an 8 byte boundary
+and is memory mapped in place.  Nothing is parsed on load except the
+trailer and the metadata.
+
+The metadata is :
+
+    version     format version of the bundle
+    header      the header of the trie (dupe_num, zoom, encoding, ...)
+    num_tiles   number of city tiles
+    sections    {name: [offset, length]} of every section
+
+A bundle can only hold an unsharded trie.
+'''
+import json
+import shutil
+import struct
+from os.path import getsize
+
+import bloom
+import trieformat
+from citytiles import OrderedCityTiles
+
+BUNDLE_MAGIC = b'CITYBNDL'
+BUNDLE_VERSION = 1
+BUNDLE_TRAILER = struct.Struct('<8sIQQ')
+
+SECTION_ALIGN = 8
+
+
+def _align(fout):
+    padding = -fout.tell() % SECTION_ALIGN
+    fout.write(b'\0' * padding)
+    return fout.tell()
+
+
+def save_bundle(fname, trie_fname, city_tiles, bloom_filter=None):
+    '''
+    Write a bundle from a record trie file, an OrderedCityTiles and
+    an optional BloomFilter.
+    '''
+    if trieformat.is_shard_index(trie_fname):
+        raise RuntimeError("Sharded tries can't be bundled: %s" % trie_fname)
+    header = trieformat.load_trie(trie_fname).header
+
+    sections = {}
+    with open(fname, 'wb') as fout:
+        with open(trie_fname, 'rb') as fin:
+            shutil.copyfileobj(fin, fout)
+        sections['trie'] = [0, fout.tell()]
+
+        start = _align(fout)
+        city_tiles.write(fout)
+        sections['city_tiles'] = [start, fout.tell() - start]
+
+        if bloom_filter is not None:
+            start = _align(fout)
+            bloom_filter.write(fout)
+            sections['bloom'] = [start, fout.tell() - start]
+
+        meta = json.dumps({'version': BUNDLE_VERSION,
+                           'header': header,
+                           'num_tiles': city_tiles.size(),
+                           'sections': sections},
+                          sort_keys=True)
+        meta_offset = _align(fout)
+        fout.write(meta)
+        fout.write(BUNDLE_TRAILER.pack(BUNDLE_MAGIC,
+                                       BUNDLE_VERSION,
+                                       meta_offset,
+                                       len(meta)))
+
+
+def _read_trailer(fname):
+    '''
+    Return (version, meta_offset, meta_length), or None if fname is
+    not a bundle
+    '''
+    if getsize(fname) < BUNDLE_TRAILER.size:
+        return None
+    with open(fname, 'rb') as fin:
+        fin.seek(-BUNDLE_TRAILER.size, 2)
+        magic, version, meta_offset, meta_length = \
+            BUNDLE_TRAILER.unpack(fin.read(BUNDLE_TRAILER.size))
+    if magic != BUNDLE_MAGIC:
+        return None
+    return version, meta_offset, meta_length
+
+
+def is_bundle(fname):
+    return _read_trailer(fname) is not None
+
+
+class CityBundle(object):
+    '''
+    A bundle file.  Only the trailer and the metadata are read up
+    front.  Each section is memory mapped when it is asked for.
+    '''
+    def __init__(self, fname):
+        trailer = _read_trailer(fname)
+        if trailer is None:
+            raise RuntimeError("Not a city bundle: %s" % fname)
+        version, meta_offset, meta_length = trailer
+        if version > BUNDLE_VERSION:
+            raise RuntimeError("Unsupported bundle version: %d" % version)
+        with open(fname, 'rb') as fin:
+            fin.seek(meta_offset)
+            self.meta = json.loads(fin.read(meta_length))
+
+        self.fname = fname
+        self.header = self.meta['header']
+        self.sections = self.meta['sections']
+
+    def size(self):
+        return getsize(self.fname)
+
+    def trie(self):
+        return trieformat.load_trie(self.fname)
+
+    def city_tiles(self):
+        city_tiles = OrderedCityTiles()
+        city_tiles.load(self.fname, offset=self.sections['city_tiles'][0])
+        return city_tiles
+
+    def bloom(self):
+        '''
+        The bloom filter, or None if the bundle was written without
+        one
+        '''
+        if 'bloom' not in self.sections:
+            return None
+        return bloom.load_bloom(self.fname, offset=self.sections['bloom'][0])
+
+
+def load_bundle(fname):
+    '''
+    Memory map the trie and city tiles of a bundle
+    '''
+    city_bundle = CityBundle(fname)
+    return city_bundle.trie(), city_bundle.city_tiles()
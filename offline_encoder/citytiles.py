@@ -1,81 +1,491 @@
 import csv
+import struct
+from itertools import izip
+
+import numpy as np
+
+from slippytiles import num2deg_array
 
 ORDERED_CITY_CSV = '../outputs/ordered_city.csv'
 
+# Tiles are zoom level 18 unless a city has too many tiles to fit in
+# 16 bits.  Those cities use coarser tiles for some or all of the
+# city.  The encoder modules import the zoom level from here, and the
+# searcher reads it from the trie header.
+#
+# Never change this unless you've thought about it 97 times.
+# Then still never change it.
+ZOOM_LEVEL = 18
+
+# The binary layout written by OrderedCityTiles.save :
+#
+#     magic       8 bytes  'CITYTILE'
+#     version     uint32
+#     num_tiles   uint32
+#     keys        int64[num_tiles]    packed zoom 18 NW corners
+#     lats        float64[num_tiles]  latitude of each tile centre
+#     lons        float64[num_tiles]  longitude of each tile centre
+#     zooms       uint8[num_tiles]
+#     adj_offsets uint32[num_tiles + 1]   (version 2)
+#     adj_tiles   uint32[adj_offsets[-1]] (version 2)
+#
+# Everything is little endian.  The arrays are memory mapped by load.
+# The neighbours of tile i are adj_tiles[adj_offsets[i]:adj_offsets[i + 1]].
+# Version 1 files have no adjacency arrays, they are computed when
+# they are first needed.
+CITY_MAGIC = b'CITYTILE'
+CITY_VERSION = 2
+CITY_HEADER = struct.Struct('<8sII')
+
+# (dx, dy) of the positions around a tile, in the order that their
+# tiles are listed by OrderedCityTiles.neighbours
+ADJACENT_OFFSETS = [(-1, -1), (0, -1), (1, -1),
+                    (-1, 0), (1, 0),
+                    (-1, 1), (0, 1), (1, 1)]
+
+
+def _pack(xs, ys):
+    return (np.asarray(xs, dtype=np.int64) << 32) | np.asarray(ys, dtype=np.int64)
+
+
+def _unpack(keys, zooms):
+    '''
+    Return the (tile_xs, tile_ys) arrays of packed zoom level 18 north
+    west corners, at the zoom level of each tile
+    '''
+    shifts = ZOOM_LEVEL - zooms.astype(np.int64)
+    return (keys >> 32) >> shifts, (keys & 0xffffffff) >> shifts
+
 
 class OrderedCityTiles(object):
     '''
     This class provides acts like an order preserving
     hashtable.
 
+    Zoom level 18 tiles are keyed by (tile_x, tile_y).  Coarser tiles
+    are keyed by (tile_x, tile_y, zoom) using the tile co-ordinates at
+    their own zoom level.  On disk, zoom level 18 tiles are written as
+    2 column rows and coarser tiles as 3 column rows.
+
+    Tiles are held in sorted numpy arrays.  Each tile is stored as
+    the packed zoom level 18 co-ordinates of its north west corner
+    and its zoom level, and tile ids are positions in those arrays.
+    Lookups are binary searches.  The centre of every tile is
+    computed once when the tile list is finalized or saved.
     '''
     def __init__(self, load_fromdisk=False, fname=None):
-        self._hash = {}
-        self._hash_list = []
+        # Tiles added with put() before finalize()
+        self._pending = []
+
+        self._keys = np.zeros(0, dtype=np.int64)
+        self._zooms = np.zeros(0, dtype=np.uint8)
+        self._lats = None
+        self._lons = None
+        self._coarse_zooms = []
+        self._adj_offsets = None
+        self._adj_tiles = None
+
+        # Permutation which sorts _keys, or None when they are
+        # already sorted.  Only CSV files written out of order need it.
+        self._order = None
 
         if fname is None:
             fname = ORDERED_CITY_CSV
 
         if load_fromdisk:
-            with open(fname) as fin:
-                reader = csv.reader(fin)
-                for (tile_x, tile_y) in reader:
-                    t = (int(tile_x.strip()), int(tile_y.strip()))
-                    self._hash_list.append(t)
-                    self._hash[t] = len(self._hash_list) - 1
+            self.load(fname)
+
+    def _norm_key(self, k):
+        if len(k) == 3 and k[2] == ZOOM_LEVEL:
+            return k[:2]
+        return k
 
     def __contains__(self, k):
         if isinstance(k, tuple):
-            # Return the integer tile_id
-            return k in self._hash
+            return self._find(k) is not None
         raise RuntimeError("Invalid key: %s" % k)
 
-    def finalize(self):
-        # Sort the list of tiles in place and fix up all the
-        # hash keys
+    def finalize(self, fname=None):
+        # Sort the tiles and fix up all the tile ids.  Tiles sort by
+        # the zoom level 18 co-ordinates of their north west corner
+        # so that a city with only zoom level 18 tiles sorts by
+        # (tile_x, tile_y).
+        if self._pending:
+            xs, ys, zooms = zip(*[self._split_key(k) for k in self._pending])
+            self._pending = []
+            self._set_tiles(np.concatenate([self._keys,
+                                            self._nw_keys(xs, ys, zooms)]),
+                            np.concatenate([self._zooms,
+                                            np.array(zooms, dtype=np.uint8)]))
 
-        self._hash_list.sort()
-        for i, k in enumerate(self._hash_list):
-            self._hash[k] = i
+        if fname is None:
+            fname = ORDERED_CITY_CSV
 
-        with open(ORDERED_CITY_CSV, 'w') as fout:
+        tile_xs, tile_ys, zooms = self.coords_array(np.arange(self.size()))
+        with open(fname, 'w') as fout:
             writer = csv.writer(fout)
-            for item in self._hash_list:
-                writer.writerow(item)
+            writer.writerows(k if k[2] != ZOOM_LEVEL else k[:2]
+                             for k in izip(tile_xs.tolist(),
+                                           tile_ys.tolist(),
+                                           zooms.tolist()))
+
+    def _split_key(self, k):
+        if len(k) == 2:
+            return k[0], k[1], ZOOM_LEVEL
+        return k
+
+    def _nw_keys(self, xs, ys, zooms):
+        shifts = ZOOM_LEVEL - np.asarray(zooms, dtype=np.int64)
+        return _pack(np.asarray(xs, dtype=np.int64) << shifts,
+                     np.asarray(ys, dtype=np.int64) << shifts)
+
+    def _set_tiles(self, keys, zooms, order=True):
+        '''
+        Replace the tiles.  Unless order is False, the tiles are
+        sorted and duplicates are dropped.
+        '''
+        if order:
+            keys, first = np.unique(keys, return_index=True)
+            zooms = zooms[first]
+            self._order = None
+        elif len(keys) and np.any(np.diff(keys) <= 0):
+            self._order = np.argsort(keys, kind='mergesort')
+        else:
+            self._order = None
+        self._keys = keys
+        self._zooms = zooms
+        self._lats = None
+        self._lons = None
+        self._adj_offsets = None
+        self._adj_tiles = None
+        self._coarse_zooms = sorted(set(self._zooms.tolist()) - set([ZOOM_LEVEL]),
+                                    reverse=True)
 
     def __getitem__(self, k):
         '''
         Enable fetching the item from the list interface
         '''
         # For indexed fetches into the list
-        if isinstance(k, int):
-            # Return the (tilex, tiley) tuple
-            try:
-                return self._hash_list[k]
-            except:
+        if isinstance(k, (int, long, np.integer)):
+            # Return the (tilex, tiley) tuple at the tile's own zoom
+            # level.
+            if not 0 <= k < len(self._keys):
                 return None, None
+            key = self._keys.item(k)
+            shift = ZOOM_LEVEL - self._zooms.item(k)
+            return (key >> 32) >> shift, (key & 0xffffffff) >> shift
 
         if isinstance(k, tuple):
             # Return the integer tile_id
-            return self._hash[k]
+            tile_id = self._find(k)
+            if tile_id is None:
+                raise KeyError(k)
+            return tile_id
 
         raise RuntimeError("Invalid key: %s" % k)
 
+    def _find(self, k):
+        '''
+        Return the tile id of exactly the tile k, or None
+        '''
+        x, y, zoom = self._split_key(self._norm_key(k))
+        shift = ZOOM_LEVEL - zoom
+        if shift < 0:
+            return None
+        key = ((x << shift) << 32) | (y << shift)
+        if self._order is None:
+            idx = int(self._keys.searchsorted(key))
+        else:
+            idx = int(self._keys.searchsorted(key, sorter=self._order))
+            if idx < len(self._order):
+                idx = self._order.item(idx)
+        if (idx < len(self._keys) and self._keys.item(idx) == key and
+                self._zooms.item(idx) == zoom):
+            return idx
+        return None
+
+    def find_array(self, tile_xs, tile_ys, zooms):
+        '''
+        Vectorized self[(tilex, tiley, zoom)] for arrays of tile
+        co-ordinates, each at its own zoom level.  Returns an array of
+        tile ids.  A KeyError is raised if any tile isn't in the city.
+        '''
+        tile_xs = np.asarray(tile_xs, dtype=np.int64)
+        tile_ys = np.asarray(tile_ys, dtype=np.int64)
+        zooms = np.asarray(zooms, dtype=np.int64)
+        tile_ids = np.zeros(len(tile_xs), dtype=np.int64) - 1
+        todo = np.flatnonzero(zooms <= ZOOM_LEVEL)
+        if len(self._keys) and len(todo):
+            shifts = ZOOM_LEVEL - zooms[todo]
+            keys = _pack(tile_xs[todo] << shifts, tile_ys[todo] << shifts)
+            idx = self._search(keys)
+            found = (self._keys[idx] == keys) & (self._zooms[idx] == zooms[todo])
+            tile_ids[todo[found]] = idx[found]
+        missing = np.flatnonzero(tile_ids < 0)
+        if len(missing):
+            i = missing[0]
+            raise KeyError(self._norm_key((int(tile_xs[i]), int(tile_ys[i]), int(zooms[i]))))
+        return tile_ids
+
+    def _search(self, keys):
+        '''
+        Return the ids of the tiles where an array of packed keys
+        would be.  The caller checks which of them match.
+        '''
+        if self._order is None:
+            idx = np.searchsorted(self._keys, keys)
+        else:
+            idx = np.searchsorted(self._keys, keys, sorter=self._order)
+        idx = np.minimum(idx, len(self._keys) - 1)
+        if self._order is not None:
+            idx = self._order[idx]
+        return idx
+
+    def coords_array(self, tile_ids):
+        '''
+        Vectorized self[tile_id] and zoom(tile_id) for an array of
+        tile ids.  Returns (tile_xs, tile_ys, zooms) arrays with the
+        co-ordinates at the zoom level of each tile.
+        '''
+        tile_ids = np.asarray(tile_ids, dtype=np.int64)
+        zooms = self._zooms[tile_ids]
+        tile_xs, tile_ys = _unpack(self._keys[tile_ids], zooms)
+        return tile_xs, tile_ys, zooms.astype(np.int64)
+
+    def zoom(self, tile_id):
+        '''
+        Return the zoom level of a tile id
+        '''
+        return self._zooms.item(tile_id)
+
+    def center(self, tile_id):
+        '''
+        Return the (lat, lon) of the centre of a tile
+        '''
+        self._compute_centers()
+        return float(self._lats[tile_id]), float(self._lons[tile_id])
+
+    def _compute_centers(self):
+        if self._lats is not None:
+            return
+        xs, ys = _unpack(self._keys, self._zooms)
+        lats = np.zeros(len(self._keys), dtype=np.float64)
+        lons = np.zeros(len(self._keys), dtype=np.float64)
+        for zoom in set(self._zooms.tolist()):
+            mask = self._zooms == zoom
+            lats[mask], lons[mask] = num2deg_array(xs[mask] + 0.5,
+                                                   ys[mask] + 0.5,
+                                                   zoom)
+        self._lats = lats
+        self._lons = lons
+
+    def resolve(self, k):
+        '''
+        Return the tile id of the tile which covers k.
+
+        k is either a zoom level 18 (tilex, tiley) or a
+        (tilex, tiley, zoom) tuple.  If there is no tile at exactly
+        that position, the coarser tiles of the city are searched
+        for one which contains it.  A KeyError is raised if no tile
+        covers k.
+        '''
+        k = self._norm_key(k)
+        tile_id = self._find(k)
+        if tile_id is not None:
+            return tile_id
+
+        x, y, zoom = self._split_key(k)
+        for coarse_zoom in self._coarse_zooms:
+            if coarse_zoom >= zoom:
+                continue
+            shift = zoom - coarse_zoom
+            tile_id = self._find((x >> shift, y >> shift, coarse_zoom))
+            if tile_id is not None:
+                return tile_id
+        raise KeyError(k)
+
+    def resolve_array(self, tile_xs, tile_ys):
+        '''
+        Vectorized resolve for arrays of zoom level 18 co-ordinates.
+        Returns an array of tile ids.  A KeyError is raised if any
+        tile is not covered by the city.
+        '''
+        tile_xs = np.asarray(tile_xs, dtype=np.int64)
+        tile_ys = np.asarray(tile_ys, dtype=np.int64)
+        tile_ids = self._resolve_ids(tile_xs,
+                                     tile_ys,
+                                     np.zeros(len(tile_xs), dtype=np.int64) + ZOOM_LEVEL)
+        missing = np.flatnonzero(tile_ids < 0)
+        if len(missing):
+            raise KeyError((int(tile_xs[missing[0]]), int(tile_ys[missing[0]])))
+        return tile_ids
+
+    def _resolve_ids(self, tile_xs, tile_ys, zooms):
+        '''
+        Vectorized resolve for arrays of tile co-ordinates, each at its
+        own zoom level.  Tiles which aren't covered get an id of -1.
+        '''
+        tile_ids = np.zeros(len(tile_xs), dtype=np.int64) - 1
+        if not len(self._keys):
+            return tile_ids
+        for zoom in [ZOOM_LEVEL] + self._coarse_zooms:
+            # Tiles are tried at their own zoom level first, then at
+            # each coarser zoom level just like resolve()
+            todo = np.flatnonzero((tile_ids < 0) & (zooms >= zoom))
+            if not len(todo):
+                continue
+            up = zooms[todo] - zoom
+            shift = ZOOM_LEVEL - zoom
+            keys = _pack((tile_xs[todo] >> up) << shift,
+                         (tile_ys[todo] >> up) << shift)
+            idx = self._search(keys)
+            found = (self._keys[idx] == keys) & (self._zooms[idx] == zoom)
+            tile_ids[todo[found]] = idx[found]
+        return tile_ids
+
+    def neighbours(self, tile_id):
+        '''
+        Return an array of the ids of the tiles next to a tile.
+
+        The 8 surrounding positions are taken at the zoom level of the
+        tile and resolved to the tiles which cover them.  Each
+        neighbour is listed once, in the order of the positions, and
+        the tile itself is never listed.
+        '''
+        self._compute_adjacency()
+        if not 0 <= tile_id < len(self._keys):
+            return self._adj_tiles[:0]
+        return self._adj_tiles[self._adj_offsets[tile_id]:self._adj_offsets[tile_id + 1]]
+
+    def _compute_adjacency(self):
+        if self._adj_offsets is not None:
+            return
+        num_tiles = len(self._keys)
+        xs, ys = _unpack(self._keys, self._zooms)
+
+        # One row for each of the 8 positions around every tile.  The
+        # positions of a row are in the same order as the tiles, which
+        # keeps the binary searches cheap.
+        zooms = self._zooms.astype(np.int64)
+        found = np.zeros((len(ADJACENT_OFFSETS), num_tiles), dtype=np.int64)
+        for row, (dx, dy) in enumerate(ADJACENT_OFFSETS):
+            found[row] = self._resolve_ids(xs + dx, ys + dy, zooms)
+
+        # Drop missing positions, the tile itself and repeats of a
+        # neighbour which covers more than one position.  Only coarser
+        # tiles can be repeated.
+        keep = (found >= 0) & (found != np.arange(num_tiles))
+        if self._coarse_zooms:
+            for row in range(1, len(found)):
+                for prev in range(row):
+                    keep[row] &= found[row] != found[prev]
+
+        self._adj_offsets = np.zeros(num_tiles + 1, dtype=np.uint32)
+        self._adj_offsets[1:] = np.cumsum(keep.sum(axis=0))
+        # Neighbours are listed tile by tile
+        self._adj_tiles = found.T[keep.T].astype(np.uint32)
+
     def put(self, k):
         '''
         k must be the (tilex, tiley) co-ordinates where both tilex and
-        tiley are integers.
+        tiley are integers, or (tilex, tiley, zoom) for tiles which
+        are not at zoom level 18.
+
+        New tiles don't get a tile id until finalize() is called.
         '''
         assert isinstance(k, tuple)
-        assert len(k) == 2
-        assert isinstance(k[0], int)
-        assert isinstance(k[1], int)
-        if k in self._hash:
-            # Skip this - we already added it
+        assert len(k) in (2, 3)
+        assert isinstance(k[0], (int, long))
+        assert isinstance(k[1], (int, long))
+        k = self._norm_key(k)
+        if len(k) == 3:
+            assert isinstance(k[2], int)
+            assert k[2] < ZOOM_LEVEL
+        self._pending.append(k)
+
+    def size(self):
+        return len(self._keys)
+
+    def __len__(self):
+        return self.size()
+
+    def save(self, fname):
+        '''
+        Write the tiles out in the binary format that load() memory
+        maps.
+        '''
+        with open(fname, 'wb') as fout:
+            self.write(fout)
+
+    def write(self, fout):
+        '''
+        Write the binary format to an open file at its current
+        position.  City bundles embed the tiles this way.
+        '''
+        self._compute_centers()
+        self._compute_adjacency()
+        fout.write(CITY_HEADER.pack(CITY_MAGIC, CITY_VERSION, self.size()))
+        self._keys.astype('<i8').tofile(fout)
+        self._lats.astype('<f8').tofile(fout)
+        self._lons.astype('<f8').tofile(fout)
+        self._zooms.astype(np.uint8).tofile(fout)
+        self._adj_offsets.astype('<u4').tofile(fout)
+        self._adj_tiles.astype('<u4').tofile(fout)
+
+    def load(self, fname, offset=0):
+        '''
+        Load the tiles from a binary file written by save(), or from
+        a CSV file written by finalize().  Tile ids follow the order
+        of the file.
+
+        The binary format may also start at offset bytes into a
+        larger file, see bundle.py.
+        '''
+        with open(fname, 'rb') as fin:
+            fin.seek(offset)
+            is_binary = fin.read(len(CITY_MAGIC)) == CITY_MAGIC
+
+        if not is_binary:
+            with open(fname) as fin:
+                rows = [tuple(int(v.strip()) for v in row)
+                        for row in csv.reader(fin)]
+            if rows:
+                xs, ys, zooms = zip(*[self._split_key(self._norm_key(k))
+                                      for k in rows])
+            else:
+                xs = ys = zooms = ()
+            self._set_tiles(self._nw_keys(xs, ys, zooms),
+                            np.array(zooms, dtype=np.uint8),
+                            order=False)
             return
 
-        self._hash_list.append(k)
-        self._hash[k] = len(self._hash_list)-1
+        with open(fname, 'rb') as fin:
+            fin.seek(offset)
+            magic, version, num_tiles = CITY_HEADER.unpack(fin.read(CITY_HEADER.size))
+        if version > CITY_VERSION:
+            raise RuntimeError("Unknown city tile file version: %d" % version)
 
-    def size(self):
-        return len(self._hash_list)
+        offset = [offset + CITY_HEADER.size]
+
+        def _array(dtype, length):
+            start = offset[0]
+            offset[0] += length * np.dtype(dtype).itemsize
+            if not length:
+                return np.zeros(0, dtype=dtype)
+            return np.memmap(fname,
+                             dtype=dtype,
+                             mode='r',
+                             offset=start,
+                             shape=(length,))
+
+        keys = _array('<i8', num_tiles)
+        lats = _array('<f8', num_tiles)
+        lons = _array('<f8', num_tiles)
+        zooms = _array(np.uint8, num_tiles)
+
+        self._set_tiles(keys, zooms, order=False)
+        self._lats = lats
+        self._lons = lons
+        if version >= 2:
+            self._adj_offsets = _array('<u4', num_tiles + 1)
+            self._adj_tiles = _array('<u4', int(self._adj_offsets[-1]))
@@ -1,15 +1,74 @@
+"""
+Random integers read from the kernel's entropy source.
+
+Random bytes are read in large blocks into a refillable buffer so that
+drawing millions of integers doesn't turn into millions of tiny reads.
+Integers can be drawn one at a time or in batches as numpy arrays.
+"""
+import os
 import struct
 
-_random_source = open("/dev/random", "rb")
+import numpy as np
+
+RANDOM_SOURCE = "/dev/random"
+
+# Number of bytes to read from the random source at a time
+BLOCK_SIZE = 64 * 1024
+
+# Number of integers generated at a time by randint_gen
+BATCH_SIZE = 4096
+
+UINT32_MAX = 0xffffffff
+
+
+class EntropyPool(object):
+    """
+    A buffer of random bytes which is refilled from the random source
+    in blocks of block_size bytes.
+    """
+    def __init__(self, fname=RANDOM_SOURCE, block_size=BLOCK_SIZE):
+        self._source = open(fname, "rb")
+        self._block_size = block_size
+        self._buffer = b""
+        self._offset = 0
+
+    def read(self, length):
+        available = len(self._buffer) - self._offset
+        if available < length:
+            refill = max(self._block_size, length - available)
+            self._buffer = self._buffer[self._offset:] + self._source.read(refill)
+            self._offset = 0
+
+        result = self._buffer[self._offset:self._offset+length]
+        self._offset += length
+        return result
+
+    def uint32_array(self, count):
+        """
+        Return a numpy array of count random unsigned 32bit integers
+        """
+        return np.frombuffer(self.read(4 * count), dtype=np.uint32)
+
+
+_pool = None
+_pool_pid = None
+
+def _default_pool():
+    # A forked child must not hand out the bytes which are already
+    # buffered in its parent's pool.
+    global _pool, _pool_pid
+    if _pool is None or _pool_pid != os.getpid():
+        _pool = EntropyPool()
+        _pool_pid = os.getpid()
+    return _pool
 
 def random_bytes(len):
-    return _random_source.read(len)
+    return _default_pool().read(len)
 
 def unpack_uint32(bytes):
     tup = struct.unpack("I", bytes)
     return tup[0]
 
-UINT32_MAX = 0xffffffff
 def randint(low, high):
     """
     Return a random integer in the range [low, high], including
@@ -22,23 +81,41 @@ def randint(low, high):
     result = int(scale_factor * random_uint32) + low
     return result
 
-def randint_gen(low, high, count):
+def randint_array(low, high, count):
     """
-    Generator that yields random integers in the range [low, high],
-    including both endpoints.
+    Return a numpy array of count random integers in the range
+    [low, high], including both endpoints.
+
+    This uses the same scaling as randint.
     """
     n = (high - low) + 1
     assert n >= 1
     scale_factor = n / float(UINT32_MAX + 1)
-    for _ in range(count):
-        random_uint32 = unpack_uint32(random_bytes(4))
-        result = int(scale_factor * random_uint32) + low
-        yield result
+    random_uint32 = _default_pool().uint32_array(count)
+    return (scale_factor * random_uint32).astype(np.int64) + low
+
+def randint_gen(low, high, count, batch_size=None):
+    """
+    Generator that yields random integers in the range [low, high],
+    including both endpoints.
+
+    If batch_size is set, numpy arrays of up to batch_size integers
+    are yielded instead of single integers.
+    """
+    step = batch_size or BATCH_SIZE
+    for offset in xrange(0, count, step):
+        batch = randint_array(low, high, min(step, count - offset))
+        if batch_size:
+            yield batch
+        else:
+            for result in batch.tolist():
+                yield result
 
-def scramble_tiles(num_tiles, scramble_factor):
+def scramble_tiles(num_tiles, scramble_factor, batch_size=None):
     """
     Return a generator that will generate a series of tile locations.
     """
     return randint_gen(0,
                        num_tiles-1,
-                       int(num_tiles*scramble_factor))
+                       int(num_tiles*scramble_factor),
+                       batch_size)
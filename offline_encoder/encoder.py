@@ -6,24 +6,135 @@ a record trie for BSSID data.
 """
 
 # Standard library
+import argparse
+import binascii
 import csv
+import multiprocessing
+import os
+from itertools import chain, groupby, islice, izip, repeat
+from operator import itemgetter
 
-from os.path import isfile
+from os.path import abspath, isfile, join, splitext
 
 # Custom modules
-from devrand import randint
+import bloom
+import bundle
+from buildstats import BuildReport
+from devrand import randint_array
+import etl
+import pnpoly
 import tiler
-from slippytiles import deg2num
-from citytiles import OrderedCityTiles
+import tilefit
+import trieformat
+from slippytiles import deg2num_array
+from citytiles import OrderedCityTiles, ORDERED_CITY_CSV, ZOOM_LEVEL
 
 # PyPI stuff
-from marisa_trie import RecordTrie
+import numpy as np
 
 import hashlib
 
-# Never change this unless you've thought about it 97 times.
-# Then still never change it.
-ZOOM_LEVEL = 18
+
+def pack_tiles(tile_xs, tile_ys):
+    '''
+    Pack arrays of tile co-ordinates into single int64 keys which sort
+    in the same order as (tile_x, tile_y) tuples.
+    '''
+    return (np.asarray(tile_xs, dtype=np.int64) << 32) | tile_ys
+
+
+def unpack_tiles(tile_keys):
+    '''
+    Inverse of pack_tiles.  Returns lists of python integers.
+    '''
+    tile_keys = np.asarray(tile_keys, dtype=np.int64)
+    return (tile_keys >> 32).tolist(), (tile_keys & 0xffffffff).tolist()
+
+
+def merge_tile_counts(tile_keys, tile_counts, new_keys):
+    '''
+    Add an array of packed tile keys, which may contain repeats, to
+    the sorted unique tile_keys and their per tile counts.
+    '''
+    keys, idx = np.unique(np.concatenate([tile_keys, new_keys]),
+                          return_inverse=True)
+    weights = np.concatenate([tile_counts,
+                              np.ones(len(new_keys), dtype=np.int64)])
+    counts = np.bincount(idx, weights=weights).astype(np.int64)
+    return keys, counts
+
+
+def hash_bssid(bssid, key_scheme='hex'):
+    '''
+    Compute the record trie key for a raw BSSID
+    '''
+    return trieformat.bssid_key(bssid, key_scheme)
+
+
+def hex_key(key, key_scheme):
+    '''
+    The hex digest prefix of a record trie key.  This is how hashed
+    BSSIDs are written to the CSV files.
+    '''
+    if key_scheme == 'hex':
+        return key
+    return binascii.hexlify(trieformat.key_digest(key, key_scheme))
+
+
+def rebase_tiles_array(orig_tile_idxs, sobol_keys, sobol_seq, num_tiles, dupe_num):
+    '''
+    Takes arrays of original tile ids and sobol indexes and returns
+    an array with one row of dupe_num tile ids per BSSID.  The first
+    tile id of every row is the original tile.
+
+    The sobol sequence is 'rebased' onto the original tile : each
+    row is the dupe_num sobol tiles starting at the BSSID's sobol
+    index, shifted by the delta between the original tile and the
+    first of them.
+    '''
+    sobol_seq = np.asarray(sobol_seq, dtype=np.int64)
+    orig_tile_idxs = np.asarray(orig_tile_idxs, dtype=np.int64)
+    sobol_keys = np.asarray(sobol_keys, dtype=np.int64)
+
+    tile_deltas = orig_tile_idxs - sobol_seq[sobol_keys]
+    offsets = (sobol_keys[:, np.newaxis] + np.arange(dupe_num)) % len(sobol_seq)
+    return (tile_deltas[:, np.newaxis] + sobol_seq[offsets]) % num_tiles
+
+
+# Shared, read only state for the worker processes used by
+# PrivateLocations.generate_recordtrie_parallel
+_worker_state = None
+
+
+def _init_worker(city_fname, sobol_fname, dupe_num, key_scheme):
+    global _worker_state
+    city_tiles = OrderedCityTiles(load_fromdisk=True, fname=city_fname)
+    sobol_seq = tiler.load_sobol_seq(sobol_fname)
+    _worker_state = (city_tiles, sobol_seq, dupe_num, key_scheme)
+
+
+def _obfuscate_partition(columns):
+    '''
+    Compute the obfuscated records for one partition of the input,
+    given as (bssids, tile_xs, tile_ys, sobol idxs) columns.  The
+    BSSIDs are hashed and their tiles resolved here, so the parent
+    process only hands out rows.  Returns the keys and an array of
+    their tile ids in input order, which pickle far faster than a
+    list of records.
+    '''
+    city_tiles, sobol_seq, dupe_num, key_scheme = _worker_state
+    bssids, tile_xs, tile_ys, sobol_keys = columns
+    tile_ids = rebase_tiles_array(city_tiles.resolve_array(tile_xs, tile_ys),
+                                  sobol_keys,
+                                  sobol_seq,
+                                  city_tiles.size(),
+                                  dupe_num)
+    return [hash_bssid(bssid, key_scheme) for bssid in bssids], tile_ids
+
+
+def _partition_records(partition):
+    keys, tile_ids = partition
+    return izip(keys, tile_ids.tolist())
 
 
 class PrivateLocations(object):
@@ -34,18 +145,23 @@ class PrivateLocations(object):
     The output of this class in the context of offline geolocation is 2 files.
 
     A) A record trie which maps :
-        prefix(hash.sha2(BSSID), 12) -> 32-bit integer
+        prefix(hash.sha2(BSSID), 6 bytes) -> dupe_num 16-bit tile ids
+
+       The trie also carries a header which describes how the keys
+       and tile ids are encoded, see trieformat.py.
 
     B) An ordered list of tiles within the city.  This is used to map
        the integer value in A) to an actual tile_x, tile_y co-ordinate.
 
        The list of tiles for a city must not exceed 64k (16-bits) to
-       ensure reasonable space constraints.
+       ensure reasonable space constraints.  Cities with more zoom
+       level 18 tiles than that are fitted with coarser tiles, see
+       tilefit.py.
 
     To create repeatable 'random' offsets for the BSSIDs over time, we
     also have two files per city which define a stable SOBOL sequence.
 
-    The first is defined in self.sobol_seq_csv which is a SOBOL
+    The first is defined in self.sobol_seq_bin which is a SOBOL
     sequence of numbers for a city.  This should be persistent for the
     lifetime that we generate new datasets for a city.
 
@@ -54,20 +170,36 @@ class PrivateLocations(object):
     is to ensure that a single BSSID will generate stable random
     entries in the record trie over time.
     '''
-    def __init__(self):
+    def __init__(self,
+                 audit=False,
+                 bssid_input='inputs/input.csv',
+                 output_dir='outputs',
+                 sobol_seed=123344129,
+                 ordered_city_csv=ORDERED_CITY_CSV):
         self.dupe_num = 3
 
-        # Always always always write big endian/network byte order
-        self.fmt = ">" + ("i" * self.dupe_num)
+        # How the tile ids of each BSSID are stored in the record
+        # trie.  One of trieformat.ENCODINGS.  Records are always
+        # written big endian/network byte order.
+        self.trie_encoding = 'u16'
+
+        # How hashed BSSIDs are stored as record trie keys.  One of
+        # trieformat.KEY_SCHEMES.  CSV files always hold the hex form.
+        self.key_scheme = 'binary'
+
+        # Split the record trie into this many shards by hashed BSSID
+        # prefix.  Each shard is built on its own which bounds the
+        # memory needed to build the trie.
+        self.num_shards = 1
 
         # This is a CSV file with (BSSID, lat, lon)
-        self.bssid_input = 'inputs/input.csv'
+        self.bssid_input = bssid_input
 
         # This file contains the slippy tile coordinates and zoom
         # level for all tiles within the city shapefile boundaries.
         # CSV file is formatted with (x, y, zoom level) using slippy
         # tile zoom level 18 (or whatever ZOOM_LEVEL) is defined as.
-        self.incity_tiles = 'outputs/incity_tiles.csv'
+        self.incity_tiles = join(output_dir, 'incity_tiles.csv')
 
         # This pair of variables defines the initial seed to generate
         # a long sobol sequence of numbers, and the file name of the
@@ -76,80 +208,165 @@ class PrivateLocations(object):
         # data.  These values *must* be stable or else someone can
         # attack the dataset over time to see which points move, and
         # which points do not move to determine 'true' locations.
-        # TODO: this should probably be written out to disk somewhere
-        self.sobol_seed = 123344129
-        self.sobol_seq_csv = 'outputs/sobol_seq.csv'
+        # The seed is recorded in the header of sobol_seq_bin.
+        self.sobol_seed = sobol_seed
+        self.sobol_seq_bin = join(output_dir, 'sobol_seq.bin')
+
+        # Cities which were built before the binary sobol file existed
+        # have their sequence stored as CSV.  It gets converted to
+        # sobol_seq_bin the first time it is loaded.
+        self.sobol_seq_csv = join(output_dir, 'sobol_seq.csv')
 
         # This is an output file where each row is
         # (BSSID, tile_x, tile_y, zoom_level, sobol_idx)
         # The intent of this file is to be able to *generate* the
         # obfuscated BSSID set.  The sobol_idx number indicates an
-        # index to peek into the sobol_seq_csv file to start
+        # index to peek into the sobol_seq_bin file to start
         # generating a list of random placements within the city
         # space.
-        # All rows in this file are 'real' BSSIDs.
-        self.bssid_sobol_idx_csv = 'outputs/bssid_sobol_idx.csv'
+        # All rows in this file are 'real' BSSIDs, and it holds exactly
+        # the BSSIDs of the last build.
+        self.bssid_sobol_idx_csv = join(output_dir, 'bssid_sobol_idx.csv')
+
+        # The same layout for BSSIDs which have dropped out of the
+        # input.  They keep their sobol_idx in case they come back.
+        self.bssid_sobol_retired_csv = join(output_dir, 'bssid_sobol_retired.csv')
 
         # This is the same layout as bssid_sobol_idx_csv, but each row
         # is duplicated with fake tile_x, tile_y co-ordinates.  Those
         # tile_x and tile_y co-ordinates are generated by computing
         # offsets using the sobol_idx in the bssid_sobol_idx file.
-        self.bssid_sobol_obfuscated_csv = 'outputs/obfuscated.csv'
+        self.bssid_sobol_obfuscated_csv = join(output_dir, 'obfuscated.csv')
 
         # The final record trie
-        self.output_trie_fname = 'outputs/area.record_trie'
+        self.output_trie_fname = join(output_dir, 'area.record_trie')
+
+        # Bloom filter of the hashed BSSIDs in the trie, so a searcher
+        # serving many cities can tell which of them a scan is in.
+        self.output_bloom_fname = join(output_dir, 'area.bloom')
+
+        # The trie, city tiles and bloom filter packed into one file
+        # which the searcher memory maps, see bundle.py.  Sharded
+        # tries are not bundled.
+        self.output_bundle_fname = join(output_dir, 'area.bundle')
+
+        # The ordered list of tiles within the city which maps tile
+        # ids in the record trie back to tile co-ordinates.
+        self.ordered_city_csv = ordered_city_csv
+
+        # The same list in a binary format which can be memory
+        # mapped.  This is what the searcher should load.
+        self.ordered_city_bin = splitext(ordered_city_csv)[0] + '.bin'
+        self._city_tiles = None
+
+        # The fused pipeline never writes the intermediate
+        # incity_tiles.csv and obfuscated.csv files unless auditing is
+        # enabled.  The sobol sequence and the sobol index files are
+        # persistent state and are always written.
+        self.audit = audit
+
+        # Number of input rows converted into tiles at a time
+        self.chunk_rows = 100000
+
+        # Every build writes a JSON report with timings, row counts
+        # and memory use for each stage.  Set report_fname to None to
+        # skip it.  If profile_dir is set, each stage is also run
+        # under cProfile and dumped into that directory.
+        self.report_fname = join(output_dir, 'build_report.json')
+        self.profile_dir = None
+        self.report = BuildReport()
+
+        # How a city with too many tiles is fitted into the 16 bit
+        # tile id space.  One of tilefit.FIT_MODES.
+        self.max_tiles = tilefit.MAX_TILES
+        self.tile_fit = 'mixed'
 
     def _compute_city_tiles(self):
         '''
         Filter input.csv (bssid, lat, lon) through the osm tile
         filter so that we can compute the set of tiles for a city.
 
-        The tileset *must* fit within 16bits (64k tiles).
-
-        If the tileset is too large, we :
-            * compute a bounding box around the total lat/lon set
-            * compute the center of the bounding box
-            * Compute total 2^16/# of actual tiles as N
-            * Scale the allowed longitudinal (horizontal) points from
-              the center point by sqrt(N*1.05)
-            * Scale the allowed latitude (vertical) points from
-              the center point by sqrt(N*1.05)
-            * Recalculate the tileset
+        The tileset *must* fit within 16bits (64k tiles).  If the
+        city covers more zoom level 18 tiles than that, the tiles are
+        fitted onto coarser zoom levels by tilefit.fit_tiles.
         '''
-
-        # This code has been removed to simplify the entire process.
-        # Just assume everything fits into a 64k tiled space for now.
-        # If the actual number of tiles exceeds 64k, we'll
-        # just scale down the the number of tiles to fit.
-
-        rows = 0
-        tile_set = set()
+        tile_keys = np.zeros(0, dtype=np.int64)
+        tile_counts = np.zeros(0, dtype=np.int64)
         with open(self.incity_tiles, 'w') as f_out:
             writer = csv.writer(f_out)
+            for chunk in self._iter_city_tile_chunks():
+                writer.writerows(self._iter_city_rows(chunk))
+                tile_keys, tile_counts = merge_tile_counts(
+                    tile_keys,
+                    tile_counts,
+                    pack_tiles(*chunk[1:]))
+
+        ordered_city_tiles = self._build_city(tile_keys, tile_counts)
+        self.report.count(rows_out=ordered_city_tiles.size())
+
+    def _build_city(self, tile_keys, tile_counts):
+        '''
+        Fit the packed zoom level 18 tile keys of a city into the 16
+        bit tile id space and return the finalized OrderedCityTiles.
+        tile_counts holds the number of BSSIDs seen in each tile.
+        '''
+        tile_xs, tile_ys = unpack_tiles(tile_keys)
+        tiles = tilefit.fit_tiles(tile_xs,
+                                  tile_ys,
+                                  tile_counts,
+                                  self.max_tiles,
+                                  self.tile_fit)
+        if len(tiles) < len(tile_xs):
+            print "Fitted %d tiles into %d tiles" % (len(tile_xs), len(tiles))
+
+        ordered_city_tiles = OrderedCityTiles()
+        for tile_key in tiles:
+            ordered_city_tiles.put(tile_key)
+        ordered_city_tiles.finalize(self.ordered_city_csv)
+        ordered_city_tiles.save(self.ordered_city_bin)
+        self._set_city_size(ordered_city_tiles.size())
+
+        # Later stages reuse the same tiles instead of building them
+        # again.
+        self._city_tiles = ordered_city_tiles
+        return ordered_city_tiles
 
-            with open(self.bssid_input, 'r') as f_in:
-                for i, row in enumerate(csv.reader(f_in)):
-                    bssid = row[0]
-                    lat = float(row[1])
-                    lon = float(row[2])
-                    tile_x, tile_y = deg2num(lat, lon, ZOOM_LEVEL)
-
-                    entry = (bssid, tile_x, tile_y, ZOOM_LEVEL)
-                    writer.writerow(entry)
-
-                    tile_key = (tile_x, tile_y)
-                    tile_set.add(tile_key)
-                    rows += 1
-
-        num_tiles = len(tile_set)
-        if num_tiles > 2**16:
-            # TODO: this is where we need to apply scaling.  For now,
-            # just abort early
-            raise RuntimeError("Too many tiles: [%d]" % num_tiles)
+    def _set_city_size(self, num_tiles):
         print "Total tileset size: %d" % num_tiles
 
         self.total_city_tiles = num_tiles
 
+    def _iter_city_tile_chunks(self):
+        '''
+        Stream (bssids, tile_xs, tile_ys) chunks computed from
+        input.csv (bssid, lat, lon).  Each chunk holds up to
+        self.chunk_rows rows and the tile co-ordinates are numpy
+        arrays.
+        '''
+        with open(self.bssid_input, 'r') as f_in:
+            reader = csv.reader(f_in)
+            while True:
+                rows = list(islice(reader, self.chunk_rows))
+                if not rows:
+                    break
+                self.report.count(rows_in=len(rows))
+                columns = zip(*rows)
+                bssids = columns[0]
+                lats = np.array(columns[1], dtype=np.float64)
+                lons = np.array(columns[2], dtype=np.float64)
+                tile_xs, tile_ys = deg2num_array(lats, lons, ZOOM_LEVEL)
+                yield bssids, tile_xs, tile_ys
+
+    def _iter_city_rows(self, chunk):
+        '''
+        Yield (bssid, tile_x, tile_y, zoom_level) rows for a chunk
+        '''
+        bssids, tile_xs, tile_ys = chunk
+        return izip(bssids,
+                    tile_xs.tolist(),
+                    tile_ys.tolist(),
+                    repeat(ZOOM_LEVEL))
+
     def _generate_bssid_sobol_keys(self):
         # Read in incity_tiles.csv
         # and write out `outputs/bssid_sobol_idx.csv` CSV file
@@ -159,30 +376,59 @@ class PrivateLocations(object):
         # random numbers assigned into it so it's important
         # to keep the bssid_sobol_idx.csv file around for the
         # next iteration of the tile generation.
-
-        if isfile(self.bssid_sobol_idx_csv):
-            print "!!!  SOBOL data already exists. Not regenerating it."
-            return
-
-        max_idx = tiler.write_sobol_seq(self.sobol_seq_csv,
-                                        self.sobol_seed,
-                                        self.total_city_tiles)
-
-
-        with open(self.bssid_sobol_idx_csv, 'w') as file_out:
+        #
+        # The rows are streamed in chunks into a new index file which
+        # only replaces the old one if anything changed.
+        max_idx = len(self._get_sobol_seq())
+        known_rows = self._load_sobol_keys(self.bssid_sobol_idx_csv)
+        retired_rows = self._load_sobol_keys(self.bssid_sobol_retired_csv)
+
+        changed = False
+        new_fname = self.bssid_sobol_idx_csv + '.new'
+        with open(new_fname, 'w') as file_out:
             writer = csv.writer(file_out)
             with open(self.incity_tiles) as file_in:
                 reader = csv.reader(file_in)
-                for row in reader:
-                    (bssid, tilex, tiley, zlevel) = row
-                    sobol_idx = randint(0, max_idx-1)
-                    r = (bssid, tilex, tiley, zlevel, sobol_idx)
-                    writer.writerow(r)
+                while True:
+                    rows = list(islice(reader, self.chunk_rows))
+                    if not rows:
+                        break
+                    statuses, sobol_idxs = self._assign_sobol_chunk(rows,
+                                                                    known_rows,
+                                                                    retired_rows,
+                                                                    max_idx)
+                    for row, sobol_idx in izip(rows, sobol_idxs):
+                        row.append(sobol_idx)
+                    writer.writerows(rows)
+                    self.report.count(rows_out=len(rows))
+                    if statuses.count('unchanged') < len(statuses):
+                        changed = True
+
+        if changed or known_rows or not isfile(self.bssid_sobol_idx_csv):
+            os.rename(new_fname, self.bssid_sobol_idx_csv)
+            self._retire_sobol_keys(retired_rows, known_rows.values())
+        else:
+            os.remove(new_fname)
+
+    def _has_sobol_seq(self):
+        return isfile(self.sobol_seq_bin) or isfile(self.sobol_seq_csv)
+
+    def _load_sobol_seq(self):
+        '''
+        Return the sobol sequence as an integer array
+        '''
+        if not isfile(self.sobol_seq_bin):
+            # The header can't record the max tile number that the CSV
+            # sequence was generated with, so use the largest value.
+            values = tiler.load_sobol_seq(self.sobol_seq_csv)
+            tiler.save_sobol_bin(self.sobol_seq_bin,
+                                 values,
+                                 self.sobol_seed,
+                                 int(values.max()))
+        return tiler.load_sobol_seq(self.sobol_seq_bin)
 
     def _obfuscate_tile_data(self):
         # TODO: this stage should be pluggable
-        # Consider rewriting this as a generator
-        # so that we can stream data into the file output.
 
         '''
         1. load in the sobol sequence as a circular list.
@@ -202,12 +448,7 @@ class PrivateLocations(object):
 
         print "Obscuring data now..."
 
-        sobol_seq = []
-        with open(self.sobol_seq_csv) as sobol_in:
-            reader = csv.reader(sobol_in)
-            for sobol_int, seed in reader:
-                sobol_seq.append((int(sobol_int), seed))
-
+        sobol_seq = self._load_sobol_seq()
         ordered_city_tiles = self._load_city()
 
         obfuscated_count = 0
@@ -215,116 +456,787 @@ class PrivateLocations(object):
             writer = csv.writer(fout)
             with open(self.bssid_sobol_idx_csv) as file_in:
                 reader = csv.reader(file_in)
-                for row_idx, row in enumerate(reader):
-                    (bssid, tile_x, tile_y, zlevel, sobol_key) = row
-                    (bssid,
-                     tile_x,
-                     tile_y,
-                     zlevel,
-                     sobol_key) = (bssid,
-                                   int(tile_x),
-                                   int(tile_y),
-                                   int(zlevel),
-                                   int(sobol_key))
-
-                    # Ok, we need to get the key into the ordered tile
+                while True:
+                    rows = list(islice(reader, self.chunk_rows))
+                    if not rows:
+                        break
+                    (bssids,
+                     tile_xs,
+                     tile_ys,
+                     zlevels,
+                     sobol_keys) = zip(*rows)
+                    hashed_bssids = [hashlib.sha256(bssid).hexdigest()[:12]
+                                     for bssid in bssids]
+
+                    # Ok, we need to get the keys into the ordered tile
                     # list.
-                    orig_tile_key = (tile_x, tile_y)
-                    orig_tile_idx = ordered_city_tiles[orig_tile_key]
-
-                    # Base sobol tile
-                    sobol_base_tile_id, _ignored = sobol_seq[sobol_key]
-
-                    # We need the delta so that we can transform the sobol
-                    # tile offsets and 'rebase' them onto the original
-                    # tile tile index
-
-                    tile_delta = orig_tile_idx - sobol_base_tile_id
-
-                    for i in range(self.dupe_num):
-                        (next_sobol_tile_id, next_sobol_seed) = sobol_seq[(sobol_key+i) % len(sobol_seq)]
-
-                        # Note that for i = 0, this will be the original
-                        # tile id
-                        norm_tile_id = (tile_delta + next_sobol_tile_id) % ordered_city_tiles.size()
-
-                        norm_tile_x, norm_tile_y, = ordered_city_tiles[norm_tile_id]
-                        # r = (bssid, norm_tile_x, norm_tile_y, zlevel)
-                        r = (hashlib.sha256(bssid).hexdigest()[:12], norm_tile_x, norm_tile_y, zlevel)
-
-                        writer.writerow(r)
-                        obfuscated_count += 1
-                        if obfuscated_count % 10000 == 0:
-                            print "Wrote %d rows of obfuscated bssid data with dupliates" % obfuscated_count
+                    orig_tile_idxs = ordered_city_tiles.resolve_array(
+                        np.array(tile_xs, dtype=np.int64),
+                        np.array(tile_ys, dtype=np.int64))
+
+                    tile_ids = rebase_tiles_array(orig_tile_idxs,
+                                                  np.array(sobol_keys, dtype=np.int64),
+                                                  sobol_seq,
+                                                  ordered_city_tiles.size(),
+                                                  self.dupe_num)
+                    # One output row per tile id, dupe_num rows per
+                    # BSSID
+                    norm_tile_xs, norm_tile_ys, norm_zlevels = \
+                        ordered_city_tiles.coords_array(tile_ids.ravel())
+                    writer.writerows(izip(chain.from_iterable(repeat(h, self.dupe_num)
+                                                              for h in hashed_bssids),
+                                          norm_tile_xs.tolist(),
+                                          norm_tile_ys.tolist(),
+                                          norm_zlevels.tolist()))
+
+                    self.report.count(rows_in=len(rows), rows_out=tile_ids.size)
+                    obfuscated_count += tile_ids.size
+                    print "Wrote %d rows of obfuscated bssid data with dupliates" % obfuscated_count
 
     def _load_city(self):
         """
-        TODO: this is called a couple times. it could use caching
+        Return the city tiles computed by the first stage.  They are
+        only rebuilt from incity_tiles.csv if this object didn't run
+        the first stage itself.
         """
-        ordered_city_tiles = OrderedCityTiles()
+        if self._city_tiles is not None:
+            return self._city_tiles
+
+        tile_keys = np.zeros(0, dtype=np.int64)
+        tile_counts = np.zeros(0, dtype=np.int64)
         with open(self.incity_tiles) as file_in:
-            for row in csv.reader(file_in):
-                (bssid, tile_x, tile_y, zlevel) = row
-                ordered_city_tiles.put((int(tile_x), int(tile_y)))
-        ordered_city_tiles.finalize()
-        return ordered_city_tiles
+            reader = csv.reader(file_in)
+            while True:
+                rows = list(islice(reader, self.chunk_rows))
+                if not rows:
+                    break
+                columns = zip(*rows)
+                tile_keys, tile_counts = merge_tile_counts(
+                    tile_keys,
+                    tile_counts,
+                    pack_tiles(np.array(columns[1], dtype=np.int64),
+                               np.array(columns[2], dtype=np.int64)))
+        return self._build_city(tile_keys, tile_counts)
 
     def _compute_tries(self):
         ordered_city_tiles = self._load_city()
 
-        dataset = {}
         with open(self.bssid_sobol_obfuscated_csv) as file_in:
-            reader = csv.reader(file_in)
-            last_bssid = None
-            bssid_locations = None
-            for row in reader:
-                bssid, tile_x, tile_y, zlevel = row
-
-                bssid = unicode(bssid)
-                tile_key = (int(tile_x), int(tile_y))
-                tile_id = ordered_city_tiles[tile_key]
-
-                if bssid != last_bssid:
-                    if last_bssid is not None:
-                        # push bssid-locations into dataset
-                        dataset[last_bssid] = bssid_locations
-                    bssid_locations = []
-                    if len(dataset) % 10000 == 0:
-                        print "Constructing trie with record: %d" % len(dataset)
-                bssid_locations.append(tile_id)
-                last_bssid = bssid
-
-            # Copy the last batch into the dataset
-            if bssid_locations:
-                dataset[last_bssid] = bssid_locations
+            tile_rows = self._iter_obfuscated_tiles(csv.reader(file_in),
+                                                    ordered_city_tiles)
+            if self.num_shards > 1:
+                # The shards are spilled to disk, so stream the records
+                # instead of holding every BSSID in memory.
+                records = ((bssid, [tile_id for (_, tile_id) in rows])
+                           for (bssid, rows) in groupby(tile_rows, itemgetter(0)))
+                self._save_trie((self._hex_to_key(k), v) for (k, v) in records)
+                return
+            dataset = self._group_tile_rows(tile_rows)
+
+        self._save_trie((self._hex_to_key(k), v) for (k, v) in dataset.iteritems())
+
+    def _iter_obfuscated_tiles(self, reader, ordered_city_tiles):
+        '''
+        Yield a (hashed bssid, tile id) row for every row of
+        obfuscated.csv
+        '''
+        while True:
+            rows = list(islice(reader, self.chunk_rows))
+            if not rows:
+                break
+            self.report.count(rows_in=len(rows))
+            bssids, tile_xs, tile_ys, zlevels = zip(*rows)
+            tile_ids = ordered_city_tiles.find_array(np.array(tile_xs, dtype=np.int64),
+                                                     np.array(tile_ys, dtype=np.int64),
+                                                     np.array(zlevels, dtype=np.int64))
+            for row in izip(bssids, tile_ids.tolist()):
+                yield row
+
+    def _group_tile_rows(self, tile_rows):
+        '''
+        Collect (hashed bssid, tile id) rows into a dict of hashed
+        bssid -> tile ids.  The rows of a BSSID are consecutive.
+        '''
+        dataset = {}
+        last_bssid = None
+        bssid_locations = None
+        for bssid, tile_id in tile_rows:
+            if bssid != last_bssid:
+                if last_bssid is not None:
+                    # push bssid-locations into dataset
+                    dataset[last_bssid] = bssid_locations
                 bssid_locations = []
+                if len(dataset) % 10000 == 0:
+                    print "Constructing trie with record: %d" % len(dataset)
+            bssid_locations.append(tile_id)
+            last_bssid = bssid
+
+        # Copy the last batch into the dataset
+        if bssid_locations:
+            dataset[last_bssid] = bssid_locations
+        return dataset
+
+    def _hex_to_key(self, hashed_bssid):
+        return trieformat.digest_key(binascii.unhexlify(hashed_bssid),
+                                     self.key_scheme)
+
+    def _trie_header(self):
+        return trieformat.make_header(self.dupe_num,
+                                      self.trie_encoding,
+                                      ZOOM_LEVEL,
+                                      self.total_city_tiles,
+                                      self.key_scheme)
+
+    def _trie_fnames(self):
+        '''
+        The files a build of the trie writes
+        '''
+        fnames = [self.output_trie_fname, self.output_bloom_fname]
+        if self.num_shards > 1:
+            fnames.extend(trieformat.shard_fname(self.output_trie_fname, i)
+                          for i in range(self.num_shards))
+        else:
+            fnames.append(self.output_bundle_fname)
+        return fnames
+
+    def _shard_spill_fname(self, shard_idx):
+        return trieformat.shard_fname(self.output_trie_fname, shard_idx) + '.csv'
+
+    def _save_sharded_trie(self, tile_rows):
+        '''
+        Build a trie split into self.num_shards shards from
+        (hashed bssid, tile id) rows.
 
-        print "Constructing trie"
-        trie = RecordTrie(self.fmt, dataset.items())
-        trie.save(self.output_trie_fname)
+        The rows are first split into one CSV file per shard.  Each
+        shard is then built on its own, so only one shard's records
+        are held in memory at a time.
+        '''
+        print "Splitting trie into %d shards" % self.num_shards
+        spill_files = [open(self._shard_spill_fname(i), 'w')
+                       for i in range(self.num_shards)]
+        try:
+            writers = [csv.writer(f) for f in spill_files]
+            for bssid, tile_id in tile_rows:
+                shard_idx = trieformat.shard_of(binascii.unhexlify(bssid),
+                                                self.num_shards)
+                writers[shard_idx].writerow((bssid, tile_id))
+        finally:
+            for f in spill_files:
+                f.close()
+
+        header = self._trie_header()
+        shard_records = []
+        for i in range(self.num_shards):
+            spill_fname = self._shard_spill_fname(i)
+            with open(spill_fname) as file_in:
+                rows = ((bssid, int(tile_id))
+                        for (bssid, tile_id) in csv.reader(file_in))
+                dataset = self._group_tile_rows(rows)
+            os.remove(spill_fname)
+
+            print "Constructing trie shard %d" % i
+            trieformat.save_trie(
+                trieformat.shard_fname(self.output_trie_fname, i),
+                self.report.counted((self._hex_to_key(k), v)
+                                    for (k, v) in dataset.iteritems()),
+                header)
+            shard_records.append(len(dataset))
+            del dataset
+
+        trieformat.save_shard_index(self.output_trie_fname, header, shard_records)
         print "trie saved!"
 
+    def _collect_digests(self, records, digests):
+        '''
+        Pass records through, appending the digest values of their
+        keys to the list digests as uint64 arrays of up to
+        self.chunk_rows values
+        '''
+        values = []
+        for key, tile_ids in records:
+            values.append(trieformat.key_value(key, self.key_scheme))
+            if len(values) == self.chunk_rows:
+                digests.append(np.array(values, dtype=np.uint64))
+                values = []
+            yield key, tile_ids
+        digests.append(np.array(values, dtype=np.uint64))
+
+    def _remove_stale_trie(self):
+        '''
+        Remove the files of the previous trie which this build won't
+        overwrite.  A sharded build drops the old bundle, which the
+        searcher would otherwise prefer, and an unsharded build drops
+        the old shards.
+        '''
+        stale = [self.output_bundle_fname]
+        if isfile(self.output_trie_fname):
+            stale.extend(trieformat.trie_fnames(self.output_trie_fname))
+        keep = set(abspath(f) for f in self._trie_fnames())
+        for fname in stale:
+            if abspath(fname) not in keep and isfile(fname):
+                os.remove(fname)
+
+    def _save_trie(self, records):
+        # Digest values are collected as the records go by and only
+        # turned into the bloom filter once the trie is written.
+        digests = []
+        records = self._collect_digests(records, digests)
+
+        self._remove_stale_trie()
+        if self.num_shards > 1:
+            self._save_sharded_trie((hex_key(key, self.key_scheme), tile_id)
+                                    for (key, tile_ids) in records
+                                    for tile_id in tile_ids)
+        else:
+            print "Constructing trie"
+            trieformat.save_trie(self.output_trie_fname,
+                                 self.report.counted(records),
+                                 self._trie_header())
+            print "trie saved!"
+
+        bloom_filter = bloom.BloomFilter.build(np.concatenate(digests))
+        bloom_filter.save(self.output_bloom_fname)
+
+        if self.num_shards == 1:
+            bundle.save_bundle(self.output_bundle_fname,
+                               self.output_trie_fname,
+                               self._load_city(),
+                               bloom_filter)
+
+    def _start_report(self, mode):
+        self.report = BuildReport(mode, self.profile_dir)
+
+    def _finish_report(self):
+        '''
+        Record the size of the city and trie, and write out the build
+        report.
+        '''
+        self.report.info.update({
+            'input': self.bssid_input,
+            'num_tiles': self.total_city_tiles,
+            'trie_bytes': trieformat.trie_size(self.output_trie_fname),
+            'trie_shards': self.num_shards,
+            'trie_encoding': self.trie_encoding,
+            'key_scheme': self.key_scheme})
+        if self.report_fname:
+            self.report.save(self.report_fname)
+
     def generate_recordtrie(self):
-        self._compute_city_tiles()
-        self._generate_bssid_sobol_keys()
-        self._obfuscate_tile_data()
-        self._compute_tries()
+        self._start_report('staged')
+        with self.report.stage('city_tiles', [self.incity_tiles]):
+            self._compute_city_tiles()
+        with self.report.stage('sobol_keys', self._sobol_key_fnames()):
+            self._generate_bssid_sobol_keys()
+        with self.report.stage('obfuscate', [self.bssid_sobol_obfuscated_csv]):
+            self._obfuscate_tile_data()
+        with self.report.stage('trie', self._trie_fnames()):
+            self._compute_tries()
+        self._finish_report()
+
+    # The fused pipeline runs the same four stages chained as
+    # generators so that records flow straight into the trie without
+    # any CSV round-trips.
+
+    def _fused_city_tiles(self):
+        '''
+        Stage 1: compute the tile for every input row.
 
+        The full tileset has to be known before any tile can be given
+        its ordered tile id, so the rows are kept in memory instead of
+        being written to incity_tiles.csv and parsed back.
+        '''
+        city_rows, tile_keys, tile_counts = self._read_city_rows()
+        ordered_city_tiles = self._build_city(tile_keys, tile_counts)
+        self.report.count(rows_out=ordered_city_tiles.size())
+        return city_rows, ordered_city_tiles
 
-def main():
+    def _read_city_rows(self):
+        '''
+        Read all of input.csv into a list of
+        (bssid, tile_x, tile_y, zoom_level) rows and return it with
+        the sorted, packed keys of every tile that was seen and the
+        number of rows in each of those tiles.
+        '''
+        chunks = list(self._iter_city_tile_chunks())
+        if chunks:
+            tile_keys, tile_counts = np.unique(
+                np.concatenate([pack_tiles(*c[1:]) for c in chunks]),
+                return_counts=True)
+        else:
+            tile_keys = np.zeros(0, dtype=np.int64)
+            tile_counts = np.zeros(0, dtype=np.int64)
+
+        city_rows = list(chain.from_iterable(self._iter_city_rows(c)
+                                             for c in chunks))
+        if self.audit:
+            with open(self.incity_tiles, 'w') as f_out:
+                csv.writer(f_out).writerows(city_rows)
+
+        return city_rows, tile_keys, tile_counts
+
+    def _get_sobol_seq(self):
+        if not self._has_sobol_seq():
+            tiler.write_sobol_bin(self.sobol_seq_bin,
+                                  self.sobol_seed,
+                                  self.total_city_tiles)
+        return self._load_sobol_seq()
+
+    def _assign_sobol_keys(self, city_rows, max_idx):
+        '''
+        Stage 2: give every (bssid, tile_x, tile_y, zoom_level) row its
+        sobol index and compare it with bssid_sobol_idx.csv.
+
+        BSSIDs which already have an index keep it so that their fake
+        locations are stable over time.  New BSSIDs get a fresh random
+        index.  BSSIDs which have dropped out of the input are moved to
+        bssid_sobol_retired.csv, and get their old index back if they
+        return.  Both files are rewritten whenever a BSSID was added,
+        moved to another tile or removed, so bssid_sobol_idx.csv always
+        holds exactly the rows of the last build.
+
+        Returns the (bssid, tile_x, tile_y, zoom_level, sobol_idx) rows,
+        the status of each row ('added', 'moved' or 'unchanged') and
+        the rows of the BSSIDs which were removed.
+        '''
+        known_rows = self._load_sobol_keys(self.bssid_sobol_idx_csv)
+        retired_rows = self._load_sobol_keys(self.bssid_sobol_retired_csv)
+        statuses, sobol_idxs = self._assign_sobol_chunk(city_rows,
+                                                        known_rows,
+                                                        retired_rows,
+                                                        max_idx)
+        sobol_rows = [row + (sobol_idx,)
+                      for (row, sobol_idx) in izip(city_rows, sobol_idxs)]
+
+        removed_rows = known_rows.values()
+        if removed_rows or statuses.count('unchanged') < len(statuses):
+            self._save_sobol_keys(self.bssid_sobol_idx_csv, sobol_rows)
+            self._retire_sobol_keys(retired_rows, removed_rows)
+        return sobol_rows, statuses, removed_rows
+
+    def _assign_sobol_chunk(self, city_rows, known_rows, retired_rows, max_idx):
+        '''
+        Give a chunk of rows their sobol indexes.  Rows which are found
+        are popped out of the dicts of known and retired rows.  Returns
+        the status and the sobol index of each row.
+        '''
+        self.report.count(rows_in=len(city_rows))
+        if known_rows or retired_rows:
+            statuses, sobol_idxs = self._match_sobol_keys(city_rows,
+                                                          known_rows,
+                                                          retired_rows)
+        else:
+            # The first build of a city, every row is new
+            statuses = ['added'] * len(city_rows)
+            sobol_idxs = [-1] * len(city_rows)
+
+        sobol_idxs = np.array(sobol_idxs, dtype=np.int64)
+        new_rows = sobol_idxs < 0
+        sobol_idxs[new_rows] = randint_array(0, max_idx-1, new_rows.sum())
+        return statuses, sobol_idxs.tolist()
+
+    def _match_sobol_keys(self, city_rows, known_rows, retired_rows):
+        '''
+        Look up every row in the dicts of known and retired rows,
+        popping the ones which are found.  Returns the status of each
+        row and its existing sobol index, or -1 for rows which need a
+        random index.
+        '''
+        statuses = []
+        sobol_idxs = []
+        for (bssid, tile_x, tile_y, zlevel) in city_rows:
+            known = known_rows.pop(bssid, None)
+            if known is None:
+                status = 'added'
+                known = retired_rows.pop(bssid, None)
+            elif known[1:4] != [str(tile_x), str(tile_y), str(zlevel)]:
+                status = 'moved'
+            else:
+                status = 'unchanged'
+            statuses.append(status)
+            sobol_idxs.append(-1 if known is None else int(known[4]))
+        return statuses, sobol_idxs
+
+    def _sobol_key_fnames(self):
+        return [self.bssid_sobol_idx_csv, self.bssid_sobol_retired_csv]
+
+    def _load_sobol_keys(self, fname):
+        '''
+        Load a file of sobol index rows into a dict of BSSID -> CSV row
+        '''
+        known_rows = {}
+        if isfile(fname):
+            with open(fname) as file_in:
+                for row in csv.reader(file_in):
+                    known_rows[row[0]] = row
+        return known_rows
+
+    def _save_sobol_keys(self, fname, sobol_rows):
+        with open(fname, 'w') as file_out:
+            csv.writer(file_out).writerows(sobol_rows)
+
+    def _retire_sobol_keys(self, retired_rows, removed_rows):
+        '''
+        Write the rows of every BSSID which has dropped out of the
+        input to bssid_sobol_retired.csv
+        '''
+        self._save_sobol_keys(self.bssid_sobol_retired_csv,
+                              retired_rows.values() + removed_rows)
+
+    def _fused_obfuscate(self, sobol_rows, ordered_city_tiles, sobol_seq):
+        '''
+        Stage 3: yield (hashed bssid, tile ids) records ready to be
+        pushed into the record trie.
+        '''
+        num_tiles = ordered_city_tiles.size()
+        sobol_rows = iter(sobol_rows)
+        while True:
+            rows = list(islice(sobol_rows, self.chunk_rows))
+            if not rows:
+                break
+
+            orig_tile_idxs = ordered_city_tiles.resolve_array([r[1] for r in rows],
+                                                              [r[2] for r in rows])
+            sobol_keys = [r[4] for r in rows]
+            tile_ids = rebase_tiles_array(orig_tile_idxs,
+                                          sobol_keys,
+                                          sobol_seq,
+                                          num_tiles,
+                                          self.dupe_num)
+            for row, row_tile_ids in izip(rows, tile_ids.tolist()):
+                yield hash_bssid(row[0], self.key_scheme), row_tile_ids
+
+    def _audit_obfuscated(self, records, ordered_city_tiles):
+        '''
+        Pass obfuscated records through unchanged while writing them
+        out to obfuscated.csv.
+        '''
+        with open(self.bssid_sobol_obfuscated_csv, 'w') as fout:
+            writer = csv.writer(fout)
+            for hashed_bssid, tile_ids in records:
+                hex_bssid = hex_key(hashed_bssid, self.key_scheme)
+                norm_tile_xs, norm_tile_ys, norm_zlevels = \
+                    ordered_city_tiles.coords_array(tile_ids)
+                writer.writerows(izip(repeat(hex_bssid),
+                                      norm_tile_xs.tolist(),
+                                      norm_tile_ys.tolist(),
+                                      norm_zlevels.tolist()))
+                yield hashed_bssid, tile_ids
+
+    def generate_recordtrie_fused(self):
+        '''
+        Stage 4 consumes the obfuscated records directly to build the
+        trie.
+
+        Stages 2 to 4 are interleaved, so they are reported as a
+        single encode stage.
+        '''
+        self._start_report('fused')
+        with self.report.stage('city_tiles', [self.incity_tiles]):
+            city_rows, ordered_city_tiles = self._fused_city_tiles()
+
+        outputs = (self._sobol_key_fnames() +
+                   [self.bssid_sobol_obfuscated_csv] +
+                   self._trie_fnames())
+        with self.report.stage('encode', outputs):
+            sobol_seq = self._get_sobol_seq()
+            sobol_rows = self._assign_sobol_keys(city_rows, len(sobol_seq))[0]
+            records = self._fused_obfuscate(sobol_rows,
+                                            ordered_city_tiles,
+                                            sobol_seq)
+            if self.audit:
+                records = self._audit_obfuscated(records, ordered_city_tiles)
+            self._save_trie(records)
+        self._finish_report()
+
+    def generate_recordtrie_delta(self):
+        '''
+        Rebuild the record trie by only re-encoding the BSSIDs which
+        changed since the last build.
+
+        The previous build's state is bssid_sobol_idx.csv, the ordered
+        city tile list and the record trie itself.  bssid_sobol_idx.csv
+        holds exactly the rows of the last build, so each BSSID in the
+        new input is classified by comparing its row with that file :
+
+            * added - not in bssid_sobol_idx.csv
+            * moved - the BSSID now sits in a different tile
+            * unchanged - same tile as last time
+            * removed - in bssid_sobol_idx.csv but not in the new input
+
+        Only added and moved BSSIDs are hashed and rebased onto the
+        sobol sequence again, keeping their existing sobol index when
+        they have one.  Unchanged BSSIDs copy their records out of the
+        previous trie.
+
+        Tile ids are only stable while the city keeps the same tile
+        list.  The previous tile list is kept as is, so tiles which
+        have lost all their BSSIDs still take part in the obfuscation.
+        If the new input has BSSIDs in tiles which were not part of
+        the previous city, we fall back to a full fused build.
+
+        If the previous trie doesn't hold exactly the unchanged, moved
+        and removed BSSIDs, it is out of step with bssid_sobol_idx.csv
+        and we fall back to a full fused build as well.
+
+        Returns a dict with the number of BSSIDs in each class, or None
+        if a full build was run instead.
+        '''
+        if not (isfile(self.output_trie_fname) and
+                isfile(self.bssid_sobol_idx_csv) and
+                self._has_sobol_seq() and
+                isfile(self.ordered_city_csv)):
+            print "No previous build state found. Running a full build."
+            self.generate_recordtrie_fused()
+            return None
+
+        self._start_report('delta')
+        with self.report.stage('city_tiles', [self.incity_tiles]):
+            city_rows, tile_keys, tile_counts = self._read_city_rows()
+
+        city_fname = self.ordered_city_bin
+        if not isfile(city_fname):
+            city_fname = self.ordered_city_csv
+        ordered_city_tiles = OrderedCityTiles(load_fromdisk=True,
+                                              fname=city_fname)
+        try:
+            ordered_city_tiles.resolve_array(*unpack_tiles(tile_keys))
+        except KeyError as e:
+            print "New tile %s in the city. Running a full build." % (e.args[0],)
+            self.generate_recordtrie_fused()
+            return None
+        self._set_city_size(ordered_city_tiles.size())
+        self._city_tiles = ordered_city_tiles
+
+        prev_trie = trieformat.load_trie(self.output_trie_fname)
+        prev_header = prev_trie.header
+        prev_format = (prev_header['encoding'],
+                       prev_header['dupe_num'],
+                       prev_header['key_scheme'])
+        if prev_format != (self.trie_encoding, self.dupe_num, self.key_scheme):
+            print "Trie format has changed. Running a full build."
+            self.generate_recordtrie_fused()
+            return None
+
+        outputs = (self._sobol_key_fnames() +
+                   [self.bssid_sobol_obfuscated_csv] +
+                   self._trie_fnames())
+        with self.report.stage('encode', outputs):
+            counts = self._delta_encode(city_rows, ordered_city_tiles, prev_trie)
+        if counts is None:
+            print "Previous trie doesn't match the sobol index. Running a full build."
+            self.generate_recordtrie_fused()
+            return None
+        self.report.info['delta'] = counts
+        self._finish_report()
+        return counts
+
+    def _delta_encode(self, city_rows, ordered_city_tiles, prev_trie):
+        '''
+        Classify every BSSID against bssid_sobol_idx.csv, re-encode the
+        added and moved ones and write the new trie.  Returns the count
+        of each class, or None if the previous trie is out of step with
+        the index file.
+        '''
+        sobol_seq = self._get_sobol_seq()
+        sobol_rows, statuses, removed_rows = self._assign_sobol_keys(city_rows,
+                                                                     len(sobol_seq))
+        counts = {'added': 0, 'moved': 0, 'unchanged': 0}
+        for status in statuses:
+            counts[status] += 1
+
+        changed_rows = [row for (row, status) in izip(sobol_rows, statuses)
+                        if status != 'unchanged']
+        records = list(self._fused_obfuscate(changed_rows,
+                                             ordered_city_tiles,
+                                             sobol_seq))
+
+        # The previous records of moved and removed BSSIDs are dropped.
+        # items() decodes every record up front, so nothing is read
+        # from the mapped trie once the new one overwrites it.
+        stale_keys = set(key for (key, tile_ids) in records)
+        stale_keys.update(hash_bssid(row[0], self.key_scheme)
+                          for row in removed_rows)
+        records.extend((key, tile_ids) for (key, tile_ids) in prev_trie.items()
+                       if key not in stale_keys)
+        if len(records) - len(changed_rows) != counts['unchanged']:
+            return None
+
+        counts['removed'] = len(prev_trie) - counts['moved'] - counts['unchanged']
+        print ("Delta: %(added)d added, %(removed)d removed, "
+               "%(moved)d moved, %(unchanged)d unchanged" % counts)
+
+        if self.audit:
+            records = self._audit_obfuscated(records, ordered_city_tiles)
+        self._save_trie(records)
+        return counts
+
+    def _partition_rows(self, sobol_rows, num_partitions):
+        '''
+        Split (bssid, tile_x, tile_y, zoom_level, sobol_idx) rows into
+        at most num_partitions runs of consecutive rows, each passed
+        on as (bssids, tile_xs, tile_ys, sobol idxs) columns.
+        '''
+        size = max(1, -(-len(sobol_rows) // num_partitions))
+        for start in xrange(0, len(sobol_rows), size):
+            bssids, tile_xs, tile_ys, zlevels, sobol_keys = \
+                zip(*sobol_rows[start:start + size])
+            yield bssids, tile_xs, tile_ys, sobol_keys
+
+    def generate_recordtrie_parallel(self, workers=None):
+        '''
+        Run the fused pipeline with the obfuscation stage spread over a
+        pool of worker processes.
+
+        The city tiles and sobol keys are computed once up front so
+        that every worker sees the same tile ordering and sobol
+        sequence.  The rows are then split into partitions, and the
+        workers hash the BSSIDs, resolve their tiles and rebase them.
+        The trie is byte for byte the same as the one a serial run
+        would produce.
+        '''
+        if workers is None:
+            workers = multiprocessing.cpu_count()
+
+        self._start_report('parallel')
+        with self.report.stage('city_tiles', [self.incity_tiles]):
+            city_rows, ordered_city_tiles = self._fused_city_tiles()
+
+        with self.report.stage('sobol_keys', self._sobol_key_fnames()) as stage:
+            sobol_seq = self._get_sobol_seq()
+            sobol_rows = self._assign_sobol_keys(city_rows, len(sobol_seq))[0]
+            stage.rows_out = len(sobol_rows)
+
+        outputs = [self.bssid_sobol_obfuscated_csv] + self._trie_fnames()
+        with self.report.stage('obfuscate', outputs) as stage:
+            stage.rows_in = len(sobol_rows)
+            # Use more partitions than workers so that a slow one
+            # doesn't hold up the whole pool.
+            partitions = self._partition_rows(sobol_rows, workers * 4)
+            pool = multiprocessing.Pool(workers,
+                                        _init_worker,
+                                        (self.ordered_city_bin,
+                                         self.sobol_seq_bin,
+                                         self.dupe_num,
+                                         self.key_scheme))
+            try:
+                records = chain.from_iterable(
+                    _partition_records(p)
+                    for p in pool.imap(_obfuscate_partition, partitions))
+                if self.audit:
+                    records = self._audit_obfuscated(records, ordered_city_tiles)
+                self._save_trie(records)
+            finally:
+                pool.close()
+                pool.join()
+        self._finish_report()
 
-    """
-    TODO: we need to be able to setup
-    links to varying input files for each city.
 
-    In particular, we need to set the :
+def main():
 
-    * city name
-    * bssid_sobol_idx.csv file needs to be namespaced to just the city
+    """
+    Build the record trie for a single city.
 
+    Use batch.py to build many cities, each with their own input,
+    seed and output directory.
     """
-    pl = PrivateLocations()
-    pl.generate_recordtrie()
+    parser = argparse.ArgumentParser(description='Generate a record trie')
+    parser.add_argument('--input',
+                        default='inputs/input.csv',
+                        help='CSV file of (bssid, lat, lon)')
+    parser.add_argument('--raw-input',
+                        default=None,
+                        help='Clean this raw dump into --input before building')
+    parser.add_argument('--raw-format',
+                        choices=sorted(etl.RAW_FORMATS),
+                        default='tsv',
+                        help='Layout of --raw-input')
+    parser.add_argument('--geojson',
+                        default=None,
+                        help='Only encode the points inside this city polygon')
+    parser.add_argument('--output-dir',
+                        default='outputs',
+                        help='Directory for the trie and sobol state')
+    parser.add_argument('--seed',
+                        type=int,
+                        default=123344129,
+                        help='Sobol seed for the city')
+    parser.add_argument('--fused',
+                        action='store_true',
+                        help='Stream every stage straight into the trie')
+    parser.add_argument('--audit',
+                        action='store_true',
+                        help='Write intermediate CSV files in fused mode')
+    parser.add_argument('--delta',
+                        action='store_true',
+                        help='Only re-encode BSSIDs changed since the last build')
+    parser.add_argument('--workers',
+                        type=int,
+                        default=0,
+                        help='Run the fused pipeline over N processes')
+    parser.add_argument('--tile-fit',
+                        choices=tilefit.FIT_MODES,
+                        default='mixed',
+                        help='How to fit a city with more than 64k tiles')
+    parser.add_argument('--trie-encoding',
+                        choices=trieformat.ENCODINGS,
+                        default='u16',
+                        help='How tile ids are stored in the record trie')
+    parser.add_argument('--key-scheme',
+                        choices=trieformat.KEY_SCHEMES,
+                        default='binary',
+                        help='How hashed BSSIDs are stored as trie keys')
+    parser.add_argument('--shards',
+                        type=int,
+                        default=1,
+                        help='Split the record trie into N shards')
+    parser.add_argument('--report',
+                        default=None,
+                        help='Write the JSON build report here '
+                             '(default: build_report.json in the output dir)')
+    parser.add_argument('--profile-dir',
+                        default=None,
+                        help='Dump a cProfile of each stage into this directory')
+    args = parser.parse_args()
+
+    if args.raw_input:
+        stats = etl.clean(args.raw_input, args.input, raw_format=args.raw_format)
+        print ("Cleaned %s: %d rows in, %d rows out, %d skipped, %d duplicates" %
+               (args.raw_input, stats.rows_in, stats.rows_out,
+                stats.skipped, stats.duplicates))
+
+    bssid_input = args.input
+    if args.geojson:
+        # Points outside the city are kept in pnpoly_outside.csv
+        bssid_input = join(args.output_dir, pnpoly.INSIDE_CSV)
+        num_inside, num_outside = pnpoly.split_points(
+            pnpoly.PolygonIndex.from_geojson(args.geojson),
+            args.input,
+            bssid_input,
+            join(args.output_dir, pnpoly.OUTSIDE_CSV))
+        print "%d points inside %s, %d outside" % (num_inside,
+                                                   args.geojson,
+                                                   num_outside)
+
+    pl = PrivateLocations(audit=args.audit,
+                          bssid_input=bssid_input,
+                          output_dir=args.output_dir,
+                          sobol_seed=args.seed,
+                          ordered_city_csv=join(args.output_dir, 'ordered_city.csv'))
+    pl.tile_fit = args.tile_fit
+    pl.trie_encoding = args.trie_encoding
+    pl.key_scheme = args.key_scheme
+    pl.num_shards = args.shards
+    if args.report:
+        pl.report_fname = args.report
+    pl.profile_dir = args.profile_dir
+    if args.delta:
+        pl.generate_recordtrie_delta()
+    elif args.workers:
+        pl.generate_recordtrie_parallel(args.workers)
+    elif args.fused:
+        pl.generate_recordtrie_fused()
+    else:
+        pl.generate_recordtrie()
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,336 @@
+#!/usr/bin/env python
+
+"""
+Clean a raw wifi dump into the input CSV of the encoder.
+
+The output is a CSV file with no header row.  Each row is
+(bssid, lat, lon) and every BSSID appears once.  BSSIDs are 12 lower
+case hex characters with no separators :
+
+    002351bfaa49,43.5813927142857,-79.6150485714286
+
+Raw dumps are read by a format from RAW_FORMATS :
+
+    tsv           tab separated (bssid, lat, lon, ...).  Extra columns
+                  are ignored.
+    tsv_accuracy  tab separated (bssid, lat, lon, accuracy in meters).
+                  Rows without a valid accuracy are skipped.
+    csv           comma separated (bssid, lat, lon, ...)
+
+A format is a (delimiter, parse) pair.  parse takes one raw row and
+returns (bssid, lat, lon) or None if the row should be skipped, so new
+formats only need a parse function.  Input files ending in .gz are
+read with gzip.
+
+The first row seen for a BSSID is kept.  Deduplication never holds
+more than buffer_rows rows in memory.  An input which fits in the
+buffer is deduplicated in memory and keeps its order.  Larger inputs
+are deduplicated in one of two ways :
+
+    partition  spill rows into FANOUT files by a hash of the BSSID,
+               then deduplicate each file in memory.  Files which are
+               still too big are partitioned again with a different
+               hash.  Rows come out grouped by partition.
+    sort       an external merge sort on the BSSID.  Rows come out
+               sorted by BSSID.
+
+Skipped rows and duplicates are counted, not printed.
+"""
+
+# Standard library
+import argparse
+import csv
+import gzip
+import hashlib
+import heapq
+import os
+import shutil
+import tempfile
+from itertools import groupby, islice
+from operator import itemgetter
+
+DEDUPE_MODES = ('partition', 'sort')
+
+# Rows held in memory while deduplicating
+BUFFER_ROWS = 1000000
+
+# Rows parsed at a time
+CHUNK_ROWS = 100000
+
+# Files per round of hash partitioning
+FANOUT = 16
+
+# Rounds of hash partitioning before giving up.  Only reached when a
+# single BSSID has more than buffer_rows rows.
+MAX_DEPTH = 4
+
+
+def parse_tsv(row):
+    '''
+    Parse (bssid, lat, lon, ...).  Returns (bssid, lat, lon) with the
+    co-ordinates as they were written, or None for an invalid row.
+    '''
+    if len(row) < 3:
+        return None
+    bssid = row[0].strip().lower()
+    if len(bssid) != 12:
+        return None
+    try:
+        int(bssid, 16)
+        lat = float(row[1])
+        lon = float(row[2])
+    except ValueError:
+        return None
+    if not (-90 <= lat <= 90 and -180 <= lon <= 180):
+        return None
+    return bssid, row[1].strip(), row[2].strip()
+
+
+def parse_tsv_accuracy(row):
+    '''
+    Parse (bssid, lat, lon, accuracy in meters)
+    '''
+    if len(row) != 4:
+        return None
+    try:
+        float(row[3])
+    except ValueError:
+        return None
+    return parse_tsv(row)
+
+
+RAW_FORMATS = {'tsv': ('\t', parse_tsv),
+               'tsv_accuracy': ('\t', parse_tsv_accuracy),
+               'csv': (',', parse_tsv)}
+
+
+class ETLStats(object):
+    def __init__(self):
+        self.rows_in = 0
+        self.rows_out = 0
+        self.skipped = 0
+        self.duplicates = 0
+        self.spilled = 0
+
+    def as_dict(self):
+        return {'rows_in': self.rows_in,
+                'rows_out': self.rows_out,
+                'skipped': self.skipped,
+                'duplicates': self.duplicates,
+                'spilled': self.spilled}
+
+
+def open_raw(fname):
+    if fname.endswith('.gz'):
+        return gzip.open(fname, 'rb')
+    return open(fname, 'rb')
+
+
+def _skip_malformed(reader, stats):
+    while True:
+        try:
+            row = next(reader)
+        except StopIteration:
+            return
+        except csv.Error:
+            # The reader carries on from the next line
+            stats.rows_in += 1
+            stats.skipped += 1
+            continue
+        yield row
+
+
+def iter_raw_chunks(fin, raw_format='tsv', chunk_rows=CHUNK_ROWS, stats=None):
+    '''
+    Yield lists of up to chunk_rows parsed (bssid, lat, lon) rows
+    '''
+    if raw_format not in RAW_FORMATS:
+        raise RuntimeError("Invalid raw format: %s" % raw_format)
+    delimiter, parse = RAW_FORMATS[raw_format]
+    if stats is None:
+        stats = ETLStats()
+
+    reader = _skip_malformed(csv.reader(fin, delimiter=delimiter), stats)
+    while True:
+        raw_rows = list(islice(reader, chunk_rows))
+        if not raw_rows:
+            break
+        stats.rows_in += len(raw_rows)
+        rows = [r for r in (parse(row) for row in raw_rows) if r is not None]
+        stats.skipped += len(raw_rows) - len(rows)
+        yield rows
+
+
+def _dedupe_in_memory(rows, writer, stats):
+    seen = set()
+    for row in rows:
+        if row[0] in seen:
+            stats.duplicates += 1
+            continue
+        seen.add(row[0])
+        writer.writerow(row)
+        stats.rows_out += 1
+
+
+def _partition_of(bssid, depth, fanout):
+    digest = hashlib.md5('%d:%s' % (depth, bssid)).digest()
+    return ord(digest[0]) % fanout
+
+
+def _dedupe_partitioned(rows, writer, stats, tmp_dir, buffer_rows, fanout, depth=0):
+    '''
+    Spill rows into fanout files and deduplicate each of them
+    '''
+    fnames = [os.path.join(tmp_dir, 'part_%d_%03d.csv' % (depth, i))
+              for i in range(fanout)]
+    counts = [0] * fanout
+    fouts = [open(f, 'wb') for f in fnames]
+    try:
+        writers = [csv.writer(f) for f in fouts]
+        for row in rows:
+            idx = _partition_of(row[0], depth, fanout)
+            writers[idx].writerow(row)
+            counts[idx] += 1
+    finally:
+        for fout in fouts:
+            fout.close()
+    stats.spilled += sum(counts)
+
+    for fname, count in zip(fnames, counts):
+        with open(fname, 'rb') as fin:
+            part_rows = csv.reader(fin)
+            if count <= buffer_rows or depth + 1 >= MAX_DEPTH:
+                _dedupe_in_memory(part_rows, writer, stats)
+            else:
+                _dedupe_partitioned(part_rows, writer, stats, tmp_dir,
+                                    buffer_rows, fanout, depth + 1)
+        os.unlink(fname)
+
+
+def _dedupe_sorted(rows, writer, stats, tmp_dir, buffer_rows):
+    '''
+    Write sorted runs of buffer_rows rows, then merge them keeping the
+    first row of each BSSID.
+    '''
+    run_fnames = []
+    seq = 0
+    rows = iter(rows)
+    while True:
+        run = list(islice(rows, buffer_rows))
+        if not run:
+            break
+        # The input sequence number keeps the first row of a BSSID
+        # ahead of its duplicates once the runs are merged.
+        run = [(bssid, seq + i, lat, lon)
+               for i, (bssid, lat, lon) in enumerate(run)]
+        seq += len(run)
+        run.sort()
+        fname = os.path.join(tmp_dir, 'run_%05d.csv' % len(run_fnames))
+        with open(fname, 'wb') as fout:
+            csv.writer(fout).writerows(run)
+        stats.spilled += len(run)
+        run_fnames.append(fname)
+
+    fins = [open(f, 'rb') for f in run_fnames]
+    try:
+        runs = [((bssid, int(seq), lat, lon) for (bssid, seq, lat, lon) in csv.reader(fin))
+                for fin in fins]
+        for bssid, group in groupby(heapq.merge(*runs), key=itemgetter(0)):
+            first = next(group)
+            writer.writerow((bssid, first[2], first[3]))
+            stats.rows_out += 1
+            stats.duplicates += sum(1 for _ in group)
+    finally:
+        for fin in fins:
+            fin.close()
+
+
+def clean(raw_fname,
+          output_fname,
+          raw_format='tsv',
+          dedupe='partition',
+          buffer_rows=BUFFER_ROWS,
+          chunk_rows=CHUNK_ROWS,
+          fanout=FANOUT,
+          tmp_dir=None):
+    '''
+    Clean raw_fname into output_fname and return the ETLStats
+    '''
+    if dedupe not in DEDUPE_MODES:
+        raise RuntimeError("Invalid dedupe mode: %s" % dedupe)
+
+    stats = ETLStats()
+    with open_raw(raw_fname) as fin:
+        chunks = iter_raw_chunks(fin, raw_format, chunk_rows, stats)
+
+        # Read up to one buffer of rows.  If that is the whole input
+        # there is no need to spill anything.
+        head = []
+        for chunk in chunks:
+            head.extend(chunk)
+            if len(head) > buffer_rows:
+                break
+
+        def _rows():
+            for row in head:
+                yield row
+            for chunk in chunks:
+                for row in chunk:
+                    yield row
+
+        with open(output_fname, 'wb') as fout:
+            writer = csv.writer(fout)
+            if len(head) <= buffer_rows:
+                _dedupe_in_memory(head, writer, stats)
+                return stats
+
+            work_dir = tempfile.mkdtemp(dir=tmp_dir)
+            try:
+                if dedupe == 'sort':
+                    _dedupe_sorted(_rows(), writer, stats, work_dir, buffer_rows)
+                else:
+                    _dedupe_partitioned(_rows(), writer, stats, work_dir,
+                                        buffer_rows, fanout)
+            finally:
+                shutil.rmtree(work_dir)
+    return stats
+
+
+def main(default_input=None, default_output='input.csv', default_format='tsv'):
+    parser = argparse.ArgumentParser(description='Clean a raw wifi dump '
+                                                 'into the encoder input CSV')
+    parser.add_argument('--input',
+                        default=default_input,
+                        required=default_input is None,
+                        help='Raw input file, optionally gzipped')
+    parser.add_argument('--output',
+                        default=default_output,
+                        help='Cleaned (bssid, lat, lon) CSV file')
+    parser.add_argument('--format',
+                        choices=sorted(RAW_FORMATS),
+                        default=default_format,
+                        help='Layout of the raw input')
+    parser.add_argument('--dedupe',
+                        choices=DEDUPE_MODES,
+                        default='partition',
+                        help='How to deduplicate inputs larger than the buffer')
+    parser.add_argument('--buffer-rows',
+                        type=int,
+                        default=BUFFER_ROWS,
+                        help='Most rows held in memory while deduplicating')
+    parser.add_argument('--tmp-dir',
+                        default=None,
+                        help='Directory for spilled rows')
+    args = parser.parse_args()
+
+    stats = clean(args.input,
+                  args.output,
+                  raw_format=args.format,
+                  dedupe=args.dedupe,
+                  buffer_rows=args.buffer_rows,
+                  tmp_dir=args.tmp_dir)
+    print ("%d rows in, %d rows out, %d skipped, %d duplicates" %
+           (stats.rows_in, stats.rows_out, stats.skipped, stats.duplicates))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,248 @@
+#!/usr/bin/env python
+
+"""
+Split input points by a city polygon.
+
+The polygon comes from geojson.load_geojson as a list of (lat, lon)
+vertices.  Points are tested with the PNPoly crossing rule : a ray cast
+from the point towards increasing longitude crosses the polygon
+boundary an odd number of times if the point is inside.
+
+Only edges which span the latitude of a point can be crossed, so the
+edges are indexed by latitude band.  The bounding box of the polygon
+is cut into horizontal bands, and each band lists the edges which
+overlap it.  Points are grouped by band and each group is tested
+against only the edges of its band, as one numpy operation.
+
+    python ./pnpoly.py --geojson toronto.geojson --input inputs/input.csv
+
+writes pnpoly.csv and pnpoly_outside.csv with the (bssid, lat, lon)
+rows inside and outside the polygon, and pnpoly_tiles.csv with the
+(tile_x, tile_y, zoom_level) of every tile whose centre is inside the
+polygon.
+"""
+
+# Standard library
+import argparse
+import csv
+from itertools import islice
+from os.path import join
+
+# PyPI
+import numpy as np
+
+# Custom modules
+from geojson import load_geojson
+from citytiles import ZOOM_LEVEL
+from slippytiles import deg2num, num2deg_array
+
+INSIDE_CSV = 'pnpoly.csv'
+OUTSIDE_CSV = 'pnpoly_outside.csv'
+TILES_CSV = 'pnpoly_tiles.csv'
+
+# Rows read from the input at a time
+CHUNK_ROWS = 500000
+
+# Largest (points x edges) array built in one step
+BATCH_CELLS = 4000000
+
+MAX_BANDS = 4096
+
+
+class PolygonIndex(object):
+    '''
+    A polygon with its edges indexed by latitude band
+    '''
+    def __init__(self, poly_pts, num_bands=None):
+        pts = np.asarray(poly_pts, dtype=np.float64)
+        if len(pts) < 3:
+            raise RuntimeError("A polygon needs at least 3 points")
+        lats = pts[:, 0]
+        lons = pts[:, 1]
+        self.min_lat, self.max_lat = lats.min(), lats.max()
+        self.min_lon, self.max_lon = lons.min(), lons.max()
+
+        # Edge i runs from vertex i to vertex i + 1.  GeoJSON rings
+        # repeat the first vertex at the end, but close the ring here
+        # in case the last vertex was left out.
+        lat0, lon0 = lats, lons
+        lat1, lon1 = np.roll(lats, -1), np.roll(lons, -1)
+
+        # Horizontal edges are never crossed by a horizontal ray
+        keep = lat0 != lat1
+        self._lat0, self._lon0 = lat0[keep], lon0[keep]
+        self._lat1, self._lon1 = lat1[keep], lon1[keep]
+        # Longitude where the edge crosses a latitude is
+        # lon0 + (lat - lat0) * slope
+        self._slope = (self._lon1 - self._lon0) / (self._lat1 - self._lat0)
+
+        num_edges = len(self._lat0)
+        if num_bands is None:
+            num_bands = min(max(num_edges, 1), MAX_BANDS)
+        self.num_bands = num_bands
+        self._band_height = (self.max_lat - self.min_lat) / num_bands or 1.0
+
+        # Each band lists the edges which overlap it, stored as one
+        # array of edge ids with an offset for the start of each band.
+        first = self._band_of(np.minimum(self._lat0, self._lat1))
+        last = self._band_of(np.maximum(self._lat0, self._lat1))
+        spans = last - first + 1
+        edge_ids = np.repeat(np.arange(num_edges), spans)
+        starts = np.repeat(np.cumsum(spans) - spans, spans)
+        bands = np.repeat(first, spans) + (np.arange(len(edge_ids)) - starts)
+        order = np.argsort(bands, kind='mergesort')
+        self._band_edges = edge_ids[order]
+        self._band_offsets = np.zeros(num_bands + 1, dtype=np.int64)
+        self._band_offsets[1:] = np.cumsum(np.bincount(bands, minlength=num_bands))
+
+    @classmethod
+    def from_geojson(cls, fname, num_bands=None):
+        return cls(load_geojson(fname), num_bands)
+
+    def _band_of(self, lats):
+        bands = ((lats - self.min_lat) / self._band_height).astype(np.int64)
+        return np.clip(bands, 0, self.num_bands - 1)
+
+    def bbox(self):
+        '''
+        (min_lat, min_lon, max_lat, max_lon) of the polygon
+        '''
+        return self.min_lat, self.min_lon, self.max_lat, self.max_lon
+
+    def contains(self, lats, lons):
+        '''
+        Return a boolean array which is True for each point inside
+        the polygon.
+        '''
+        lats = np.asarray(lats, dtype=np.float64)
+        lons = np.asarray(lons, dtype=np.float64)
+        inside = np.zeros(len(lats), dtype=bool)
+
+        candidates = np.flatnonzero((lats >= self.min_lat) & (lats <= self.max_lat) &
+                                    (lons >= self.min_lon) & (lons <= self.max_lon))
+        if not len(candidates):
+            return inside
+
+        bands = self._band_of(lats[candidates])
+        order = np.argsort(bands, kind='mergesort')
+        candidates = candidates[order]
+        bands = bands[order]
+        bounds = np.searchsorted(bands, np.arange(self.num_bands + 1))
+
+        for band in np.flatnonzero(np.diff(bounds)):
+            edges = self._band_edges[self._band_offsets[band]:self._band_offsets[band + 1]]
+            if not len(edges):
+                continue
+            lat0 = self._lat0[edges]
+            lat1 = self._lat1[edges]
+            lon0 = self._lon0[edges]
+            slope = self._slope[edges]
+
+            band_pts = candidates[bounds[band]:bounds[band + 1]]
+            step = max(1, BATCH_CELLS // len(edges))
+            for offset in xrange(0, len(band_pts), step):
+                pts = band_pts[offset:offset + step]
+                py = lats[pts][:, np.newaxis]
+                px = lons[pts][:, np.newaxis]
+                crosses = (((lat0 > py) != (lat1 > py)) &
+                           (px < lon0 + (py - lat0) * slope))
+                inside[pts] = crosses.sum(axis=1) % 2 == 1
+        return inside
+
+    def tiles(self, zoom=ZOOM_LEVEL):
+        '''
+        Return arrays of (tile_x, tile_y) for every tile in the
+        bounding box whose centre is inside the polygon.
+        '''
+        min_x, min_y = deg2num(self.max_lat, self.min_lon, zoom)
+        max_x, max_y = deg2num(self.min_lat, self.max_lon, zoom)
+        xs = np.arange(min_x, max_x + 1, dtype=np.int64)
+
+        # Test the bounding box one or more rows of tiles at a time
+        rows_per_batch = max(1, CHUNK_ROWS // len(xs))
+        tile_xs = []
+        tile_ys = []
+        for y in xrange(min_y, max_y + 1, rows_per_batch):
+            ys = np.arange(y, min(y + rows_per_batch, max_y + 1), dtype=np.int64)
+            grid_xs = np.tile(xs, len(ys))
+            grid_ys = np.repeat(ys, len(xs))
+            lats, lons = num2deg_array(grid_xs + 0.5, grid_ys + 0.5, zoom)
+            inside = self.contains(lats, lons)
+            tile_xs.append(grid_xs[inside])
+            tile_ys.append(grid_ys[inside])
+        return np.concatenate(tile_xs), np.concatenate(tile_ys)
+
+
+def split_points(index, input_fname, inside_fname, outside_fname,
+                 chunk_rows=CHUNK_ROWS):
+    '''
+    Copy the (bssid, lat, lon) rows of input_fname into inside_fname
+    or outside_fname.  Returns (rows inside, rows outside).
+    '''
+    num_inside = num_outside = 0
+    with open(input_fname) as fin, \
+            open(inside_fname, 'w') as inside_out, \
+            open(outside_fname, 'w') as outside_out:
+        reader = csv.reader(fin)
+        inside_writer = csv.writer(inside_out)
+        outside_writer = csv.writer(outside_out)
+        while True:
+            rows = list(islice(reader, chunk_rows))
+            if not rows:
+                break
+            columns = zip(*rows)
+            inside = index.contains(np.array(columns[1], dtype=np.float64),
+                                    np.array(columns[2], dtype=np.float64))
+            for row, is_inside in zip(rows, inside.tolist()):
+                if is_inside:
+                    inside_writer.writerow(row)
+                else:
+                    outside_writer.writerow(row)
+            chunk_inside = int(inside.sum())
+            num_inside += chunk_inside
+            num_outside += len(rows) - chunk_inside
+    return num_inside, num_outside
+
+
+def write_tiles(index, fname, zoom=ZOOM_LEVEL):
+    '''
+    Write the (tile_x, tile_y, zoom_level) of every tile inside the
+    polygon.  Returns the number of tiles.
+    '''
+    tile_xs, tile_ys = index.tiles(zoom)
+    with open(fname, 'w') as fout:
+        writer = csv.writer(fout)
+        for x, y in zip(tile_xs.tolist(), tile_ys.tolist()):
+            writer.writerow((x, y, zoom))
+    return len(tile_xs)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Split input points by '
+                                                 'a city polygon')
+    parser.add_argument('--geojson',
+                        required=True,
+                        help='GeoJSON file with the city polygon')
+    parser.add_argument('--input',
+                        default='inputs/input.csv',
+                        help='CSV file of (bssid, lat, lon)')
+    parser.add_argument('--output-dir',
+                        default='outputs',
+                        help='Directory for the inside, outside and tile files')
+    parser.add_argument('--no-tiles',
+                        action='store_true',
+                        help="Don't write the tiles inside the polygon")
+    args = parser.parse_args()
+
+    index = PolygonIndex.from_geojson(args.geojson)
+    num_inside, num_outside = split_points(index,
+                                           args.input,
+                                           join(args.output_dir, INSIDE_CSV),
+                                           join(args.output_dir, OUTSIDE_CSV))
+    print "%d points inside, %d points outside" % (num_inside, num_outside)
+    if not args.no_tiles:
+        num_tiles = write_tiles(index, join(args.output_dir, TILES_CSV))
+        print "%d tiles inside" % num_tiles
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,555 @@
+"""
+Check that the different ways of running the encoder all produce the
+same record trie for a small synthetic city.
+"""
+
+import csv
+import os
+import random
+import shutil
+import tempfile
+from os.path import isfile
+
+from encoder import PrivateLocations
+
+_orig_cwd = None
+_tmpdir = None
+
+
+def setup():
+    global _orig_cwd, _tmpdir
+    _orig_cwd = os.getcwd()
+    _tmpdir = tempfile.mkdtemp()
+
+    # citytiles.ORDERED_CITY_CSV is relative to the city directory
+    for dirname in ('city/inputs', 'city/outputs', 'outputs'):
+        os.makedirs(os.path.join(_tmpdir, dirname))
+    os.chdir(os.path.join(_tmpdir, 'city'))
+
+    rand = random.Random(1)
+    with open('inputs/input.csv', 'w') as fout:
+        writer = csv.writer(fout)
+        for i in range(2000):
+            writer.writerow(('%012x' % rand.getrandbits(48),
+                             43.6 + rand.random() * 0.02,
+                             -79.4 + rand.random() * 0.02))
+
+
+def teardown():
+    os.chdir(_orig_cwd)
+    shutil.rmtree(_tmpdir)
+
+
+def _build(method, *args, **kwargs):
+    pl = PrivateLocations(**kwargs)
+    getattr(pl, method)(*args)
+    with open(pl.output_trie_fname, 'rb') as fin:
+        trie_bytes = fin.read()
+
+    # Only keep the persistent sobol state between builds
+    for fname in (pl.incity_tiles,
+                  pl.bssid_sobol_obfuscated_csv,
+                  pl.output_trie_fname):
+        if os.path.isfile(fname):
+            os.remove(fname)
+    return trie_bytes
+
+
+def test_fused_matches_staged():
+    staged = _build('generate_recordtrie')
+    assert staged == _build('generate_recordtrie_fused')
+    assert staged == _build('generate_recordtrie_fused', audit=True)
+
+
+def test_parallel_matches_serial():
+    serial = _build('generate_recordtrie_fused')
+    assert serial == _build('generate_recordtrie_parallel', 3)
+
+
+def test_delta_matches_full_build():
+    with open('inputs/input.csv') as fin:
+        orig_rows = list(csv.reader(fin))
+
+    pl = PrivateLocations()
+    pl.generate_recordtrie_fused()
+    orig_idx = pl._load_sobol_keys(pl.bssid_sobol_idx_csv)
+
+    # Drop 20 BSSIDs, move 20 onto the location of other BSSIDs and
+    # add 20 new ones in tiles which are already part of the city.
+    rows = [list(r) for r in orig_rows[20:]]
+    for i in range(20):
+        rows[i][1:] = rows[100 + i][1:]
+    rand = random.Random(2)
+    for i in range(20):
+        rows.append(['%012x' % rand.getrandbits(48)] + rows[200 + i][1:])
+
+    try:
+        with open('inputs/input.csv', 'w') as fout:
+            csv.writer(fout).writerows(rows)
+
+        counts = PrivateLocations().generate_recordtrie_delta()
+        assert counts == {'added': 20,
+                          'removed': 20,
+                          'moved': 20,
+                          'unchanged': len(orig_rows) - 40}
+        delta = _build('generate_recordtrie_delta')
+        assert delta == _build('generate_recordtrie_fused')
+
+        # Dropped BSSIDs get their old sobol index back when they return
+        PrivateLocations().generate_recordtrie_fused()
+        with open('inputs/input.csv', 'w') as fout:
+            csv.writer(fout).writerows(orig_rows)
+        counts = PrivateLocations().generate_recordtrie_delta()
+        assert counts['added'] == 20
+        assert counts['removed'] == 20
+        known = pl._load_sobol_keys(pl.bssid_sobol_idx_csv)
+        for row in orig_rows[:20]:
+            assert known[row[0]][4] == orig_idx[row[0]][4]
+    finally:
+        with open('inputs/input.csv', 'w') as fout:
+            csv.writer(fout).writerows(orig_rows)
+
+
+def test_delta_move_back():
+    with open('inputs/input.csv') as fin:
+        orig_rows = list(csv.reader(fin))
+    moved_rows = [list(r) for r in orig_rows]
+    for i in range(20):
+        moved_rows[i][1:] = moved_rows[100 + i][1:]
+
+    PrivateLocations().generate_recordtrie_fused()
+    try:
+        with open('inputs/input.csv', 'w') as fout:
+            csv.writer(fout).writerows(moved_rows)
+        counts = PrivateLocations().generate_recordtrie_delta()
+        assert counts['moved'] == 20
+
+        # Moving them back must re-encode them again
+        with open('inputs/input.csv', 'w') as fout:
+            csv.writer(fout).writerows(orig_rows)
+        counts = PrivateLocations().generate_recordtrie_delta()
+        assert counts['moved'] == 20
+        assert counts['unchanged'] == len(orig_rows) - 20
+        assert _build('generate_recordtrie_delta') == _build('generate_recordtrie_fused')
+    finally:
+        with open('inputs/input.csv', 'w') as fout:
+            csv.writer(fout).writerows(orig_rows)
+
+
+def test_sobol_index_tracks_moves():
+    with open('inputs/input.csv') as fin:
+        orig_rows = list(csv.reader(fin))
+
+    pl = PrivateLocations()
+    pl.generate_recordtrie_fused()
+
+    # Move BSSIDs without adding any
+    rows = [list(r) for r in orig_rows]
+    for i in range(20):
+        rows[i][1:] = rows[100 + i][1:]
+    try:
+        with open('inputs/input.csv', 'w') as fout:
+            csv.writer(fout).writerows(rows)
+        pl = PrivateLocations()
+        pl.generate_recordtrie_fused()
+        known = pl._load_sobol_keys(pl.bssid_sobol_idx_csv)
+        for i in range(20):
+            assert known[rows[i][0]][1:3] == known[rows[100 + i][0]][1:3]
+    finally:
+        with open('inputs/input.csv', 'w') as fout:
+            csv.writer(fout).writerows(orig_rows)
+        PrivateLocations().generate_recordtrie_fused()
+
+
+def test_sobol_array_matches_i4_uniform():
+    import StringIO
+    import tiler
+
+    fout = StringIO.StringIO()
+    tiler._generate_stream(fout, 123344129, 1928)
+    expected = [int(line.split(',')[0])
+                for line in fout.getvalue().splitlines()]
+
+    assert tiler.sobol_array(123344129, 1928).tolist() == expected
+
+
+def test_batch_build():
+    import json
+    import batch
+
+    manifest = {'cities': []}
+    for name, seed in (('north', 1111), ('south', 2222)):
+        shutil.copy('inputs/input.csv', 'inputs/%s.csv' % name)
+        manifest['cities'].append({'name': name,
+                                   'input': 'inputs/%s.csv' % name,
+                                   'seed': seed,
+                                   'output_dir': 'batch/%s' % name})
+    with open('manifest.json', 'w') as fout:
+        json.dump(manifest, fout)
+
+    cities = batch.load_manifest('manifest.json')
+    results = batch.build_cities(cities, jobs=2)
+    assert results == {'north': ('built', None), 'south': ('built', None)}
+    for name in ('north', 'south'):
+        for fname in ('area.record_trie', 'ordered_city.csv', 'sobol_seq.bin'):
+            assert os.path.isfile(os.path.join('batch', name, fname))
+
+    # Only the city with a changed input gets rebuilt
+    with open('inputs/south.csv', 'a') as fout:
+        fout.write('0123456789ab,43.61,-79.39\n')
+    results = batch.build_cities(cities, jobs=2)
+    assert results == {'north': ('skipped', None), 'south': ('built', None)}
+
+
+def test_fitted_city():
+    from citytiles import OrderedCityTiles
+    from slippytiles import deg2num
+
+    os.makedirs('fitted')
+    kwargs = {'output_dir': 'fitted',
+              'ordered_city_csv': 'fitted/ordered_city.csv'}
+
+    tries = []
+    for method in ('generate_recordtrie', 'generate_recordtrie_fused'):
+        pl = PrivateLocations(**kwargs)
+        pl.max_tiles = 100
+        getattr(pl, method)()
+        with open(pl.output_trie_fname, 'rb') as fin:
+            tries.append(fin.read())
+    assert tries[0] == tries[1]
+
+    city_tiles = OrderedCityTiles(load_fromdisk=True,
+                                  fname='fitted/ordered_city.csv')
+    assert 0 < city_tiles.size() <= 100
+    assert min(city_tiles.zoom(i) for i in range(city_tiles.size())) < 18
+
+    # Every BSSID still lands in exactly one tile of the city
+    with open('inputs/input.csv') as fin:
+        for bssid, lat, lon in csv.reader(fin):
+            tile_key = deg2num(float(lat), float(lon), 18)
+            tile_id = city_tiles.resolve(tile_key)
+            tile_x, tile_y = city_tiles[tile_id]
+            shift = 18 - city_tiles.zoom(tile_id)
+            assert (tile_key[0] >> shift, tile_key[1] >> shift) == (tile_x, tile_y)
+
+
+def test_trie_encodings():
+    import trieformat
+
+    tries = {}
+    for encoding in trieformat.ENCODINGS:
+        pl = PrivateLocations()
+        pl.trie_encoding = encoding
+        pl.generate_recordtrie_fused()
+        tries[encoding] = trieformat.load_trie(pl.output_trie_fname, mmap=False)
+        assert tries[encoding].header['encoding'] == encoding
+        assert tries[encoding].header['dupe_num'] == pl.dupe_num
+
+    expected = dict(tries['i32'].items())
+    assert len(expected) == len(tries['u16']) == len(tries['sorted'])
+    assert dict(tries['u16'].items()) == expected
+    for key, tile_ids in tries['sorted'].items():
+        assert tile_ids == tuple(sorted(expected[key]))
+    assert trieformat.META_KEY not in tries['u16']
+
+
+def test_varints():
+    import trieformat
+
+    tile_ids = (65535, 0, 127, 128, 300)
+    data = trieformat.encode_varints(tile_ids)
+    assert trieformat.decode_varints(data) == tuple(sorted(tile_ids))
+
+
+def test_key_schemes():
+    import trieformat
+
+    tries = {}
+    for key_scheme in trieformat.KEY_SCHEMES:
+        pl = PrivateLocations()
+        pl.key_scheme = key_scheme
+        pl.generate_recordtrie_fused()
+        tries[key_scheme] = trieformat.load_trie(pl.output_trie_fname, mmap=False)
+
+    with open('inputs/input.csv') as fin:
+        bssids = [row[0] for row in csv.reader(fin)]
+    for bssid in bssids:
+        records = [trie.get(trie.bssid_key(bssid)) for trie in tries.values()]
+        assert records[0] is not None
+        assert records[0] == records[1]
+
+    key = tries['binary'].bssid_key(bssids[0])
+    assert len(key) == 7
+    assert trieformat.key_digest(key, 'binary') == trieformat.bssid_digest(bssids[0])
+
+
+def test_build_report():
+    import json
+
+    profile_dir = tempfile.mkdtemp()
+    try:
+        pl = PrivateLocations()
+        pl.profile_dir = profile_dir
+        pl.generate_recordtrie_fused()
+
+        with open(pl.report_fname) as fin:
+            report = json.load(fin)
+        assert report['mode'] == 'fused'
+        assert [s['name'] for s in report['stages']] == ['city_tiles', 'encode']
+        city_stage, encode_stage = report['stages']
+        assert city_stage['rows_in'] == 2000
+        assert city_stage['rows_out'] == report['info']['num_tiles']
+        assert encode_stage['rows_in'] == encode_stage['rows_out'] == 2000
+        assert encode_stage['bytes_written'] >= report['info']['trie_bytes'] > 0
+        assert report['peak_rss_kb'] > 0
+        assert sorted(os.listdir(profile_dir)) == ['01_city_tiles.prof',
+                                                   '02_encode.prof']
+    finally:
+        shutil.rmtree(profile_dir)
+
+
+def test_benchmark():
+    import bench
+
+    bench.generate_input('synthetic_a.csv', 1000, seed=3)
+    bench.generate_input('synthetic_b.csv', 1000, seed=3)
+    with open('synthetic_a.csv') as fin_a, open('synthetic_b.csv') as fin_b:
+        rows = list(csv.reader(fin_a))
+        assert rows == list(csv.reader(fin_b))
+    assert len(rows) == 1000
+    min_lat, min_lon, max_lat, max_lon = bench.DEFAULT_BBOX
+    for bssid, lat, lon in rows:
+        assert len(bssid) == 12
+        assert min_lat <= float(lat) <= max_lat
+        assert min_lon <= float(lon) <= max_lon
+
+    report = bench.run_benchmark('staged', 1000, work_dir='.')
+    results = {'staged/1000': bench.summarize(report)}
+    assert sorted(results['staged/1000']) == ['city_tiles', 'obfuscate',
+                                              'sobol_keys', 'trie']
+    assert bench.compare(results, results, 0.2) == []
+
+    slow = {'staged/1000': dict((name, {'rows_per_sec': stats['rows_per_sec'] * 2,
+                                        'peak_rss_kb': stats['peak_rss_kb']})
+                                for name, stats in results['staged/1000'].items())}
+    assert len(bench.compare(results, slow, 0.2)) == 4
+
+
+def test_sharded_trie():
+    import trieformat
+
+    for method in ('generate_recordtrie', 'generate_recordtrie_fused'):
+        with open('single.trie', 'wb') as fout:
+            fout.write(_build(method))
+        expected = dict(trieformat.load_trie('single.trie').items())
+
+        pl = PrivateLocations()
+        pl.num_shards = 4
+        getattr(pl, method)()
+
+        trie = trieformat.load_trie(pl.output_trie_fname)
+        assert isinstance(trie, trieformat.ShardedTrie)
+        assert len(trie) == len(expected)
+        assert dict(trie.items()) == expected
+
+        # Each shard only holds keys from its own prefix range
+        for i in range(4):
+            for key in trie.shard(i).keys():
+                digest = trieformat.key_digest(key, trie.key_scheme)
+                assert trieformat.shard_of(digest, 4) == i
+
+        # Shards are only opened as they're needed
+        trie = trieformat.load_trie(pl.output_trie_fname)
+        key = sorted(expected)[0]
+        assert trie.get(key) == [expected[key]]
+        assert [s is not None for s in trie._shards] == [True, False, False, False]
+        assert trie.get(u'\x01' * 7) is None
+
+
+def test_etl():
+    import gzip
+    import etl
+
+    rand = random.Random(5)
+    raw_rows = []
+    first = {}
+    for i in range(3000):
+        bssid = '%012X' % rand.getrandbits(12)
+        row = (bssid, '%.7f' % (43.6 + rand.random()), '%.7f' % -79.4, '%d' % i)
+        raw_rows.append(row)
+        first.setdefault(bssid.lower(), row)
+    raw_rows.extend([('short', '43.6', '-79.4', '1'),
+                     ('00000000000g', '43.6', '-79.4', '1'),
+                     ('000000000001', 'north', '-79.4', '1'),
+                     ('000000000001', '43.6', '-79.4', 'far')])
+    with gzip.open('raw.tsv.gz', 'wb') as fout:
+        csv.writer(fout, delimiter='\t').writerows(raw_rows)
+
+    expected = sorted((bssid, lat, lon) for (bssid, (_, lat, lon, _)) in first.items())
+    results = {}
+    for dedupe in etl.DEDUPE_MODES:
+        for buffer_rows in (100, 10000):
+            stats = etl.clean('raw.tsv.gz', 'clean.csv',
+                              raw_format='tsv_accuracy',
+                              dedupe=dedupe,
+                              buffer_rows=buffer_rows,
+                              chunk_rows=64,
+                              tmp_dir='.')
+            with open('clean.csv') as fin:
+                rows = [tuple(r) for r in csv.reader(fin)]
+            assert sorted(rows) == expected
+            assert stats.rows_in == len(raw_rows)
+            assert stats.rows_out == len(first)
+            assert stats.skipped == 4
+            assert stats.duplicates == 3000 - len(first)
+            assert (stats.spilled > 0) == (buffer_rows == 100)
+            results[(dedupe, buffer_rows)] = rows
+
+    # Small inputs keep the input order
+    assert results[('sort', 10000)] == results[('partition', 10000)]
+    assert [r[0] for r in results[('partition', 10000)]] == sorted(first, key=lambda b: int(first[b][3]))
+    assert results[('sort', 100)] == expected
+
+    # The plain tsv format ignores the accuracy column
+    stats = etl.clean('raw.tsv.gz', 'clean.csv', raw_format='tsv')
+    assert stats.skipped == 3
+    os.unlink('raw.tsv.gz')
+    os.unlink('clean.csv')
+
+
+def _pnpoly(poly_pts, lat, lon):
+    inside = False
+    j = len(poly_pts) - 1
+    for i in range(len(poly_pts)):
+        lat_i, lon_i = poly_pts[i]
+        lat_j, lon_j = poly_pts[j]
+        if ((lat_i > lat) != (lat_j > lat) and
+                lon < (lon_j - lon_i) * (lat - lat_i) / (lat_j - lat_i) + lon_i):
+            inside = not inside
+        j = i
+    return inside
+
+
+def test_pnpoly():
+    import json
+    import math
+    import pnpoly
+    from slippytiles import num2deg
+
+    # A concave star around Toronto, written out as GeoJSON
+    poly_pts = []
+    for i in range(40):
+        radius = 0.05 if i % 2 else 0.02
+        angle = 2 * math.pi * i / 40
+        poly_pts.append((43.7 + radius * math.sin(angle),
+                         -79.4 + radius * math.cos(angle)))
+    ring = [[lon, lat] for (lat, lon) in poly_pts + poly_pts[:1]]
+    with open('city.geojson', 'w') as fout:
+        json.dump({'features': [{'geometry': {'type': 'Polygon',
+                                              'coordinates': [ring]}}]}, fout)
+    index = pnpoly.PolygonIndex.from_geojson('city.geojson', num_bands=7)
+
+    rand = random.Random(7)
+    with open('points.csv', 'w') as fout:
+        writer = csv.writer(fout)
+        for i in range(3000):
+            writer.writerow(('%012x' % i,
+                             43.64 + rand.random() * 0.12,
+                             -79.46 + rand.random() * 0.12))
+    num_inside, num_outside = pnpoly.split_points(index, 'points.csv',
+                                                  'inside.csv', 'outside.csv',
+                                                  chunk_rows=500)
+    assert num_inside + num_outside == 3000
+    assert 0 < num_inside < 3000
+    for fname, expected in (('inside.csv', True), ('outside.csv', False)):
+        with open(fname) as fin:
+            for bssid, lat, lon in csv.reader(fin):
+                assert _pnpoly(poly_pts, float(lat), float(lon)) == expected
+        os.unlink(fname)
+    os.unlink('points.csv')
+    os.unlink('city.geojson')
+
+    tile_xs, tile_ys = index.tiles(zoom=14)
+    expected = []
+    for x in range(tile_xs.min() - 2, tile_xs.max() + 3):
+        for y in range(tile_ys.min() - 2, tile_ys.max() + 3):
+            if _pnpoly(poly_pts, *num2deg(x + 0.5, y + 0.5, 14)):
+                expected.append((x, y))
+    assert sorted(zip(tile_xs.tolist(), tile_ys.tolist())) == sorted(expected)
+
+
+def test_bloom_filter():
+    import bloom
+    import trieformat
+
+    builds = [('generate_recordtrie_fused', 1),
+              ('generate_recordtrie_fused', 3),
+              ('generate_recordtrie', 3)]
+    for method, num_shards in builds:
+        pl = PrivateLocations()
+        pl.num_shards = num_shards
+        getattr(pl, method)()
+        trie = trieformat.load_trie(pl.output_trie_fname)
+        bloom_filter = bloom.load_bloom(pl.output_bloom_fname)
+        assert bloom_filter.num_keys == len(trie)
+        for key in trie.keys():
+            assert trieformat.key_digest(key, trie.key_scheme) in bloom_filter
+
+        # BSSIDs which were never encoded are mostly filtered out
+        rand = random.Random(4)
+        others = [trieformat.bssid_digest('%012x' % rand.getrandbits(48))
+                  for i in range(1000)]
+        assert sum(1 for d in others if d in bloom_filter) < 50
+        for fname in trieformat.trie_fnames(pl.output_trie_fname):
+            os.remove(fname)
+        os.remove(pl.output_bloom_fname)
+
+
+def test_bundle():
+    import bundle
+    import trieformat
+    from citytiles import OrderedCityTiles
+
+    pl = PrivateLocations()
+    pl.generate_recordtrie_fused()
+    trie = trieformat.load_trie(pl.output_trie_fname)
+    city_tiles = OrderedCityTiles(load_fromdisk=True, fname=pl.ordered_city_bin)
+
+    city_bundle = bundle.CityBundle(pl.output_bundle_fname)
+    assert city_bundle.header == trie.header
+    assert city_bundle.meta['num_tiles'] == city_tiles.size()
+
+    bundle_trie, bundle_tiles = bundle.load_bundle(pl.output_bundle_fname)
+    assert sorted(bundle_trie.items()) == sorted(trie.items())
+    assert bundle_tiles.size() == city_tiles.size()
+    for tile_id in range(city_tiles.size()):
+        assert bundle_tiles[tile_id] == city_tiles[tile_id]
+        assert bundle_tiles.center(tile_id) == city_tiles.center(tile_id)
+        assert list(bundle_tiles.neighbours(tile_id)) == list(city_tiles.neighbours(tile_id))
+    assert city_bundle.bloom().num_keys == len(trie)
+
+    assert bundle.is_bundle(pl.output_bundle_fname)
+    assert not bundle.is_bundle(pl.output_trie_fname)
+
+
+def test_rebuild_removes_stale_trie():
+    import trieformat
+
+    pl = PrivateLocations()
+    pl.generate_recordtrie_fused()
+    assert isfile(pl.output_bundle_fname)
+
+    # A sharded rebuild must not leave the old bundle behind
+    pl = PrivateLocations()
+    pl.num_shards = 3
+    pl.generate_recordtrie_fused()
+    assert not isfile(pl.output_bundle_fname)
+    shard_fnames = trieformat.trie_fnames(pl.output_trie_fname)[1:]
+    assert all(isfile(f) for f in shard_fnames)
+
+    # Nor an unsharded rebuild the old shards
+    pl = PrivateLocations()
+    pl.generate_recordtrie_fused()
+    assert isfile(pl.output_bundle_fname)
+    assert not trieformat.is_shard_index(pl.output_trie_fname)
+    assert not any(isfile(f) for f in shard_fnames)
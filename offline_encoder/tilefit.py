@@ -0,0 +1,95 @@
+'''
+Fit the tiles of a city into the 16 bit tile id space.
+
+A large metro can cover more than 2^16 distinct zoom level 18 tiles.
+Those cities get coarser tiles instead.  Two strategies are
+available :
+
+    * uniform - use the most detailed single zoom level which fits.
+    * mixed - collapse the sparsest groups of tiles into their parent
+      tile one zoom level at a time until the city fits.  Dense areas
+      keep their zoom level 18 tiles while sparse outskirts get
+      coarser tiles.
+
+Both strategies are deterministic so the same input always produces
+the same tiles.
+'''
+
+import numpy as np
+
+from citytiles import ZOOM_LEVEL
+
+MAX_TILES = 2 ** 16
+
+# Don't coarsen past this zoom level.  A zoom level 10 tile is about
+# 40km across.
+MIN_ZOOM = 10
+
+FIT_MODES = ('mixed', 'uniform')
+
+
+def _pack(xs, ys):
+    return (xs.astype(np.int64) << 32) | ys
+
+
+def fit_tiles(tile_xs, tile_ys, counts, max_tiles=MAX_TILES, mode='mixed'):
+    '''
+    Take arrays of unique zoom level 18 tile co-ordinates and the
+    number of BSSIDs in each tile.  Return a list of tile keys which
+    cover every input tile, using no more than max_tiles tiles.
+
+    Zoom level 18 tiles are returned as (tile_x, tile_y) and coarser
+    tiles as (tile_x, tile_y, zoom) to match OrderedCityTiles.
+    '''
+    if mode not in FIT_MODES:
+        raise RuntimeError("Invalid tile fit mode: %s" % mode)
+
+    xs = np.asarray(tile_xs, dtype=np.int64)
+    ys = np.asarray(tile_ys, dtype=np.int64)
+    zs = np.zeros(len(xs), dtype=np.int64) + ZOOM_LEVEL
+    counts = np.asarray(counts, dtype=np.int64)
+
+    for zoom in range(ZOOM_LEVEL - 1, MIN_ZOOM - 1, -1):
+        if len(xs) <= max_tiles:
+            break
+
+        # The parent of every cell at this zoom level
+        shifts = zs - zoom
+        parent_keys = _pack(xs >> shifts, ys >> shifts)
+        group_keys, group_idx, group_sizes = np.unique(parent_keys,
+                                                       return_inverse=True,
+                                                       return_counts=True)
+        group_counts = np.bincount(group_idx, weights=counts).astype(np.int64)
+
+        if mode == 'uniform':
+            merge = np.ones(len(group_keys), dtype=bool)
+        else:
+            # Merge the sparsest groups first until we have removed
+            # enough cells.  Ties are broken on the tile key.
+            merge = np.zeros(len(group_keys), dtype=bool)
+            candidates = np.flatnonzero(group_sizes > 1)
+            order = np.lexsort((group_keys[candidates],
+                                group_counts[candidates]))
+            candidates = candidates[order]
+            removed = np.cumsum(group_sizes[candidates] - 1)
+            excess = len(xs) - max_tiles
+            needed = np.searchsorted(removed, excess) + 1
+            merge[candidates[:needed]] = True
+
+        keep = ~merge[group_idx]
+        xs = np.concatenate([xs[keep], group_keys[merge] >> 32])
+        ys = np.concatenate([ys[keep], group_keys[merge] & 0xffffffff])
+        zs = np.concatenate([zs[keep],
+                             np.zeros(merge.sum(), dtype=np.int64) + zoom])
+        counts = np.concatenate([counts[keep], group_counts[merge]])
+
+    if len(xs) > max_tiles:
+        raise RuntimeError("Too many tiles: [%d]" % len(xs))
+
+    tiles = []
+    for x, y, z in zip(xs.tolist(), ys.tolist(), zs.tolist()):
+        if z == ZOOM_LEVEL:
+            tiles.append((x, y))
+        else:
+            tiles.append((x, y, z))
+    return tiles
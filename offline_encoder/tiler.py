@@ -5,20 +5,50 @@ to position fake BSSIDs.
 
 We use a SOBOL sequence to generate a large stream of random numbers.
 
+The sequence can be stored either as CSV, or as a fixed width binary
+file which can be memory mapped.  The binary file starts with a small
+header followed by one little endian uint32 per number in the
+sequence :
+
+    magic       8 bytes  'SOBOLSEQ'
+    version     uint32
+    seed        uint32   initial seed of the sequence
+    length      uint32   number of entries in the sequence
+    max_tilenum uint32   largest number the sequence can contain
+
 '''
 # Std lib
 import csv
+import struct
 
 # PyPI
+import numpy as np
 from sobol import i4_uniform
 
-# Custom stuff
-from fileutil import file_len
+# This seed number should be held on the ichnaea server as a
+# secret.  It's not critically important to maintain as a secret
+# as the i4_uniform function generates a new seed for every
+# iteration.
+DEFAULT_INITIAL_SEED = 1233441294
+
+# We want to generate 100,000 numbers in the sequence
+SEQUENCE_LENGTH = 100000
+
+DEFAULT_MAX_TILENUM = 65535
+
+SOBOL_MAGIC = b'SOBOLSEQ'
+SOBOL_VERSION = 1
+SOBOL_HEADER = struct.Struct('<8sIIII')
+SOBOL_DTYPE = np.dtype('<u4')
+
+# Constants of the Park-Miller generator used by sobol.i4_uniform
+_LCG_MULTIPLIER = 16807
+_LCG_MODULUS = 2147483647
+
 
 def write_sobol_seq(fname, seed, max_tilenum):
     with open(fname, 'w') as fout:
-        _generate_stream(fout, seed, max_tilenum)
-    return file_len(fname)
+        return _generate_stream(fout, seed, max_tilenum)
 
 def _generate_stream(fout, seed=0, max_tilenum=0):
     """
@@ -26,23 +56,14 @@ def _generate_stream(fout, seed=0, max_tilenum=0):
     it out to disk.  The idea is to use the list as a circular buffer.
 
     For each BSSID, we store an index into this list and then iterate
-    for N fake BSSIDs.  
-    
+    for N fake BSSIDs.
+
     Still need to figure out how to make this work at lower zoom
     levels when more area is visible, or how to handle the case where
     we want continuous maps that are greater than a city boundary.
-    """
-
-    # This seed number should be held on the ichnaea server as a
-    # secret.  It's not critically important to maintain as a secret
-    # as the i4_uniform function generates a new seed for every
-    # iteration.
-    DEFAULT_INITIAL_SEED = 1233441294
 
-    # We want to generate 100,000 numbers in the sequence
-    SEQUENCE_LENGTH = 100000
-
-    DEFAULT_MAX_TILENUM = 65535
+    Returns the number of rows written.
+    """
 
     if max_tilenum == 0:
         max_tilenum = DEFAULT_MAX_TILENUM
@@ -55,3 +76,100 @@ def _generate_stream(fout, seed=0, max_tilenum=0):
         (i, seed) = i4_uniform (0, max_tilenum, seed)
         writer.writerow((i, seed))
     fout.flush()
+    return SEQUENCE_LENGTH
+
+def sobol_array(seed=0, max_tilenum=0, length=SEQUENCE_LENGTH):
+    """
+    Compute the same numbers as _generate_stream, all at once.
+
+    i4_uniform is a Park-Miller generator, so the seed after k steps
+    is seed * 16807^k mod (2^31 - 1).  The powers are computed as the
+    outer product of two short runs of powers so that every seed can
+    be computed with a single vectorized multiply.
+    """
+    if max_tilenum == 0:
+        max_tilenum = DEFAULT_MAX_TILENUM
+
+    if seed == 0:
+        seed = DEFAULT_INITIAL_SEED
+
+    seed = int(seed) % _LCG_MODULUS
+
+    # powers[i * block + j] == 16807^(i * block + j + 1)
+    block = int(np.ceil(np.sqrt(length)))
+    low_powers = [_LCG_MULTIPLIER]
+    for i in xrange(block - 1):
+        low_powers.append(low_powers[-1] * _LCG_MULTIPLIER % _LCG_MODULUS)
+    block_power = low_powers[-1]
+    high_powers = [1]
+    for i in xrange(block - 1):
+        high_powers.append(high_powers[-1] * block_power % _LCG_MODULUS)
+
+    powers = (np.array(high_powers, dtype=np.int64)[:, np.newaxis] *
+              np.array(low_powers, dtype=np.int64)[np.newaxis, :])
+    powers = (powers % _LCG_MODULUS).ravel()[:length]
+    seeds = (seed * powers) % _LCG_MODULUS
+
+    # Scale to lie between -0.5 and max_tilenum+0.5 and round half
+    # away from zero exactly like i4_uniform does.
+    r = seeds * 4.656612875E-10
+    r = (1.0 - r) * (0 - 0.5) + r * (max_tilenum + 0.5)
+    floor_r = np.floor(r)
+    values = np.where(r - floor_r >= 0.5, floor_r + 1, floor_r)
+    return np.clip(values, 0, max_tilenum).astype(SOBOL_DTYPE)
+
+def write_sobol_bin(fname, seed, max_tilenum):
+    """
+    Write the sobol sequence out as a binary file that
+    load_sobol_seq can memory map.  Returns the length of the
+    sequence.
+    """
+    values = sobol_array(seed, max_tilenum)
+    save_sobol_bin(fname, values, seed, max_tilenum)
+    return len(values)
+
+def save_sobol_bin(fname, values, seed, max_tilenum):
+    with open(fname, 'wb') as fout:
+        fout.write(SOBOL_HEADER.pack(SOBOL_MAGIC,
+                                     SOBOL_VERSION,
+                                     seed,
+                                     len(values),
+                                     max_tilenum))
+        np.asarray(values, dtype=SOBOL_DTYPE).tofile(fout)
+
+def read_sobol_header(fname):
+    """
+    Return the (seed, length, max_tilenum) header of a binary sobol
+    sequence file.
+    """
+    with open(fname, 'rb') as fin:
+        data = fin.read(SOBOL_HEADER.size)
+    if len(data) < SOBOL_HEADER.size:
+        raise RuntimeError("Truncated sobol file: %s" % fname)
+
+    magic, version, seed, length, max_tilenum = SOBOL_HEADER.unpack(data)
+    if magic != SOBOL_MAGIC:
+        raise RuntimeError("Not a binary sobol file: %s" % fname)
+    if version != SOBOL_VERSION:
+        raise RuntimeError("Unknown sobol file version: %d" % version)
+    return seed, length, max_tilenum
+
+def load_sobol_seq(fname):
+    """
+    Load a sobol sequence as an integer array.  Binary files are
+    memory mapped.  CSV files written by write_sobol_seq are parsed.
+    """
+    with open(fname, 'rb') as fin:
+        is_binary = fin.read(len(SOBOL_MAGIC)) == SOBOL_MAGIC
+
+    if not is_binary:
+        with open(fname) as fin:
+            return np.array([int(row[0]) for row in csv.reader(fin)],
+                            dtype=SOBOL_DTYPE)
+
+    seed, length, max_tilenum = read_sobol_header(fname)
+    return np.memmap(fname,
+                     dtype=SOBOL_DTYPE,
+                     mode='r',
+                     offset=SOBOL_HEADER.size,
+                     shape=(length,))
@@ -0,0 +1,437 @@
+'''
+Reading and writing the record trie file.
+
+A record trie maps the hashed BSSID to the tile ids of that BSSID.
+Every trie written by the encoder carries a small header stored under
+META_KEY, which can never collide with a hashed BSSID.  The header is
+a JSON object :
+
+    version      format version of the trie
+    dupe_num     number of tile ids stored for each BSSID
+    encoding     how the tile ids are stored, one of ENCODINGS
+    record_width bytes per tile id, 0 for variable width encodings
+    zoom         zoom level of the finest tiles in the city
+    num_tiles    number of tiles in the ordered city tile list
+    key_scheme   how BSSIDs are turned into keys, one of KEY_SCHEMES
+
+The encodings are :
+
+    u16     dupe_num unsigned big endian 16 bit tile ids.  This is the
+            default as tile ids always fit in 16 bits.
+    sorted  the tile ids sorted in ascending order and delta encoded
+            as unsigned LEB128 varints.  The order of the tile ids is
+            not preserved.
+    i32     dupe_num signed big endian 32 bit tile ids.  Tries written
+            before the header existed use this encoding.
+
+Every key is made from the first KEY_BYTES bytes of the sha256 digest
+of the BSSID.  The key schemes are :
+
+    hex     the digest prefix as 12 lower case hex characters.
+    binary  the digest prefix as 7 base 127 digits, each stored as
+            one of the characters 0x01 to 0x7f.  marisa_trie keys are
+            unicode so bytes above 0x7f would take two bytes of UTF-8,
+            and keys containing NUL can't be looked up.  This is the
+            shortest key which avoids both.
+
+Tries without a header are read as i32 records with LEGACY_DUPE_NUM
+tile ids and hex keys.
+
+A large city can be split into a sharded trie.  Shard i holds every
+key whose first 16 bits of digest d satisfy d * num_shards >> 16 == i,
+so each shard covers a contiguous range of the keyspace.  Each shard
+is an ordinary trie file named <trie>.NNN.  The trie file itself is
+then a small JSON index :
+
+    {"version": 1,
+     "header": <header shared by every shard>,
+     "shards": [{"fname": "area.record_trie.000",
+                 "first_prefix": 0,
+                 "last_prefix": 16383,
+                 "records": 12345}, ...]}
+
+load_trie recognizes the index and returns a ShardedTrie which only
+maps a shard the first time a key in its range is looked up.
+'''
+import binascii
+import hashlib
+import json
+import struct
+from os.path import abspath, basename, dirname, expanduser, getsize, join
+
+from marisa_trie import BytesTrie
+
+from citytiles import ZOOM_LEVEL
+
+TRIE_VERSION = 1
+
+META_KEY = u'~meta'
+
+ENCODINGS = ('u16', 'sorted', 'i32')
+
+# Tile ids per BSSID in tries written before the header existed
+LEGACY_DUPE_NUM = 3
+
+_RECORD_TYPES = {'u16': 'H', 'i32': 'i'}
+
+KEY_SCHEMES = ('hex', 'binary')
+
+KEY_BYTES = 6
+
+_KEY_DIGITS = 7
+_KEY_BASE = 127
+
+# Binary keys are converted two base 127 digits at a time through
+# lookup tables, instead of one digit at a time.
+_PAIR_BASE = _KEY_BASE * _KEY_BASE
+_DIGIT_CHARS = [unichr(i + 1) for i in xrange(_KEY_BASE)]
+_PAIR_CHARS = [_DIGIT_CHARS[i // _KEY_BASE] + _DIGIT_CHARS[i % _KEY_BASE]
+               for i in xrange(_PAIR_BASE)]
+_PAIR_VALUES = dict((chars, i) for (i, chars) in enumerate(_PAIR_CHARS))
+_DIGEST = struct.Struct('>HI')
+
+
+def bssid_digest(bssid):
+    '''
+    The sha256 digest prefix that every key scheme is built from
+    '''
+    return hashlib.sha256(bssid).digest()[:KEY_BYTES]
+
+
+def digest_key(digest, key_scheme):
+    '''
+    Convert a digest prefix into a trie key.  Keys sort in the same
+    order as their digests.
+    '''
+    if key_scheme == 'binary':
+        high, low = _DIGEST.unpack(digest)
+        n = (high << 32) | low
+        pair3 = n % _PAIR_BASE
+        n //= _PAIR_BASE
+        pair2 = n % _PAIR_BASE
+        n //= _PAIR_BASE
+        pair1 = n % _PAIR_BASE
+        return (_DIGIT_CHARS[n // _PAIR_BASE] +
+                _PAIR_CHARS[pair1] +
+                _PAIR_CHARS[pair2] +
+                _PAIR_CHARS[pair3])
+    if key_scheme == 'hex':
+        return unicode(binascii.hexlify(digest))
+    raise RuntimeError("Invalid key scheme: %s" % key_scheme)
+
+
+def key_digest(key, key_scheme):
+    '''
+    Inverse of digest_key
+    '''
+    return binascii.unhexlify('%0*x' % (2 * KEY_BYTES, key_value(key, key_scheme)))
+
+
+def key_value(key, key_scheme):
+    '''
+    The digest prefix of a key as an integer
+    '''
+    if key_scheme == 'binary':
+        return (((ord(key[0]) - 1) * _PAIR_BASE +
+                 _PAIR_VALUES[key[1:3]]) * _PAIR_BASE +
+                _PAIR_VALUES[key[3:5]]) * _PAIR_BASE + _PAIR_VALUES[key[5:7]]
+    if key_scheme == 'hex':
+        return int(key, 16)
+    raise RuntimeError("Invalid key scheme: %s" % key_scheme)
+
+
+def bssid_key(bssid, key_scheme):
+    return digest_key(bssid_digest(bssid), key_scheme)
+
+
+def make_header(dupe_num,
+                encoding='u16',
+                zoom=ZOOM_LEVEL,
+                num_tiles=None,
+                key_scheme='binary'):
+    if encoding not in ENCODINGS:
+        raise RuntimeError("Invalid trie encoding: %s" % encoding)
+    if key_scheme not in KEY_SCHEMES:
+        raise RuntimeError("Invalid key scheme: %s" % key_scheme)
+    record_width = 0
+    if encoding in _RECORD_TYPES:
+        record_width = struct.calcsize(_RECORD_TYPES[encoding])
+    return {'version': TRIE_VERSION,
+            'dupe_num': dupe_num,
+            'encoding': encoding,
+            'record_width': record_width,
+            'zoom': zoom,
+            'num_tiles': num_tiles,
+            'key_scheme': key_scheme}
+
+
+def legacy_header():
+    '''
+    The header of a trie which was written without one
+    '''
+    return make_header(LEGACY_DUPE_NUM, 'i32', key_scheme='hex')
+
+
+def encode_varints(tile_ids):
+    '''
+    Sort the tile ids and encode the gaps between them as unsigned
+    LEB128 varints.
+    '''
+    out = bytearray()
+    prev = 0
+    for tile_id in sorted(tile_ids):
+        delta = tile_id - prev
+        prev = tile_id
+        while delta >= 0x80:
+            out.append((delta & 0x7f) | 0x80)
+            delta >>= 7
+        out.append(delta)
+    return bytes(out)
+
+
+def decode_varints(data):
+    tile_ids = []
+    value = shift = prev = 0
+    for byte in bytearray(data):
+        value |= (byte & 0x7f) << shift
+        if byte & 0x80:
+            shift += 7
+            continue
+        prev += value
+        tile_ids.append(prev)
+        value = shift = 0
+    return tuple(tile_ids)
+
+
+class RecordCodec(object):
+    '''
+    Packs and unpacks the tile ids of one BSSID for a trie header
+    '''
+    def __init__(self, header):
+        if header['version'] > TRIE_VERSION:
+            raise RuntimeError("Unsupported trie version: %d" % header['version'])
+        self.header = header
+        encoding = header['encoding']
+        if encoding == 'sorted':
+            self.pack = encode_varints
+            self.unpack = decode_varints
+        elif encoding in _RECORD_TYPES:
+            fmt = struct.Struct('>' + _RECORD_TYPES[encoding] * header['dupe_num'])
+            self.pack = lambda tile_ids: fmt.pack(*tile_ids)
+            self.unpack = fmt.unpack
+        else:
+            raise RuntimeError("Invalid trie encoding: %s" % encoding)
+
+
+def save_trie(fname, records, header):
+    '''
+    Write (hashed bssid, tile ids) records out as a record trie with
+    the header stored alongside them.
+    '''
+    pack = RecordCodec(header).pack
+
+    def _items():
+        yield META_KEY, json.dumps(header, sort_keys=True)
+        for key, tile_ids in records:
+            yield key, pack(tile_ids)
+
+    trie = BytesTrie(_items())
+    trie.save(fname)
+
+
+class OfflineTrie(object):
+    '''
+    A read only record trie.  get() returns a list holding one tuple
+    of tile ids just like marisa_trie.RecordTrie does.
+    '''
+    def __init__(self, trie):
+        self._trie = trie
+        meta = trie.get(META_KEY)
+        if meta:
+            self.header = json.loads(meta[0])
+            self.header.setdefault('key_scheme', 'hex')
+            self._has_meta = True
+        else:
+            self.header = legacy_header()
+            self._has_meta = False
+        self._unpack = RecordCodec(self.header).unpack
+        self.key_scheme = self.header['key_scheme']
+
+    def bssid_key(self, bssid):
+        '''
+        Return the key for a raw BSSID in this trie
+        '''
+        return bssid_key(bssid, self.key_scheme)
+
+    def get(self, key, default=None):
+        values = self._trie.get(key)
+        if values is None or key == META_KEY:
+            return default
+        return [self._unpack(v) for v in values]
+
+    def __getitem__(self, key):
+        values = self.get(key)
+        if values is None:
+            raise KeyError(key)
+        return values
+
+    def __contains__(self, key):
+        return key != META_KEY and key in self._trie
+
+    def __len__(self):
+        return len(self._trie) - int(self._has_meta)
+
+    def keys(self):
+        return [k for k in self._trie.keys() if k != META_KEY]
+
+    def items(self):
+        return [(k, self._unpack(v)) for (k, v) in self._trie.items()
+                if k != META_KEY]
+
+
+def shard_of(digest, num_shards):
+    '''
+    The shard which holds the key for a digest prefix
+    '''
+    return (struct.unpack('>H', digest[:2])[0] * num_shards) >> 16
+
+
+def shard_fname(fname, shard_idx):
+    return '%s.%03d' % (fname, shard_idx)
+
+
+def save_shard_index(fname, header, shard_records):
+    '''
+    Write the index of a sharded trie.  shard_records holds the
+    number of records in each shard, which must already have been
+    written with save_trie to shard_fname(fname, i).
+    '''
+    num_shards = len(shard_records)
+    shards = []
+    for i, records in enumerate(shard_records):
+        # The range of 16 bit prefixes that shard_of puts in shard i
+        first_prefix = -((-i << 16) // num_shards)
+        last_prefix = -((-(i + 1) << 16) // num_shards) - 1
+        shards.append({'fname': basename(shard_fname(fname, i)),
+                       'first_prefix': first_prefix,
+                       'last_prefix': last_prefix,
+                       'records': records})
+    index = {'version': TRIE_VERSION,
+             'header': header,
+             'shards': shards}
+    with open(fname, 'w') as fout:
+        json.dump(index, fout, indent=2, sort_keys=True, separators=(',', ': '))
+
+
+def is_shard_index(fname):
+    with open(fname, 'rb') as fin:
+        return fin.read(1) == b'{'
+
+
+class ShardedTrie(object):
+    '''
+    A read only trie split into shards by key prefix.  Shards are
+    opened the first time they are needed.
+    '''
+    def __init__(self, index_fname, mmap=True):
+        with open(index_fname) as fin:
+            index = json.load(fin)
+        if index['version'] > TRIE_VERSION:
+            raise RuntimeError("Unsupported trie version: %d" % index['version'])
+        self.header = index['header']
+        self.key_scheme = self.header['key_scheme']
+        base_dir = dirname(index_fname)
+        self._shard_fnames = [join(base_dir, s['fname']) for s in index['shards']]
+        self._records = sum(s['records'] for s in index['shards'])
+        self._shards = [None] * len(self._shard_fnames)
+        self._mmap = mmap
+
+    @property
+    def num_shards(self):
+        return len(self._shards)
+
+    def shard(self, shard_idx):
+        '''
+        Return the OfflineTrie of one shard, opening it if needed
+        '''
+        trie = self._shards[shard_idx]
+        if trie is None:
+            trie = load_trie(self._shard_fnames[shard_idx], self._mmap)
+            self._shards[shard_idx] = trie
+        return trie
+
+    def _shard_for(self, key):
+        if key == META_KEY:
+            return None
+        try:
+            digest = key_digest(key, self.key_scheme)
+        except (TypeError, ValueError):
+            # Not a key this trie could hold
+            return None
+        return self.shard(shard_of(digest, self.num_shards))
+
+    def bssid_key(self, bssid):
+        return bssid_key(bssid, self.key_scheme)
+
+    def get(self, key, default=None):
+        trie = self._shard_for(key)
+        if trie is None:
+            return default
+        return trie.get(key, default)
+
+    def __getitem__(self, key):
+        values = self.get(key)
+        if values is None:
+            raise KeyError(key)
+        return values
+
+    def __contains__(self, key):
+        trie = self._shard_for(key)
+        return trie is not None and key in trie
+
+    def __len__(self):
+        return self._records
+
+    def keys(self):
+        result = []
+        for i in range(self.num_shards):
+            result.extend(self.shard(i).keys())
+        return result
+
+    def items(self):
+        result = []
+        for i in range(self.num_shards):
+            result.extend(self.shard(i).items())
+        return result
+
+
+def trie_fnames(fname):
+    '''
+    Every file which makes up the trie in fname
+    '''
+    if not is_shard_index(fname):
+        return [fname]
+    with open(fname) as fin:
+        index = json.load(fin)
+    base_dir = dirname(abspath(fname))
+    return [fname] + [join(base_dir, s['fname']) for s in index['shards']]
+
+
+def trie_size(fname):
+    return sum(getsize(f) for f in trie_fnames(fname))
+
+
+def load_trie(fname, mmap=True):
+    '''
+    Open a record trie file, or the index of a sharded trie.  By
+    default the file is memory mapped.
+    '''
+    fname = abspath(expanduser(fname))
+    if is_shard_index(fname):
+        return ShardedTrie(fname, mmap)
+    trie = BytesTrie()
+    if mmap:
+        trie.mmap(fname)
+    else:
+        trie.load(fname)
+    return OfflineTrie(trie)
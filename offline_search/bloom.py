@@ -0,0 +1 @@
+../offline_encoder/bloom.py
\ No newline at end of file
@@ -0,0 +1 @@
+../offline_encoder/bundle.py
\ No newline at end of file
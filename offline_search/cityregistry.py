@@ -0,0 +1,219 @@
+"""
+Serve location fixes for many cities at once.
+
+Every city is registered with the files its build wrote : either its
+bundle (see bundle.py), or the record trie, the ordered city tiles
+and the bloom filter of its hashed BSSIDs (see bloom.py).  Only the
+bloom filters are kept in memory all the time.  A city's trie and
+tiles are memory mapped the first time a scan is routed to it.
+
+To route a scan, each BSSID is hashed once and checked against the
+bloom filter of every city.  Cities are tried in order of the number
+of BSSIDs their filter let through, and only those cities' tries are
+ever probed.  The probes reuse the hashes, converted to the key
+scheme of each city's trie.
+
+Open cities are kept in least recently used order.  When the files
+of the open cities add up to more than memory_budget bytes, the least
+recently used cities are closed again.  The city being opened is
+never closed, even if it is larger than the budget on its own.
+"""
+
+import json
+import threading
+from collections import OrderedDict
+from os.path import abspath, dirname, getsize, isfile, join
+
+import numpy as np
+
+import bloom
+import bundle
+import trieformat
+from citytiles import OrderedCityTiles
+from searcher import LocationFixer, load_trie
+from strategies import BasicLocationFix, SimpleTieBreaker
+
+# 1 GB of memory mapped city files
+DEFAULT_BUDGET = 1024 ** 3
+
+STRATEGIES = [BasicLocationFix, SimpleTieBreaker]
+
+
+def _trie_bloom(trie):
+    '''
+    Build the bloom filter of a trie written without one
+    '''
+    return bloom.BloomFilter.build([trieformat.key_value(key, trie.key_scheme)
+                                    for key in trie.keys()])
+
+
+class City(object):
+    def __init__(self, name, bloom_filter, trie_fname=None,
+                 city_tiles_fname=None, city_bundle=None):
+        self.name = name
+        self.bloom = bloom_filter
+        self.trie_fname = trie_fname
+        self.city_tiles_fname = city_tiles_fname
+        self.city_bundle = city_bundle
+        self.fixer = None
+
+    def open(self):
+        '''
+        Memory map the trie and the city tiles
+        '''
+        if self.city_bundle is not None:
+            return self.city_bundle.trie(), self.city_bundle.city_tiles()
+        return (load_trie(self.trie_fname),
+                OrderedCityTiles(load_fromdisk=True, fname=self.city_tiles_fname))
+
+    def resident_bytes(self):
+        '''
+        Upper bound on the memory the city takes up while it is open
+        '''
+        if self.city_bundle is not None:
+            return self.city_bundle.size()
+        return (trieformat.trie_size(self.trie_fname) +
+                getsize(self.city_tiles_fname))
+
+
+class CityRegistry(object):
+    def __init__(self, strategies=STRATEGIES, memory_budget=DEFAULT_BUDGET,
+                 cache_size=None):
+        self.strategies = strategies
+        self.memory_budget = memory_budget
+        self.cache_size = cache_size
+        self.cities = OrderedDict()
+        self.stats = {'loads': 0, 'evictions': 0, 'probes': 0}
+
+        # Open cities, least recently used first
+        self._open = OrderedDict()
+        self._open_bytes = 0
+        self._lock = threading.RLock()
+
+    def add_city(self, name, trie_fname, city_tiles_fname, bloom_fname=None):
+        '''
+        Register a city.  If there is no bloom filter file, the filter
+        is built from the trie.
+        '''
+        if name in self.cities:
+            raise RuntimeError("Duplicate city: %s" % name)
+        if bloom_fname is not None and isfile(bloom_fname):
+            bloom_filter = bloom.load_bloom(bloom_fname)
+        else:
+            bloom_filter = _trie_bloom(load_trie(trie_fname))
+        self.cities[name] = City(name, bloom_filter, trie_fname, city_tiles_fname)
+
+    def add_bundle(self, name, bundle_fname):
+        '''
+        Register a city from its bundle file
+        '''
+        if name in self.cities:
+            raise RuntimeError("Duplicate city: %s" % name)
+        city_bundle = bundle.CityBundle(bundle_fname)
+        bloom_filter = city_bundle.bloom()
+        if bloom_filter is None:
+            bloom_filter = _trie_bloom(city_bundle.trie())
+        self.cities[name] = City(name, bloom_filter, city_bundle=city_bundle)
+
+    def add_output_dir(self, name, output_dir):
+        '''
+        Register a city from the output directory of its build.  The
+        bundle is used if the build wrote one.
+        '''
+        bundle_fname = join(output_dir, 'area.bundle')
+        if isfile(bundle_fname):
+            self.add_bundle(name, bundle_fname)
+            return
+
+        city_tiles_fname = join(output_dir, 'ordered_city.bin')
+        if not isfile(city_tiles_fname):
+            city_tiles_fname = join(output_dir, 'ordered_city.csv')
+        self.add_city(name,
+                      join(output_dir, 'area.record_trie'),
+                      city_tiles_fname,
+                      join(output_dir, 'area.bloom'))
+
+    def add_manifest(self, manifest_fname):
+        '''
+        Register every city in a batch.py manifest
+        '''
+        base_dir = dirname(abspath(manifest_fname))
+        with open(manifest_fname) as fin:
+            manifest = json.load(fin)
+        for city in manifest['cities']:
+            self.add_output_dir(city['name'], join(base_dir, city['output_dir']))
+
+    def candidates(self, bssids, digests=None):
+        '''
+        Return [(city name, BSSIDs which passed its bloom filter)] for
+        every city which may hold any of the BSSIDs, most likely city
+        first.  digests are the digests of the BSSIDs, if the caller
+        has already hashed them.
+        '''
+        if digests is None:
+            digests = [trieformat.bssid_digest(b) for b in bssids]
+        values = np.array([bloom.digest_value(d) for d in digests], dtype=np.uint64)
+        result = []
+        for name, city in self.cities.items():
+            hits = int(city.bloom.contains_values(values).sum())
+            if hits:
+                result.append((name, hits))
+        result.sort(key=lambda item: -item[1])
+        return result
+
+    def fixer(self, name):
+        '''
+        Return the LocationFixer of a city, opening the city if needed
+        '''
+        with self._lock:
+            city = self.cities[name]
+            if name in self._open:
+                # Mark the city as the most recently used
+                self._open[name] = self._open.pop(name)
+                return city.fixer
+
+            kwargs = {}
+            if self.cache_size is not None:
+                kwargs['cache_size'] = self.cache_size
+            trie, city_tiles = city.open()
+            city.fixer = LocationFixer(trie,
+                                       city_tiles,
+                                       self.strategies,
+                                       city.trie_fname,
+                                       **kwargs)
+            size = city.resident_bytes()
+            self._open[name] = size
+            self._open_bytes += size
+            self.stats['loads'] += 1
+
+            while self._open_bytes > self.memory_budget and len(self._open) > 1:
+                self._evict(next(iter(self._open)))
+            return city.fixer
+
+    def _evict(self, name):
+        self._open_bytes -= self._open.pop(name)
+        # The files are unmapped once nothing refers to them
+        self.cities[name].fixer = None
+        self.stats['evictions'] += 1
+
+    def open_cities(self):
+        with self._lock:
+            return list(self._open)
+
+    def find_solution(self, fixTime, bssids):
+        '''
+        Return (city name, LocationSolution) for the first candidate
+        city whose trie holds any of the BSSIDs, or (None, None).
+        '''
+        digests = [trieformat.bssid_digest(b) for b in bssids]
+        for name, hits in self.candidates(bssids, digests):
+            self.stats['probes'] += 1
+            fixer = self.fixer(name)
+            key_scheme = fixer.offline_trie.key_scheme
+            soln = fixer.find_solution(fixTime,
+                                       bssids,
+                                       [trieformat.digest_key(d, key_scheme)
+                                        for d in digests])
+            if soln.matches:
+                return name, soln
+        return None, None
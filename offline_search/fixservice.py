@@ -0,0 +1,395 @@
+#!/usr/bin/env python
+
+"""
+A local network service which computes location fixes.
+
+The trie and the city tiles are loaded once when the service starts
+and stay memory mapped.  Clients connect over TCP and send one JSON
+scan per line :
+
+    {"bssids": ["788df7e75788", "a06391685342"]}
+
+Each request gets one line back, which is the JSON of
+LocationSolution.asjson.  Requests which can't be parsed get
+{"error": "..."} instead.  Responses on a connection come back in
+the same order as its requests, so clients may pipeline.
+
+The service is a single asyncore event loop.  Requests from every
+connection are queued, and the queue is fixed as one batch with
+LocationFixer.find_solutions once it holds max_batch requests or its
+oldest request has waited batch_window seconds.
+
+Backpressure : a connection stops being read while it has
+max_conn_pending requests in the queue, or max_conn_output responses
+which it hasn't sent yet.  Every connection stops being read while
+the queue holds max_pending requests.  Lines which were already
+received stay buffered, unparsed, until the connection may queue
+requests again.  Clients then block on their own socket buffers
+until the queue drains.  Lines longer than MAX_REQUEST_BYTES close
+the connection.
+
+    python ./fixservice.py serve --trie city.record_trie --city-tiles ordered_city.bin
+    python ./fixservice.py serve --bundle area.bundle
+    python ./fixservice.py load --bssids tests/fixtures/newmarket_fixtures.json
+
+The load command is a load generator for local testing.  It runs
+--connections clients which each send --requests scans of random
+BSSIDs and reports the request latency.
+"""
+
+# Standard library
+import argparse
+import asynchat
+import asyncore
+import datetime
+import json
+import random
+import socket
+import threading
+import time
+from collections import deque
+
+# Custom modules
+import bundle
+from citytiles import OrderedCityTiles
+from fixture_loader import fetch_bssids
+from searcher import LocationFixer, load_trie
+from strategies import BasicLocationFix, SimpleTieBreaker
+
+DEFAULT_PORT = 8765
+
+STRATEGIES = [BasicLocationFix, SimpleTieBreaker]
+
+# Requests fixed together in one batch
+MAX_BATCH = 256
+
+# Seconds the oldest queued request waits for a batch to fill
+BATCH_WINDOW = 0.005
+
+# Queued requests before no connection is read
+MAX_PENDING = 4096
+
+# Queued requests of one connection before it is no longer read
+MAX_CONN_PENDING = 64
+
+# Unsent responses of one connection before it is no longer read
+MAX_CONN_OUTPUT = 256
+
+MAX_REQUEST_BYTES = 64 * 1024
+
+
+class FixConnection(asynchat.async_chat):
+    def __init__(self, sock, service):
+        asynchat.async_chat.__init__(self, sock, map=service.socket_map)
+        self.service = service
+        self.pending = 0
+        # Bytes received but not parsed yet
+        self._buffer = ''
+
+    def can_queue(self):
+        '''
+        True while the connection may queue another request
+        '''
+        return (self.pending < self.service.max_conn_pending and
+                len(self.producer_fifo) < self.service.max_conn_output and
+                len(self.service.queue) < self.service.max_pending)
+
+    def readable(self):
+        return self.can_queue() and asynchat.async_chat.readable(self)
+
+    def handle_read(self):
+        try:
+            data = self.recv(self.ac_in_buffer_size)
+        except socket.error:
+            self.handle_error()
+            return
+        self._buffer += data
+        self.parse_lines()
+
+    def parse_lines(self):
+        '''
+        Submit the buffered lines until the connection may not queue
+        any more requests.  Connections left with complete lines are
+        parsed again by the service once requests were fixed.
+        '''
+        buf = self._buffer
+        start = 0
+        while self.connected and self.can_queue():
+            end = buf.find('\n', start)
+            if end < 0:
+                break
+            line = buf[start:end]
+            start = end + 1
+            if len(line) > MAX_REQUEST_BYTES:
+                self._reject()
+                return
+            self._submit_line(line.strip())
+        self._buffer = buf = buf[start:]
+
+        if len(buf) > MAX_REQUEST_BYTES and buf.find('\n', 0, MAX_REQUEST_BYTES + 1) < 0:
+            self._reject()
+        elif self.connected and '\n' in buf:
+            self.service.stalled.add(self)
+        else:
+            self.service.stalled.discard(self)
+
+    def _reject(self):
+        self.service.stats['rejected'] += 1
+        self.close()
+
+    def _submit_line(self, line):
+        if not line:
+            return
+
+        bssids = error = None
+        try:
+            request = json.loads(line)
+            bssids = [str(b) for b in request['bssids']]
+        except (ValueError, KeyError, TypeError, UnicodeEncodeError):
+            error = 'Invalid request'
+        self.service.submit(self, bssids, error)
+
+    def handle_close(self):
+        self.close()
+
+    def close(self):
+        self.service.stalled.discard(self)
+        asynchat.async_chat.close(self)
+
+
+class FixService(asyncore.dispatcher):
+    '''
+    Accepts connections and fixes their requests in batches
+    '''
+    def __init__(self,
+                 fixer,
+                 host='127.0.0.1',
+                 port=DEFAULT_PORT,
+                 max_batch=MAX_BATCH,
+                 batch_window=BATCH_WINDOW,
+                 max_pending=MAX_PENDING,
+                 max_conn_pending=MAX_CONN_PENDING,
+                 max_conn_output=MAX_CONN_OUTPUT):
+        self.socket_map = {}
+        asyncore.dispatcher.__init__(self, map=self.socket_map)
+        self.fixer = fixer
+        self.max_batch = max_batch
+        self.batch_window = batch_window
+        self.max_pending = max_pending
+        self.max_conn_pending = max_conn_pending
+        self.max_conn_output = max_conn_output
+
+        # (connection, bssids, error, time queued)
+        self.queue = deque()
+        # Connections with complete lines they couldn't queue yet
+        self.stalled = set()
+        self.stats = {'requests': 0,
+                      'batches': 0,
+                      'largest_batch': 0,
+                      'rejected': 0}
+        self._running = False
+
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.set_reuse_addr()
+        self.bind((host, port))
+        self.listen(128)
+
+    @property
+    def address(self):
+        return self.socket.getsockname()
+
+    def handle_accept(self):
+        pair = self.accept()
+        if pair is not None:
+            FixConnection(pair[0], self)
+
+    def submit(self, conn, bssids, error=None):
+        conn.pending += 1
+        self.queue.append((conn, bssids, error, time.time()))
+
+    def flush(self):
+        '''
+        Fix one batch of queued requests and send the responses
+        '''
+        batch = [self.queue.popleft()
+                 for i in xrange(min(self.max_batch, len(self.queue)))]
+        now = datetime.datetime.now()
+        scans = [(now, bssids) for (conn, bssids, error, queued) in batch
+                 if error is None]
+        solutions = iter(self.fixer.find_solutions(scans))
+
+        self.stats['requests'] += len(batch)
+        self.stats['batches'] += 1
+        self.stats['largest_batch'] = max(self.stats['largest_batch'], len(batch))
+        for conn, bssids, error, queued in batch:
+            if error is None:
+                response = next(solutions).asjson()
+            else:
+                response = json.dumps({'error': error})
+            conn.pending -= 1
+            if conn.connected:
+                conn.push(response + '\n')
+
+    def _batch_due(self):
+        return (len(self.queue) >= self.max_batch or
+                time.time() - self.queue[0][3] >= self.batch_window)
+
+    def serve_forever(self, poll_interval=0.5):
+        self._running = True
+        try:
+            while self._running:
+                timeout = poll_interval
+                if self.queue:
+                    timeout = max(0, self.queue[0][3] + self.batch_window - time.time())
+                asyncore.loop(timeout=timeout, map=self.socket_map, count=1)
+                while self.queue and self._batch_due():
+                    self.flush()
+                for conn in list(self.stalled):
+                    conn.parse_lines()
+        finally:
+            self.close_all()
+
+    def stop(self):
+        '''
+        Stop serve_forever.  It returns within one poll interval.
+        '''
+        self._running = False
+
+    def close_all(self):
+        for channel in self.socket_map.values():
+            channel.close()
+
+
+def run_load(host, port, bssids, connections=8, requests=1000, scan_size=10, seed=0):
+    '''
+    Send scans of random BSSIDs from several connections at once.
+    Each connection waits for a response before its next request.
+    Returns the latency percentiles in milliseconds and the request
+    rate.
+    '''
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+
+    def _client(client_seed):
+        rand = random.Random(client_seed)
+        sock = socket.create_connection((host, port))
+        fin = sock.makefile('rb')
+        try:
+            for i in xrange(requests):
+                scan = [rand.choice(bssids) for j in xrange(scan_size)]
+                start = time.time()
+                sock.sendall(json.dumps({'bssids': scan}) + '\n')
+                response = json.loads(fin.readline())
+                elapsed = time.time() - start
+                with lock:
+                    latencies.append(elapsed)
+                    if 'error' in response:
+                        errors[0] += 1
+        finally:
+            fin.close()
+            sock.close()
+
+    start = time.time()
+    clients = [threading.Thread(target=_client, args=(seed + i,))
+               for i in xrange(connections)]
+    for client in clients:
+        client.start()
+    for client in clients:
+        client.join()
+    elapsed = time.time() - start
+
+    latencies.sort()
+
+    def _percentile(p):
+        if not latencies:
+            return None
+        return latencies[min(len(latencies) - 1, int(len(latencies) * p))] * 1000
+
+    return {'requests': len(latencies),
+            'errors': errors[0],
+            'seconds': elapsed,
+            'requests_per_sec': len(latencies) / elapsed if elapsed else None,
+            'p50_ms': _percentile(0.5),
+            'p95_ms': _percentile(0.95),
+            'p99_ms': _percentile(0.99)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve location fixes')
+    commands = parser.add_subparsers(dest='command')
+
+    serve = commands.add_parser('serve', help='Run the fix service')
+    serve.add_argument('--bundle',
+                       help='City bundle file, instead of --trie and --city-tiles')
+    serve.add_argument('--trie', help='Record trie file')
+    serve.add_argument('--city-tiles', help='ordered_city.bin or ordered_city.csv')
+    serve.add_argument('--host', default='127.0.0.1')
+    serve.add_argument('--port', type=int, default=DEFAULT_PORT)
+    serve.add_argument('--max-batch', type=int, default=MAX_BATCH)
+    serve.add_argument('--batch-window-ms', type=float, default=BATCH_WINDOW * 1000)
+    serve.add_argument('--max-pending', type=int, default=MAX_PENDING)
+    serve.add_argument('--max-conn-pending',
+                       type=int,
+                       default=MAX_CONN_PENDING,
+                       help='Queued requests of one connection before it is no longer read')
+    serve.add_argument('--max-conn-output',
+                       type=int,
+                       default=MAX_CONN_OUTPUT,
+                       help='Unsent responses of one connection before it is no longer read')
+    serve.add_argument('--cache-size',
+                       type=int,
+                       default=None,
+                       help='BSSIDs kept in the lookup cache, 0 to disable')
+
+    load = commands.add_parser('load', help='Generate load against a running service')
+    load.add_argument('--bssids',
+                      required=True,
+                      help='File with one BSSID per line to build scans from')
+    load.add_argument('--host', default='127.0.0.1')
+    load.add_argument('--port', type=int, default=DEFAULT_PORT)
+    load.add_argument('--connections', type=int, default=8)
+    load.add_argument('--requests',
+                      type=int,
+                      default=1000,
+                      help='Requests sent by each connection')
+    load.add_argument('--scan-size', type=int, default=10)
+    args = parser.parse_args()
+
+    if args.command == 'load':
+        result = run_load(args.host,
+                          args.port,
+                          fetch_bssids(args.bssids),
+                          args.connections,
+                          args.requests,
+                          args.scan_size)
+        print json.dumps(result, indent=2, sort_keys=True, separators=(',', ': '))
+        return
+
+    if args.bundle:
+        trie, city_tiles = bundle.load_bundle(args.bundle)
+    elif args.trie and args.city_tiles:
+        trie = load_trie(args.trie)
+        city_tiles = OrderedCityTiles(load_fromdisk=True, fname=args.city_tiles)
+    else:
+        parser.error('serve needs either --bundle or both --trie and --city-tiles')
+    fixer_args = {}
+    if args.cache_size is not None:
+        fixer_args['cache_size'] = args.cache_size
+    fixer = LocationFixer(trie, city_tiles, STRATEGIES, args.trie, **fixer_args)
+    service = FixService(fixer,
+                         args.host,
+                         args.port,
+                         max_batch=args.max_batch,
+                         batch_window=args.batch_window_ms / 1000.0,
+                         max_pending=args.max_pending,
+                         max_conn_pending=args.max_conn_pending,
+                         max_conn_output=args.max_conn_output)
+    print "Serving fixes on %s:%d" % service.address
+    try:
+        service.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,75 @@
+"""
+A cache of trie lookups shared by the fixes of one LocationFixer.
+
+Scans taken close together see mostly the same BSSIDs.  The cache
+maps a raw BSSID to its trie key and the tuple of tile ids stored
+for it, so a repeated BSSID is neither hashed nor decoded again.
+BSSIDs which aren't in the trie are cached too, with no tile ids.
+
+The least recently used BSSID is dropped once the cache is full.  A
+lock guards the cache so one fixer can serve many threads.
+"""
+
+import threading
+from collections import OrderedDict
+
+DEFAULT_CAPACITY = 10000
+
+
+class LookupCache(object):
+    def __init__(self, trie, capacity=DEFAULT_CAPACITY):
+        if capacity < 1:
+            raise RuntimeError("Invalid cache capacity: %d" % capacity)
+        self.trie = trie
+        self.capacity = capacity
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def lookup(self, bssid, key=None):
+        '''
+        Return (trie key, tile ids) for a raw BSSID.  The tile ids are
+        None if the BSSID isn't in the trie.  A caller which already
+        hashed the BSSID passes its trie key.
+        '''
+        with self._lock:
+            entry = self._entries.pop(bssid, None)
+            if entry is not None:
+                # Re-inserting marks the BSSID as the most recently used
+                self._entries[bssid] = entry
+                self.hits += 1
+                return entry
+            self.misses += 1
+
+        # Hash and decode outside the lock.  Two threads which miss on
+        # the same BSSID both compute the same entry.
+        if key is None:
+            key = self.trie.bssid_key(bssid)
+        matchContainer = self.trie.get(key)
+        tile_ids = None
+        if matchContainer is not None:
+            tile_ids = matchContainer[0]
+        entry = (key, tile_ids)
+
+        with self._lock:
+            self._entries[bssid] = entry
+            while len(self._entries) > self.capacity:
+                self._entries.popitem(last=False)
+        return entry
+
+    def __len__(self):
+        return len(self._entries)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits,
+                    'misses': self.misses,
+                    'size': len(self._entries),
+                    'capacity': self.capacity}
@@ -9,23 +9,20 @@ Test this using test_fancy.py and nose.
 
 import json
 import datetime
-from os.path import abspath, expanduser
 import copy
-import hashlib
-from marisa_trie import RecordTrie
-
-DUPE_NUM = 3
+import trieformat
+from lookupcache import DEFAULT_CAPACITY, LookupCache
 
 
 def offline_fix(trie, city_tiles, strategies, bssids):
     """
-    Setup an array of small integers (16bit) to map to all possible
-    tiles (64k).
+    Setup a sparse map of tile scores (see tilescores.py).  Only the
+    tiles returned for the BSSIDs are ever stored.
 
     Fetch all set results from the trie for each found BSSID and
-    add 1 point to the array index for each location.
+    add 1 point to the score of each tile.
 
-    When all BSSIDs have been exhausted, scan the array. For every
+    When all BSSIDs have been exhausted, scan the scores. For every
     index where we have 2 or more points, we want to weight those
     matches heavily - so multiply the value by 5 and overwrite the
     index value.
@@ -53,37 +50,94 @@ def offline_fix(trie, city_tiles, strategies, bssids):
     return solution.asjson()
 
 
+def offline_fixes(trie, city_tiles, strategies, scans):
+    """
+    Compute the fixes of many scans at once.  scans is a list of
+    BSSID lists, and one JSON solution is returned for each scan in
+    the same order.
+    """
+    fixer = LocationFixer(trie,
+                          city_tiles,
+                          strategies,
+                          '../outputs/toronto.record_trie')
+
+    now = datetime.datetime.now()
+    solutions = fixer.find_solutions([(now, bssids) for bssids in scans])
+    return [soln.asjson() for soln in solutions]
+
+
 def load_trie(trie_filename):
-    fmt = ">" + ("i" * DUPE_NUM)
-    l = abspath(expanduser(trie_filename))
-    return RecordTrie(fmt).mmap(l)
+    """
+    Memory map a record trie.  The record format is read from the
+    trie's header, see trieformat.py.
+
+    If the file is the index of a sharded trie, each shard is only
+    mapped the first time a BSSID in its range is looked up.
+    """
+    return trieformat.load_trie(trie_filename)
 
 
 class LocationFixer(object):
     """
     This class provides location fixes for a particular
     city.
+
+    Trie lookups of raw BSSIDs are kept in an LRU cache of cache_size
+    BSSIDs which is shared by every fix, see lookupcache.py.  Pass a
+    cache_size of 0 to turn the cache off.
     """
-    def __init__(self, trie, city_tiles, strategies, trie_filename):
+    def __init__(self, trie, city_tiles, strategies, trie_filename,
+                 cache_size=DEFAULT_CAPACITY):
 
         self.strategies = strategies
 
         self.offline_trie = trie
         self.city_tiles = city_tiles
 
-    def find_solution(self, fixTime, bssids):
+        # The trie header, which a bundle carries too, says how the
+        # city was encoded
+        self.zoom = trie.header['zoom']
+        self.dupe_num = trie.header['dupe_num']
+
+        self.lookup_cache = None
+        if cache_size:
+            self.lookup_cache = LookupCache(trie, cache_size)
+
+    def lookup(self, bssid, key=None):
+        '''
+        Return (trie key, tile ids) for a raw BSSID.  The tile ids are
+        None if the BSSID isn't in the trie.  A caller which already
+        hashed the BSSID passes its trie key.
+        '''
+        if self.lookup_cache is not None:
+            return self.lookup_cache.lookup(bssid, key)
+        if key is None:
+            key = self.offline_trie.bssid_key(bssid)
+        matchContainer = self.offline_trie.get(key)
+        if matchContainer is None:
+            return key, None
+        return key, matchContainer[0]
+
+    def find_solution(self, fixTime, bssids, bssid_keys=None):
         '''
         Try to find a location fix given a time stamp and the BSSIDs
-        that were collected at that time.
+        that were collected at that time.  bssid_keys are the trie keys
+        of the BSSIDs, if the caller has already hashed them.
 
         The timestamp is not precise and is considered accurate to within 1
         minute.
         '''
-
+        if bssid_keys is None:
+            lookups = [self.lookup(b) for b in bssids]
+        else:
+            lookups = [self.lookup(b, k) for (b, k) in zip(bssids, bssid_keys)]
         soln = LocationSolution(self.offline_trie,
                                 self.city_tiles,
                                 fixTime,
-                                bssids)
+                                bssids,
+                                [key for (key, tile_ids) in lookups],
+                                dict((key, tile_ids) for (key, tile_ids) in lookups
+                                     if tile_ids is not None))
         prev_strategy = None
 
         for strategy in self.strategies:
@@ -92,6 +146,41 @@ class LocationFixer(object):
             prev_strategy = curStrategy
         return soln
 
+    def find_solutions(self, scans):
+        '''
+        Find the location fixes of a batch of (fixTime, bssids) scans.
+        Returns a LocationSolution for each scan, in order.
+
+        A BSSID which appears in several scans of the batch is only
+        hashed and looked up in the trie once.  Each strategy is run
+        over the whole batch, see execute_batch.
+        '''
+        scans = list(scans)
+        bssid_keys = {}
+        matches = {}
+        for fixTime, bssids in scans:
+            for bssid in bssids:
+                if bssid not in bssid_keys:
+                    key, tile_ids = self.lookup(bssid)
+                    bssid_keys[bssid] = key
+                    if tile_ids is not None:
+                        matches[key] = tile_ids
+
+        solns = [LocationSolution(self.offline_trie,
+                                  self.city_tiles,
+                                  fixTime,
+                                  bssids,
+                                  [bssid_keys[b] for b in bssids],
+                                  matches)
+                 for (fixTime, bssids) in scans]
+        prev_strategy = None
+
+        for strategy in self.strategies:
+            curStrategy = strategy(self, prev_strategy)
+            curStrategy.execute_batch(solns, matches)
+            prev_strategy = curStrategy
+        return solns
+
 
 class LocationSolution(object):
     """
@@ -104,15 +193,25 @@ class LocationSolution(object):
     Each strategy places it's solution data into the dict with a key
     using it's classname. It is the responsibility of each strategy to
     store well structured data. No particular constraints are
-    implemented.
+    implemented, except that stored data must not be changed
+    afterwards.  Later strategies share it through get_soln_data.
     """
-    def __init__(self, trie, city_tiles, fix_time, bssids):
+    def __init__(self, trie, city_tiles, fix_time, bssids, bssid_keys=None,
+                 matches=None):
         # These should be immutable constants
         self.trie = trie
         self.fixTime = fix_time
         # Make the BSSID list a tuple to force it to be immutable
 
-        self.bssids = tuple([hashlib.sha256(b).hexdigest()[:12] for b in bssids])
+        # The trie keys of the BSSIDs can be passed in if they have
+        # already been hashed
+        if bssid_keys is None:
+            bssid_keys = [trie.bssid_key(b) for b in bssids]
+        self.bssids = tuple(bssid_keys)
+
+        # Tile ids of the keys found in the trie, if they have already
+        # been looked up
+        self.matches = matches
 
         self.city_tiles = city_tiles
 
@@ -122,8 +221,28 @@ class LocationSolution(object):
         self.strategy_solutions = {}
         self.strategy_guess = {}
 
+    def tile_ids(self, bssid_key):
+        """
+        Return the tile ids stored for a hashed BSSID, or None
+        """
+        if self.matches is not None:
+            return self.matches.get(bssid_key)
+        matchContainer = self.trie.get(bssid_key)
+        if matchContainer is None:
+            return None
+        return matchContainer[0]
+
     def get_soln_data(self, cls):
-        return copy.deepcopy(self.strategy_solutions[cls.__name__])
+        """
+        Return the data an earlier strategy stored.  Tile scores are
+        never copied.  They come back as an overlay which reads
+        through to the stored scores and keeps any changes to itself.
+        Any other data is deep copied.
+        """
+        data = self.strategy_solutions[cls.__name__]
+        if hasattr(data, 'overlay'):
+            return data.overlay()
+        return copy.deepcopy(data)
 
     def add_soln(self, cls, data, best_guess):
         '''
@@ -164,7 +283,11 @@ class LocationSolution(object):
         tile_ids = self._best_guess()
 
         tile_coords = [self.city_tiles[t_id] for t_id in tile_ids]
-        return json.dumps({'city_tiles': tile_ids, 'tile_coord': tile_coords})
+        # Tile co-ordinates are at the zoom level of each tile
+        tile_zooms = [self.city_tiles.zoom(t_id) for t_id in tile_ids]
+        return json.dumps({'city_tiles': tile_ids,
+                           'tile_coord': tile_coords,
+                           'tile_zoom': tile_zooms})
 
     def __str__(self):
         return self.asjson()
@@ -1,9 +1,14 @@
 """
 This module is cribbed from 
 http://wiki.openstreetmap.org/wiki/Slippy_map_tilenames#Python
+
+The *_array variants are numpy versions of the same functions that
+convert whole columns of co-ordinates at once.
 """
 import math
 
+import numpy as np
+
 def num2deg(xtile, ytile, zoom):
     n = 2.0 ** zoom
     lon_deg = xtile / n * 360.0 - 180.0
@@ -24,3 +29,29 @@ def deg2num(lat_deg, lon_deg, zoom):
     ytile = int((1.0 - math.log(math.tan(lat_rad) + (1 /
                 math.cos(lat_rad))) / math.pi) / 2.0 * n)
     return (xtile, ytile)
+
+def num2deg_array(xtiles, ytiles, zoom):
+    """
+    Convert arrays of tile x and y co-ordinates into arrays of
+    (lat_deg, lon_deg) for the north west corner of each tile.
+    """
+    xtiles = np.asarray(xtiles, dtype=np.float64)
+    ytiles = np.asarray(ytiles, dtype=np.float64)
+    n = 2.0 ** zoom
+    lon_deg = xtiles / n * 360.0 - 180.0
+    lat_rad = np.arctan(np.sinh(math.pi * (1 - 2 * ytiles / n)))
+    lat_deg = np.degrees(lat_rad)
+    return (lat_deg, lon_deg)
+
+def deg2num_array(lat_deg, lon_deg, zoom):
+    """
+    Convert arrays of latitudes and longitudes into arrays of
+    (xtile, ytile) integer co-ordinates at a zoom level.
+    """
+    lat_rad = np.radians(np.asarray(lat_deg, dtype=np.float64))
+    lon_deg = np.asarray(lon_deg, dtype=np.float64)
+    n = 2.0 ** zoom
+    xtile = ((lon_deg + 180.0) / 360.0 * n).astype(np.int64)
+    ytile = ((1.0 - np.log(np.tan(lat_rad) + (1 /
+             np.cos(lat_rad))) / math.pi) / 2.0 * n).astype(np.int64)
+    return (xtile, ytile)
@@ -1,67 +1,63 @@
-import math
+import numpy as np
 
+import slippytiles
+from tilescores import TileScores
 
-class AbstractLocationFixStrategy(object):
 
-    ZOOM_LEVEL = 18
+class AbstractLocationFixStrategy(object):
 
     def __init__(self, locationFixer, prevStep):
         self.locationFixer = locationFixer
         self.prevStep = prevStep
 
     def num2deg(self, xtile, ytile, zoom):
-        n = 2.0 ** zoom
-        lon_deg = xtile / n * 360.0 - 180.0
-        lat_rad = math.atan(math.sinh(math.pi * (1 - 2 * ytile / n)))
-        lat_deg = math.degrees(lat_rad)
-        return (lat_deg, lon_deg)
+        return slippytiles.num2deg(xtile, ytile, zoom)
 
     def deg2num(self, lat_deg, lon_deg, zoom):
         """
         Compute lat, lon and zoom level to an x,y tile co-ordinate
-        Zoom level is defined as:
-        * 0 (1 tile for the world)
-        * 19 max zoom (274,877,906,944 tiles for the world)
         """
-        lat_rad = math.radians(lat_deg)
-        n = 2.0 ** zoom
-        xtile = int((lon_deg + 180.0) / 360.0 * n)
-        ytile = int((1.0 - math.log(math.tan(lat_rad) + (1 /
-                    math.cos(lat_rad))) / math.pi) / 2.0 * n)
-        return (xtile, ytile)
-
-    def safe_city_tiles(self, x, y, city_tiles):
+        return slippytiles.deg2num(lat_deg, lon_deg, zoom)
+
+    def safe_city_tiles(self, x, y, city_tiles, zoom=None):
+        if zoom is None:
+            zoom = self.locationFixer.zoom
         try:
-            return city_tiles[(x, y)]
+            # Neighbours in a sparse part of the city may have been
+            # merged into a coarser tile.
+            return city_tiles.resolve((x, y, zoom))
         except KeyError:
             # This can happen if the adjacent tile is on the edge of a
             # city border
             return None
 
     def adjacent_tile(self, tile_id):
-        city_tiles = self.locationFixer.city_tiles
-        tx, ty = city_tiles[tile_id]
-
-        # This shouldn't happen but it does.  Just skip this
-        # problem for now and come back to it later.
-        if (tx, ty) == (None, None):
-            raise StopIteration()
-
-        for (x, y) in [(tx-1, ty-1), (tx, ty-1), (tx+1, ty-1),
-                       (tx-1, ty), (tx+1, ty), (tx-1, ty+1),
-                       (tx, ty+1), (tx+1, ty+1)]:
-            tmp_result = self.safe_city_tiles(x, y, city_tiles)
-            if tmp_result is not None:
-                yield tmp_result
+        """
+        The tile ids next to tile_id.  The city tiles compute the
+        neighbours of every tile once, so this is only a slice.
+        """
+        return self.locationFixer.city_tiles.neighbours(tile_id)
 
     def execute(self):
         """ Concrete strategies must implements a strategy against"""
         raise NotImplementedError
 
+    def execute_batch(self, locationSolutions, matches):
+        """
+        Run the strategy over a batch of solutions.  matches maps the
+        trie key of every BSSID in the batch that was found in the
+        trie to its tuple of tile ids.
+
+        Strategies which can work on the whole batch at once override
+        this.
+        """
+        for locationSolution in locationSolutions:
+            self.execute(locationSolution)
+
 
 class BasicLocationFix(AbstractLocationFixStrategy):
     """
-    This tries to build a map of 65535 tiles and tries
+    This scores every tile returned for the BSSIDs and tries
     to find tiles where multiple BSSID lookups agree on a location.
     """
     def __init__(self, locationFixer, prevStep):
@@ -71,29 +67,60 @@ class BasicLocationFix(AbstractLocationFixStrategy):
         # This is always the first fix, we don't care about any prior
         # possible solutions
 
-        tile_points = [0] * ((2**16)-1)
-
-        bssids = locationSolution.bssids
-        trie = locationSolution.trie
+        tile_points = TileScores()
 
-        for bssid in bssids:
-            matchContainer = trie.get(bssid)
-            if matchContainer is None:
+        for bssid in locationSolution.bssids:
+            tile_ids = locationSolution.tile_ids(bssid)
+            if tile_ids is None:
                 continue
-            for pt in matchContainer[0]:
+            for pt in tile_ids:
                 tile_points[pt] += 1
 
-        highest_score_intile = max(tile_points)
-        best_guess = []
-
-        if highest_score_intile > 0:
-            for i, v in enumerate(tile_points):
-                if v == highest_score_intile:
-                    best_guess.append(i)
-
         locationSolution.add_soln(self.__class__,
                                   tile_points,
-                                  tuple(best_guess))
+                                  tuple(tile_points.best_tiles()))
+
+    def execute_batch(self, locationSolutions, matches):
+        # Every (scan, tile id) hit of the batch goes into one array,
+        # packed as scan << 32 | tile id.
+        tile_ids = []
+        scan_hits = []
+        for locationSolution in locationSolutions:
+            start = len(tile_ids)
+            for bssid in locationSolution.bssids:
+                match = matches.get(bssid)
+                if match is not None:
+                    tile_ids.extend(match)
+            scan_hits.append(len(tile_ids) - start)
+
+        scan_idxs = np.repeat(np.arange(len(locationSolutions), dtype=np.int64), scan_hits)
+        hits = (scan_idxs << 32) | np.array(tile_ids, dtype=np.int64)
+        hits, scores = np.unique(hits, return_counts=True)
+        hit_scans = hits >> 32
+        hit_tiles = hits & 0xffffffff
+
+        # Hits are sorted by scan, then by tile id
+        bounds = np.searchsorted(hit_scans, np.arange(len(locationSolutions) + 1))
+        best = np.zeros(len(hits), dtype=bool)
+        starts = bounds[:-1][bounds[:-1] < bounds[1:]]
+        if len(starts):
+            max_scores = np.maximum.reduceat(scores, starts)
+            best = scores == np.repeat(max_scores, np.diff(np.append(starts, len(hits))))
+
+        hit_tiles = hit_tiles.tolist()
+        scores = scores.tolist()
+        best = best.tolist()
+        for i, locationSolution in enumerate(locationSolutions):
+            start, end = bounds[i], bounds[i + 1]
+            # dict.update skips the per item checks of Counter.update
+            tile_points = TileScores()
+            dict.update(tile_points, zip(hit_tiles[start:end], scores[start:end]))
+            best_guess = [tile_id for (tile_id, is_best) in zip(hit_tiles[start:end],
+                                                                best[start:end])
+                          if is_best]
+            locationSolution.add_soln(self.__class__,
+                                      tile_points,
+                                      tuple(best_guess))
 
 
 class SimpleTieBreaker(AbstractLocationFixStrategy):
@@ -102,21 +129,11 @@ class SimpleTieBreaker(AbstractLocationFixStrategy):
                                                prevStep)
 
     def execute(self, locationSolution):
-        # Make a copy of previous data sets
+        # Changes to the previous scores only go into our overlay
         tile_points = locationSolution.get_soln_data(BasicLocationFix)
 
         # We have to solve a tie breaker
-        assert len(tile_points) == 65535
-
-        max_pts_in_tile = max(tile_points)
-        if max_pts_in_tile == 0:
-            return
-
-        working_tileset = set()
-        for tile_id, tile_pts in enumerate(tile_points):
-            if tile_pts == max_pts_in_tile:
-                working_tileset.add(tile_id)
-
+        working_tileset = tile_points.best_tiles()
         if len(working_tileset) <= 1:
             return
 
@@ -149,14 +166,9 @@ class SimpleTieBreaker(AbstractLocationFixStrategy):
         for k, v in adj_tile_points.items():
             tile_points[k] += v
 
-        max_tilept = 0
-        maxpt_tileset = set()
-        for i, v in enumerate(tile_points):
-            if v >= max_tilept:
-                max_tilept = v
-                maxpt_tileset.clear()
-            if max_tilept == v:
-                maxpt_tileset.add(i)
+        # Ties between the highest scoring tiles still go to the
+        # highest tile id.
+        maxpt_tileset = tile_points.best_tiles()[-1:]
 
         locationSolution.add_soln(self.__class__,
                                   tile_points,
@@ -0,0 +1,54 @@
+"""
+A city bundle must give the same fixes as the trie and city tile
+files it was made from.
+"""
+
+import os
+import shutil
+import tempfile
+
+from bundle import CityBundle, is_bundle, load_bundle, save_bundle
+from citytiles import OrderedCityTiles
+from fixture_loader import fetch_bssids
+from searcher import LocationFixer, load_trie, offline_fixes
+from strategies import BasicLocationFix, SimpleTieBreaker
+
+TRIE = 'tests/fixtures/newmarket.trie'
+CITY_CSV = 'tests/fixtures/newmarket_ordered_city.csv'
+BSSIDS = fetch_bssids('tests/fixtures/newmarket_fixtures.json')
+STRATEGIES = [BasicLocationFix, SimpleTieBreaker]
+
+
+def test_bundle_fixes():
+    tmpdir = tempfile.mkdtemp()
+    try:
+        trie = load_trie(TRIE)
+        city_tiles = OrderedCityTiles(load_fromdisk=True, fname=CITY_CSV)
+        bundle_fname = os.path.join(tmpdir, 'area.bundle')
+        save_bundle(bundle_fname, TRIE, city_tiles)
+
+        assert is_bundle(bundle_fname)
+        assert not is_bundle(TRIE)
+        city_bundle = CityBundle(bundle_fname)
+        assert city_bundle.header == trie.header
+        assert city_bundle.bloom() is None
+
+        bundle_trie, bundle_tiles = load_bundle(bundle_fname)
+        assert len(bundle_trie) == len(trie)
+        scans = [BSSIDS, BSSIDS[:3], BSSIDS[::-2], []]
+        assert (offline_fixes(bundle_trie, bundle_tiles, STRATEGIES, scans) ==
+                offline_fixes(trie, city_tiles, STRATEGIES, scans))
+
+        # The fixer takes the zoom level and dupe_num from the header
+        fixer = LocationFixer(bundle_trie, bundle_tiles, STRATEGIES, None)
+        assert fixer.zoom == city_bundle.header['zoom'] == 18
+        assert fixer.dupe_num == city_bundle.header['dupe_num']
+        strategy = BasicLocationFix(fixer, None)
+        for tile_id in range(bundle_tiles.size()):
+            x, y = bundle_tiles[tile_id]
+            zoom = bundle_tiles.zoom(tile_id)
+            if zoom == fixer.zoom:
+                assert strategy.safe_city_tiles(x, y, bundle_tiles) == tile_id
+            assert strategy.safe_city_tiles(x, y, bundle_tiles, zoom) == tile_id
+    finally:
+        shutil.rmtree(tmpdir)
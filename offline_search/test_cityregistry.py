@@ -0,0 +1,110 @@
+"""
+The city registry must route each scan to the city holding its
+BSSIDs and only keep memory_budget bytes of cities open.
+"""
+
+import datetime
+import os
+import shutil
+import tempfile
+
+import bloom
+import bundle
+import trieformat
+from cityregistry import CityRegistry
+from citytiles import OrderedCityTiles
+from fixture_loader import fetch_bssids
+from searcher import load_trie
+
+TRIE = 'tests/fixtures/newmarket.trie'
+CITY_CSV = 'tests/fixtures/newmarket_ordered_city.csv'
+BSSIDS = fetch_bssids('tests/fixtures/newmarket_fixtures.json')
+
+# BSSIDs of a made up second city
+NORTH_BSSIDS = ['02000000%04x' % i for i in range(20)]
+
+
+def _build_north(output_dir):
+    '''
+    Write a small city bundle in the layout of an encoder build
+    '''
+    os.makedirs(output_dir)
+    header = trieformat.legacy_header()
+    records = [(trieformat.bssid_key(b, header['key_scheme']), (i, i + 1, i + 2))
+               for (i, b) in enumerate(NORTH_BSSIDS)]
+    trie_fname = os.path.join(output_dir, 'area.record_trie')
+    trieformat.save_trie(trie_fname, records, header)
+    bundle.save_bundle(os.path.join(output_dir, 'area.bundle'),
+                       trie_fname,
+                       OrderedCityTiles(load_fromdisk=True, fname=CITY_CSV),
+                       bloom.BloomFilter.build([trieformat.key_value(key, header['key_scheme'])
+                                                for (key, tile_ids) in records]))
+
+
+def _registry(tmpdir, **kwargs):
+    registry = CityRegistry(**kwargs)
+    registry.add_city('newmarket', TRIE, CITY_CSV)
+    north_dir = os.path.join(tmpdir, 'north')
+    _build_north(north_dir)
+    registry.add_output_dir('north', north_dir)
+    return registry
+
+
+def test_routing():
+    tmpdir = tempfile.mkdtemp()
+    try:
+        registry = _registry(tmpdir)
+        assert registry.open_cities() == []
+
+        trie = load_trie(TRIE)
+        found = [b for b in BSSIDS if trie.bssid_key(b) in trie]
+        assert found
+        assert registry.candidates(found)[0] == ('newmarket', len(found))
+        assert registry.candidates(NORTH_BSSIDS)[0] == ('north', len(NORTH_BSSIDS))
+
+        now = datetime.datetime.now()
+        name, soln = registry.find_solution(now, found)
+        assert name == 'newmarket'
+        assert soln.matches
+        assert registry.open_cities() == ['newmarket']
+
+        name, soln = registry.find_solution(now, NORTH_BSSIDS[:3])
+        assert name == 'north'
+        assert sorted(soln.matches.values()) == [(0, 1, 2), (1, 2, 3), (2, 3, 4)]
+        assert registry.open_cities() == ['newmarket', 'north']
+
+        # Routing and the trie lookups hash each BSSID only once
+        hashed = []
+        bssid_digest = trieformat.bssid_digest
+        trieformat.bssid_digest = lambda b: hashed.append(b) or bssid_digest(b)
+        try:
+            name, soln = registry.find_solution(now, NORTH_BSSIDS[3:6])
+        finally:
+            trieformat.bssid_digest = bssid_digest
+        assert name == 'north'
+        assert sorted(soln.matches.values()) == [(3, 4, 5), (4, 5, 6), (5, 6, 7)]
+        assert hashed == NORTH_BSSIDS[3:6]
+
+        assert registry.find_solution(now, ['ffffffffffff']) == (None, None)
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def test_eviction():
+    tmpdir = tempfile.mkdtemp()
+    try:
+        # Only one city fits at a time
+        registry = _registry(tmpdir, memory_budget=1)
+        now = datetime.datetime.now()
+
+        assert registry.find_solution(now, NORTH_BSSIDS)[0] == 'north'
+        assert registry.open_cities() == ['north']
+        assert registry.find_solution(now, BSSIDS)[0] == 'newmarket'
+        assert registry.open_cities() == ['newmarket']
+        assert registry.cities['north'].fixer is None
+        assert registry.find_solution(now, NORTH_BSSIDS)[0] == 'north'
+
+        assert registry.stats['loads'] == 3
+        assert registry.stats['evictions'] == 2
+    finally:
+        shutil.rmtree(tmpdir)
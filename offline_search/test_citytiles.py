@@ -0,0 +1,100 @@
+"""
+The binary city tile file must give the same tile ids as the CSV
+file it replaces.
+"""
+
+import os
+import shutil
+import tempfile
+
+from citytiles import OrderedCityTiles
+from slippytiles import num2deg
+
+ZOOM_LEVEL = 18
+CITY_CSV = 'tests/fixtures/newmarket_ordered_city.csv'
+
+
+def test_binary_matches_csv():
+    tmpdir = tempfile.mkdtemp()
+    try:
+        csv_tiles = OrderedCityTiles(load_fromdisk=True, fname=CITY_CSV)
+        bin_fname = os.path.join(tmpdir, 'ordered_city.bin')
+        csv_tiles.save(bin_fname)
+        bin_tiles = OrderedCityTiles(load_fromdisk=True, fname=bin_fname)
+
+        assert bin_tiles.size() == csv_tiles.size() > 0
+        for tile_id in range(csv_tiles.size()):
+            tile_key = csv_tiles[tile_id]
+            assert bin_tiles[tile_id] == tile_key
+            assert bin_tiles[tile_key] == csv_tiles[tile_key] == tile_id
+            assert bin_tiles.center(tile_id) == csv_tiles.center(tile_id)
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def test_mixed_zooms():
+    tmpdir = tempfile.mkdtemp()
+    try:
+        city_tiles = OrderedCityTiles()
+        for tile_key in [(202, 300), (203, 300), (25, 38, 15), (100, 150, 17)]:
+            city_tiles.put(tile_key)
+        city_tiles.finalize(os.path.join(tmpdir, 'ordered_city.csv'))
+
+        # Tiles sort by their north west corner at zoom level 18
+        assert [city_tiles[i] for i in range(4)] == [(100, 150), (25, 38),
+                                                     (202, 300), (203, 300)]
+        assert [city_tiles.zoom(i) for i in range(4)] == [17, 15, 18, 18]
+
+        assert city_tiles.resolve((203, 300)) == 3
+        assert city_tiles.resolve((201, 301)) == 0
+        assert city_tiles.resolve((207, 311)) == 1
+        assert list(city_tiles.resolve_array([203, 201, 207], [300, 301, 311])) == [3, 0, 1]
+
+        tile_xs, tile_ys, zooms = city_tiles.coords_array([1, 3, 0])
+        assert zip(tile_xs, tile_ys, zooms) == [(25, 38, 15), (203, 300, 18), (100, 150, 17)]
+        assert list(city_tiles.find_array(tile_xs, tile_ys, zooms)) == [1, 3, 0]
+        # Unlike resolve_array, a tile must be in the city exactly
+        try:
+            city_tiles.find_array([201], [301], [18])
+            assert False
+        except KeyError:
+            pass
+        try:
+            city_tiles.resolve((300, 300))
+            assert False
+        except KeyError:
+            pass
+
+        # Neighbours are only resolved at the same or a coarser zoom
+        # level, so adjacency isn't symmetric across zoom levels.
+        assert list(city_tiles.neighbours(2)) == [0, 3]
+        assert list(city_tiles.neighbours(0)) == []
+
+        lat, lon = city_tiles.center(1)
+        expected_lat, expected_lon = num2deg(25.5, 38.5, 15)
+        assert abs(lat - expected_lat) < 1e-9
+        assert abs(lon - expected_lon) < 1e-9
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def test_neighbours():
+    city_tiles = OrderedCityTiles(load_fromdisk=True, fname=CITY_CSV)
+    tmpdir = tempfile.mkdtemp()
+    try:
+        bin_fname = os.path.join(tmpdir, 'ordered_city.bin')
+        city_tiles.save(bin_fname)
+        bin_tiles = OrderedCityTiles(load_fromdisk=True, fname=bin_fname)
+
+        for tile_id in range(city_tiles.size()):
+            tx, ty = city_tiles[tile_id]
+            expected = []
+            for dx, dy in [(-1, -1), (0, -1), (1, -1), (-1, 0), (1, 0),
+                           (-1, 1), (0, 1), (1, 1)]:
+                if (tx + dx, ty + dy) in city_tiles:
+                    expected.append(city_tiles[(tx + dx, ty + dy)])
+            assert list(city_tiles.neighbours(tile_id)) == expected
+            assert list(bin_tiles.neighbours(tile_id)) == expected
+        assert list(city_tiles.neighbours(city_tiles.size())) == []
+    finally:
+        shutil.rmtree(tmpdir)
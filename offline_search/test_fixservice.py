@@ -0,0 +1,82 @@
+"""
+Run the fix service on a local port and check that it returns the
+same fixes as offline_fix.
+"""
+
+import json
+import socket
+import threading
+
+from citytiles import OrderedCityTiles
+from fixservice import FixService, STRATEGIES, run_load
+from fixture_loader import fetch_bssids
+from searcher import LocationFixer, load_trie, offline_fix
+
+TRIE = load_trie('tests/fixtures/newmarket.trie')
+CITY_TILES = OrderedCityTiles(load_fromdisk=True,
+                              fname='tests/fixtures/newmarket_ordered_city.csv')
+BSSIDS = fetch_bssids('tests/fixtures/newmarket_fixtures.json')
+
+
+def test_fix_service():
+    fixer = LocationFixer(TRIE, CITY_TILES, STRATEGIES, None)
+    service = FixService(fixer, port=0, max_batch=4, max_conn_pending=2)
+    host, port = service.address
+    thread = threading.Thread(target=service.serve_forever, args=(0.05,))
+    thread.start()
+    try:
+        scans = [BSSIDS, BSSIDS[:2], [], BSSIDS[::-1]]
+        sock = socket.create_connection((host, port))
+        fin = sock.makefile('rb')
+        # Pipeline every request, with a bad one in the middle
+        lines = [json.dumps({'bssids': scan}) for scan in scans]
+        lines.insert(2, 'not json')
+        sock.sendall('\n'.join(lines) + '\n')
+        responses = [fin.readline() for line in lines]
+        fin.close()
+        sock.close()
+
+        assert json.loads(responses.pop(2)) == {'error': 'Invalid request'}
+        for scan, response in zip(scans, responses):
+            assert response.rstrip('\n') == offline_fix(TRIE, CITY_TILES, STRATEGIES, scan)
+
+        result = run_load(host, port, BSSIDS, connections=4, requests=25, scan_size=3)
+        assert result['requests'] == 100
+        assert result['errors'] == 0
+        assert result['p50_ms'] <= result['p99_ms']
+        assert service.stats['requests'] == 105
+        assert service.stats['largest_batch'] <= 4
+    finally:
+        service.stop()
+        thread.join()
+
+
+def test_backpressure():
+    fixer = LocationFixer(TRIE, CITY_TILES, STRATEGIES, None)
+    # Batches are only fixed once the window is over, so every batch
+    # holds whatever the connection was allowed to queue.
+    service = FixService(fixer, port=0, max_batch=100, batch_window=0.05,
+                         max_conn_pending=2)
+    host, port = service.address
+    thread = threading.Thread(target=service.serve_forever, args=(0.05,))
+    thread.start()
+    try:
+        sock = socket.create_connection((host, port))
+        fin = sock.makefile('rb')
+        # All the lines arrive in one read, and the connection must
+        # still queue no more than 2 of them at a time.
+        lines = [json.dumps({'bssids': BSSIDS[:i + 1]}) for i in range(6)]
+        sock.sendall('\n'.join(lines) + '\n')
+        responses = [fin.readline() for line in lines]
+        fin.close()
+        sock.close()
+
+        for line, response in zip(lines, responses):
+            scan = json.loads(line)['bssids']
+            assert response.rstrip('\n') == offline_fix(TRIE, CITY_TILES, STRATEGIES, scan)
+        assert service.stats['requests'] == 6
+        assert service.stats['largest_batch'] == 2
+        assert service.stats['batches'] == 3
+    finally:
+        service.stop()
+        thread.join()
@@ -12,7 +12,6 @@ from slippytiles import num2deg
 
 from strategies import BasicLocationFix, SimpleTieBreaker
 
-ZOOM_LEVEL = 18
 TRIE = load_trie('tests/fixtures/newmarket.trie')
 CITY_TILES = OrderedCityTiles(load_fromdisk=True,
                               fname='tests/fixtures/newmarket_ordered_city.csv')
@@ -25,4 +24,103 @@ def test_newmarket():
 
     # Just pick the first solution
     tile_x, tile_y = json.loads(soln)['tile_coord'][0]
-    assert (44.06785366935761, -79.5025634765625) == num2deg(tile_x, tile_y, ZOOM_LEVEL)
+    assert (44.06785366935761, -79.5025634765625) == num2deg(tile_x, tile_y, TRIE.header['zoom'])
+
+
+def test_sparse_tile_scores():
+    from searcher import LocationFixer
+    from tilescores import ScoreOverlay, TileScores
+
+    scores = TileScores()
+    assert scores.max_score() == 0
+    assert scores.best_tiles() == []
+    for tile_id in (7, 3, 7, 3, 65535):
+        scores[tile_id] += 1
+    assert scores[12] == 0
+    assert len(scores) == 3
+    assert scores.best_tiles() == [3, 7]
+
+    strategies = [BasicLocationFix, SimpleTieBreaker]
+    bssids = fetch_bssids('tests/fixtures/newmarket_fixtures.json')
+    fixer = LocationFixer(TRIE, CITY_TILES, strategies, None)
+    soln = fixer.find_solution(None, bssids)
+    tile_points = soln.get_soln_data(BasicLocationFix)
+    assert isinstance(tile_points, ScoreOverlay)
+    assert 0 < len(tile_points) <= fixer.dupe_num * len(bssids)
+
+    # Changes made through an overlay never reach the stored scores
+    stored = soln.strategy_solutions['BasicLocationFix']
+    tile_id = stored.best_tiles()[0]
+    tile_points[tile_id] += 10
+    tile_points[65535] += 1
+    assert tile_points.best_tiles() == [tile_id]
+    assert tile_points[tile_id] == stored[tile_id] + 10
+    assert len(tile_points) == len(stored) + 1
+    assert 65535 not in stored
+    assert tile_points.changes == {tile_id: stored[tile_id] + 10, 65535: 1}
+
+
+def test_batch_matches_single_fixes():
+    from searcher import LocationFixer, offline_fixes
+
+    strategies = [BasicLocationFix, SimpleTieBreaker]
+    bssids = fetch_bssids('tests/fixtures/newmarket_fixtures.json')
+    scans = [bssids, bssids[:2], [], ['000000000000'], bssids[::-1] + bssids[:1]]
+    fixer = LocationFixer(TRIE, CITY_TILES, strategies, None)
+    solutions = fixer.find_solutions([(None, scan) for scan in scans])
+    assert len(solutions) == len(scans)
+    for scan, soln in zip(scans, solutions):
+        expected = fixer.find_solution(None, scan)
+        assert soln.asjson() == expected.asjson()
+        assert soln.strategy_guess == expected.strategy_guess
+        assert (soln.strategy_solutions['BasicLocationFix'] ==
+                expected.strategy_solutions['BasicLocationFix'])
+
+    assert fixer.find_solutions([]) == []
+    assert offline_fixes(TRIE, CITY_TILES, strategies, scans[:1]) == \
+        [offline_fix(TRIE, CITY_TILES, strategies, scans[0])]
+
+
+def test_lookup_cache():
+    import threading
+    from lookupcache import LookupCache
+    from searcher import LocationFixer
+
+    bssids = fetch_bssids('tests/fixtures/newmarket_fixtures.json')
+    found = [b for b in bssids if TRIE.get(TRIE.bssid_key(b)) is not None]
+    cache = LookupCache(TRIE, capacity=3)
+    key, tile_ids = cache.lookup(found[0])
+    assert key == TRIE.bssid_key(found[0])
+    assert [tile_ids] == TRIE.get(key)
+    assert cache.lookup(found[0]) == (key, tile_ids)
+    assert cache.lookup('000000000000')[1] is None
+    assert cache.stats() == {'hits': 1, 'misses': 2, 'size': 2, 'capacity': 3}
+
+    # found[0] was used more recently than the unknown BSSID
+    cache.lookup(found[0])
+    cache.lookup(found[1])
+    cache.lookup(found[2])
+    assert len(cache) == 3
+    cache.lookup('000000000000')
+    assert cache.stats()['misses'] == 5
+
+    strategies = [BasicLocationFix, SimpleTieBreaker]
+    uncached = LocationFixer(TRIE, CITY_TILES, strategies, None, cache_size=0)
+    expected = uncached.find_solution(None, bssids).asjson()
+    fixer = LocationFixer(TRIE, CITY_TILES, strategies, None)
+    results = []
+
+    def _fix():
+        for i in range(20):
+            results.append(fixer.find_solution(None, bssids).asjson())
+
+    threads = [threading.Thread(target=_fix) for i in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert results == [expected] * 80
+    stats = fixer.lookup_cache.stats()
+    assert stats['hits'] + stats['misses'] == 80 * len(bssids)
+    assert stats['size'] == len(bssids)
+    assert stats['hits'] >= 76 * len(bssids)
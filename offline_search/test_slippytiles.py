@@ -0,0 +1,29 @@
+"""
+The numpy conversions must agree exactly with the scalar functions
+or tile ids would shift between the encoder and the searcher.
+"""
+
+import numpy as np
+
+from slippytiles import deg2num, num2deg, deg2num_array, num2deg_array
+
+ZOOM_LEVEL = 18
+
+
+def test_deg2num_array():
+    rand = np.random.RandomState(42)
+    lats = rand.uniform(43.5, 44.1, 1000)
+    lons = rand.uniform(-79.7, -79.1, 1000)
+
+    tile_xs, tile_ys = deg2num_array(lats, lons, ZOOM_LEVEL)
+    for lat, lon, x, y in zip(lats, lons, tile_xs, tile_ys):
+        assert deg2num(lat, lon, ZOOM_LEVEL) == (x, y)
+
+
+def test_num2deg_array():
+    tile_xs = np.arange(73100, 73200)
+    tile_ys = np.arange(95200, 95300)
+
+    lats, lons = num2deg_array(tile_xs, tile_ys, ZOOM_LEVEL)
+    for x, y, lat, lon in zip(tile_xs, tile_ys, lats, lons):
+        assert num2deg(int(x), int(y), ZOOM_LEVEL) == (lat, lon)
@@ -0,0 +1,111 @@
+"""
+A tracking session must give the same fix as a fresh fix for its
+first scan, keep its fix steady as BSSIDs come and go, and follow
+the device when it moves.
+"""
+
+import datetime
+import json
+import os
+import shutil
+import tempfile
+
+import trieformat
+from citytiles import OrderedCityTiles
+from fixture_loader import fetch_bssids
+from searcher import LocationFixer, load_trie, offline_fix
+from strategies import BasicLocationFix, SimpleTieBreaker
+from tracking import TrackingSession
+
+TRIE = load_trie('tests/fixtures/newmarket.trie')
+CITY_TILES = OrderedCityTiles(load_fromdisk=True,
+                              fname='tests/fixtures/newmarket_ordered_city.csv')
+BSSIDS = fetch_bssids('tests/fixtures/newmarket_fixtures.json')
+STRATEGIES = [BasicLocationFix, SimpleTieBreaker]
+START = datetime.datetime(2015, 5, 12, 20, 29, 36)
+
+
+def _seconds(n):
+    return START + datetime.timedelta(seconds=n)
+
+
+def _fixed_tiles(soln):
+    return json.loads(soln.asjson())['city_tiles']
+
+
+def test_first_scan_matches_offline_fix():
+    fixer = LocationFixer(TRIE, CITY_TILES, STRATEGIES, None)
+    for scan in (BSSIDS, BSSIDS[:2], BSSIDS[1:4], BSSIDS[::-1], []):
+        soln = TrackingSession(fixer).update(START, scan)
+        assert (_fixed_tiles(soln) ==
+                json.loads(offline_fix(TRIE, CITY_TILES, STRATEGIES, scan))['city_tiles'])
+
+
+def test_incremental_updates():
+    fixer = LocationFixer(TRIE, CITY_TILES, STRATEGIES, None)
+    found = [b for b in BSSIDS if TRIE.bssid_key(b) in TRIE]
+    session = TrackingSession(fixer, half_life=10)
+
+    first = _fixed_tiles(session.update(_seconds(0), found))
+    assert first
+    assert session.last_fix == first[0]
+    assert session.last_fix in session.neighbourhood(session.last_fix)
+
+    # Only the changes are applied
+    session.update(_seconds(5), found[1:] + ['ffffffffffff'])
+    assert session.stats['added'] == len(found) + 1
+    assert session.stats['dropped'] == 1
+    assert session.memory
+
+    # Dropped BSSIDs decay, and keep the fix while they do
+    assert _fixed_tiles(session.update(_seconds(10), [])) == first
+    assert session.dropped[found[0]][1] < 1 == session.dropped[found[1]][1]
+    session.update(_seconds(100), [])
+    assert session.memory == {}
+    assert session.dropped == {}
+
+    # A BSSID seen again leaves memory
+    session.update(_seconds(105), found)
+    session.update(_seconds(106), found[1:])
+    session.update(_seconds(107), found)
+    assert session.dropped == {}
+    assert sorted(session.current.items()) == sorted(
+        TrackingSession(fixer).update(START, found)
+        .get_soln_data(TrackingSession).items())
+
+    # A long gap starts over
+    session.update(_seconds(1000), [])
+    assert session.stats['resets'] == 1
+    assert session.last_fix is None
+    assert session.memory == {}
+
+
+def test_relocation():
+    # Two groups of BSSIDs on tiles at either end of the city
+    here = 0
+    there = CITY_TILES.size() - 1
+    here_bssids = ['03000000%04x' % i for i in range(4)]
+    there_bssids = ['04000000%04x' % i for i in range(2)]
+    header = trieformat.make_header(3, num_tiles=CITY_TILES.size())
+    records = ([(trieformat.bssid_key(b, header['key_scheme']), (here,) * 3)
+                for b in here_bssids] +
+               [(trieformat.bssid_key(b, header['key_scheme']), (there,) * 3)
+                for b in there_bssids])
+    tmpdir = tempfile.mkdtemp()
+    try:
+        trie_fname = os.path.join(tmpdir, 'area.record_trie')
+        trieformat.save_trie(trie_fname, records, header)
+        fixer = LocationFixer(load_trie(trie_fname), CITY_TILES, STRATEGIES, None)
+        session = TrackingSession(fixer)
+        assert there not in session.neighbourhood(here)
+
+        assert _fixed_tiles(session.update(_seconds(0), here_bssids)) == [here]
+
+        # The device moved.  The dropped BSSIDs still remember more
+        # points than the new ones score, but the fix must follow.
+        assert _fixed_tiles(session.update(_seconds(5), there_bssids)) == [there]
+        assert session.stats['relocated'] == 1
+        assert session.memory == {}
+        assert _fixed_tiles(session.update(_seconds(10), there_bssids[:1])) == [there]
+    finally:
+        shutil.rmtree(tmpdir)
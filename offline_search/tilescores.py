@@ -0,0 +1,86 @@
+"""
+Scores that the location fix strategies give to city tiles.
+
+A fix only touches the few tiles returned for its BSSIDs, so scores
+are kept sparse.  Only tiles which have been scored are stored, and
+every other tile has a score of 0.  The cost of a fix depends on the
+number of tiles it hits, not on the number of tiles in the city.
+
+Once a strategy has stored its scores in a LocationSolution they are
+never changed.  A later strategy which wants to adjust them works on
+an overlay() instead.  The overlay reads through to the scores it was
+made from and only stores the tiles the later strategy changes, so
+no strategy ever copies the scores of another.
+"""
+
+from collections import Counter
+
+
+class _ScoreQueries(object):
+    '''
+    Queries shared by TileScores and ScoreOverlay.  Both provide
+    iteritems() over every scored tile.
+    '''
+    def max_score(self):
+        '''
+        The highest score of any tile, or 0 if no tile was scored.
+        '''
+        return max([score for (tile_id, score) in self.iteritems()] or [0])
+
+    def best_tiles(self):
+        '''
+        Return the sorted ids of the tiles with the highest score.
+        Nothing is returned unless that score is positive.
+        '''
+        best = self.max_score()
+        if best <= 0:
+            return []
+        return sorted(tile_id for (tile_id, score) in self.iteritems()
+                      if score == best)
+
+    def overlay(self):
+        return ScoreOverlay(self)
+
+
+class TileScores(_ScoreQueries, Counter):
+    '''
+    Map tile ids to scores.  Reading a tile which was never scored
+    returns 0 without storing it.
+    '''
+
+
+class ScoreOverlay(_ScoreQueries):
+    '''
+    A writable view of some scores which keeps its changes to itself
+    '''
+    def __init__(self, base):
+        self.base = base
+        self.changes = TileScores()
+
+    def __getitem__(self, tile_id):
+        if tile_id in self.changes:
+            return self.changes[tile_id]
+        return self.base[tile_id]
+
+    def __setitem__(self, tile_id, score):
+        self.changes[tile_id] = score
+
+    def __contains__(self, tile_id):
+        return tile_id in self.changes or tile_id in self.base
+
+    def __iter__(self):
+        for tile_id, score in self.iteritems():
+            yield tile_id
+
+    def __len__(self):
+        return sum(1 for tile_id in self)
+
+    def iteritems(self):
+        for tile_id, score in self.changes.iteritems():
+            yield tile_id, score
+        for tile_id, score in self.base.iteritems():
+            if tile_id not in self.changes:
+                yield tile_id, score
+
+    def items(self):
+        return list(self.iteritems())
@@ -0,0 +1,231 @@
+"""
+Track one device across a sequence of scans.
+
+A continuous tracking client sends a scan every few seconds, and
+consecutive scans mostly see the same BSSIDs.  A TrackingSession
+keeps the tile scores of the previous scan and only applies the
+BSSIDs which were added or dropped since then :
+
+    current  scores from the BSSIDs in the latest scan.  An added
+             BSSID adds 1 to each of its tiles, a dropped BSSID takes
+             its points away again.  Scores are the same as the ones
+             BasicLocationFix gives the scan.
+    memory   the points of dropped BSSIDs.  They decay by half every
+             half_life seconds and are dropped below MIN_SCORE, so a
+             BSSID which briefly drops out of a scan doesn't move the
+             fix.  A dropped BSSID which is seen again moves back
+             from memory to the current scores.
+
+The score of a tile is its current score plus its memory.  Once the
+device has a fix, only the tiles within rings steps of it are
+candidates for the next fix, as long as the latest scan gives one of
+them a current score as high as any tile in the city.  Otherwise the
+device has moved : the memory belongs to where it was, so it is
+forgotten and the fix follows the current scores across the whole
+city.  If no tile near the fix scores, or no scan was seen for
+max_gap seconds, the session also falls back to the whole city.
+
+Ties between the best tiles are broken like SimpleTieBreaker, by
+adding the scores of adjacent tiles.  Remaining ties stay on the
+previous fix if it is one of them, else go to the highest tile id.
+
+    session = TrackingSession(fixer)
+    for fixTime, bssids in scans:
+        print session.update(fixTime, bssids).asjson()
+
+A session belongs to one device and must not be shared between
+threads.  Sessions of one LocationFixer share its lookup cache.
+"""
+
+from searcher import LocationSolution
+from tilescores import TileScores
+
+# Seconds for the points of a dropped BSSID to decay by half
+HALF_LIFE = 30.0
+
+# Decayed points below this are forgotten
+MIN_SCORE = 0.05
+
+# Steps of adjacent tiles around the previous fix which are searched
+RINGS = 2
+
+# Seconds without a scan after which the session starts over
+MAX_GAP = 120.0
+
+
+class TrackingSession(object):
+    def __init__(self, fixer, half_life=HALF_LIFE, rings=RINGS, max_gap=MAX_GAP):
+        self.fixer = fixer
+        self.half_life = half_life
+        self.rings = rings
+        self.max_gap = max_gap
+        self.stats = {'scans': 0,
+                      'added': 0,
+                      'dropped': 0,
+                      'resets': 0,
+                      'reacquired': 0,
+                      'relocated': 0}
+        self.reset()
+
+    def reset(self):
+        '''
+        Forget every scan seen so far
+        '''
+        # Raw BSSID -> (trie key, tile ids) of the latest scan
+        self.bssids = {}
+        self.current = TileScores()
+        # Raw BSSID -> [tile ids, decayed points] of dropped BSSIDs
+        self.dropped = {}
+        # Tile id -> decayed points of the dropped BSSIDs
+        self.memory = {}
+        self.last_time = None
+        self.last_fix = None
+        self._neighbourhood = None
+
+    def score(self, tile_id):
+        return self.current[tile_id] + self.memory.get(tile_id, 0)
+
+    def neighbourhood(self, tile_id):
+        '''
+        Return the set of tile ids within self.rings steps of a tile,
+        the tile itself included
+        '''
+        city_tiles = self.fixer.city_tiles
+        found = set([tile_id])
+        ring = [tile_id]
+        for i in range(self.rings):
+            next_ring = []
+            for ring_tile in ring:
+                for adjacent_tileid in city_tiles.neighbours(ring_tile).tolist():
+                    if adjacent_tileid not in found:
+                        found.add(adjacent_tileid)
+                        next_ring.append(adjacent_tileid)
+            ring = next_ring
+        return found
+
+    def _decay(self, seconds):
+        if not self.dropped or seconds <= 0:
+            return
+        factor = 0.5 ** (seconds / self.half_life)
+        for bssid, entry in self.dropped.items():
+            entry[1] *= factor
+            if entry[1] < MIN_SCORE:
+                del self.dropped[bssid]
+        self._sum_memory()
+
+    def _sum_memory(self):
+        self.memory = {}
+        for tile_ids, points in self.dropped.itervalues():
+            for tile_id in tile_ids:
+                self.memory[tile_id] = self.memory.get(tile_id, 0) + points
+
+    def _apply(self, bssids):
+        '''
+        Update the current scores with the BSSIDs added and dropped
+        since the previous scan
+        '''
+        bssids = set(bssids)
+        dropped = [b for b in self.bssids if b not in bssids]
+        added = [b for b in bssids if b not in self.bssids]
+
+        remembered = False
+        for bssid in dropped:
+            key, tile_ids = self.bssids.pop(bssid)
+            if tile_ids is None:
+                continue
+            for tile_id in tile_ids:
+                self.current[tile_id] -= 1
+                if not self.current[tile_id]:
+                    del self.current[tile_id]
+            self.dropped[bssid] = [tile_ids, 1.0]
+            remembered = True
+
+        for bssid in added:
+            key, tile_ids = self.fixer.lookup(bssid)
+            self.bssids[bssid] = (key, tile_ids)
+            if tile_ids is None:
+                continue
+            for tile_id in tile_ids:
+                self.current[tile_id] += 1
+            if self.dropped.pop(bssid, None) is not None:
+                remembered = True
+
+        if remembered:
+            self._sum_memory()
+        self.stats['added'] += len(added)
+        self.stats['dropped'] += len(dropped)
+
+    def _candidates(self):
+        '''
+        Return the scores of the tiles the next fix is picked from
+        '''
+        if self.last_fix is not None:
+            if self._neighbourhood is None:
+                self._neighbourhood = self.neighbourhood(self.last_fix)
+            scores = TileScores()
+            best_current = 0
+            for tile_id in self._neighbourhood:
+                points = self.score(tile_id)
+                if points > 0:
+                    scores[tile_id] = points
+                    best_current = max(best_current, self.current[tile_id])
+            if not scores:
+                self.stats['reacquired'] += 1
+            elif best_current >= self.current.max_score():
+                return scores
+            else:
+                self.stats['relocated'] += 1
+                self.dropped = {}
+                self.memory = {}
+
+        scores = TileScores(self.current)
+        for tile_id, points in self.memory.iteritems():
+            scores[tile_id] += points
+        return scores
+
+    def _break_tie(self, best_tiles):
+        if len(best_tiles) <= 1:
+            return best_tiles
+        city_tiles = self.fixer.city_tiles
+        scores = TileScores()
+        for tile_id in best_tiles:
+            adjacent_tileids = city_tiles.neighbours(tile_id).tolist()
+            scores[tile_id] = sum(self.score(t) for t in adjacent_tileids)
+        best_tiles = scores.best_tiles() or best_tiles
+        if self.last_fix in best_tiles:
+            return [self.last_fix]
+        return best_tiles[-1:]
+
+    def update(self, fixTime, bssids):
+        '''
+        Apply the next scan of the device and return its
+        LocationSolution
+        '''
+        if self.last_time is not None:
+            seconds = (fixTime - self.last_time).total_seconds()
+            if seconds > self.max_gap:
+                self.reset()
+                self.stats['resets'] += 1
+            else:
+                self._decay(seconds)
+        self.last_time = fixTime
+        self.stats['scans'] += 1
+
+        self._apply(bssids)
+        scores = self._candidates()
+        best_guess = self._break_tie(scores.best_tiles())
+
+        if best_guess and best_guess[0] != self.last_fix:
+            self.last_fix = best_guess[0]
+            self._neighbourhood = None
+
+        soln = LocationSolution(self.fixer.offline_trie,
+                                self.fixer.city_tiles,
+                                fixTime,
+                                bssids,
+                                [self.bssids[b][0] for b in bssids],
+                                dict((key, tile_ids)
+                                     for (key, tile_ids) in self.bssids.values()
+                                     if tile_ids is not None))
+        soln.add_soln(self.__class__, scores, tuple(best_guess))
+        return soln
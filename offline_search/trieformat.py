@@ -0,0 +1 @@
+../offline_encoder/trieformat.py
\ No newline at end of file
@@ -20,38 +20,15 @@ Preconditions:
 
 Output:
     cleaned_wifi.csv - cleaned input file
-'''
 
-import sys
-import csv
+See offline_encoder/etl.py for the options.
+'''
+import etl
 
 RAW_INPUT = 'wifi_raw.csv'
 CLEAN_OUTPUT = 'cleaned_wifi.csv'
 
-bssid_set = set()
-with open(CLEAN_OUTPUT, 'w') as fout:
-    writer = csv.writer(fout)
-    for i, row in enumerate(csv.reader(open(RAW_INPUT), delimiter='\t')):
-        try:
-            bssid, lat, lon, accuracy_meters = row
-
-            # Do some nominal cleanup
-            bssid = bssid.strip()
-            lat = float(lat)
-            lon = float(lon)
-            accuracy_meters = float(accuracy_meters)
-
-            # TODO: hook plot.ly to generate a histogram of
-            # accuracy data by meters
-            # For now, we just use the entire dataset
-
-            if len(bssid) == 12:
-                if bssid in bssid_set:
-                    print "already have : %s" % bssid
-                    continue
-                bssid_set.add(bssid)
-                writer.writerow((row[0], row[1], row[2]))
-        except:
-            e = sys.exc_info()[0]
-            print "Skipping : %d" % i
-            continue
+if __name__ == '__main__':
+    etl.main(default_input=RAW_INPUT,
+             default_output=CLEAN_OUTPUT,
+             default_format='tsv_accuracy')
@@ -0,0 +1 @@
+../offline_encoder/etl.py
\ No newline at end of file